@@ -8,10 +8,11 @@ Released under the GNU GPL version 3 or later
 '''
 
 import sys, os, time, socket, signal
+
+startup_time = time.time()
 import fnmatch, errno, threading
-import serial, Queue, select
+import serial, Queue
 import traceback
-import select
 import shlex
 import platform
 
@@ -19,13 +20,22 @@ from MAVProxy.modules.lib import textconsole
 from MAVProxy.modules.lib import rline
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import dumpstacks
+from MAVProxy.modules.lib import mp_eventloop
+from MAVProxy.modules.lib import mp_logwriter
+from MAVProxy.modules.lib import mp_perf
+from MAVProxy.modules.lib import mp_sendqueue
+from MAVProxy.modules.lib import mp_history
+from MAVProxy.modules.lib import mp_sharedstate
 
 # adding all this allows pyinstaller to build a working windows executable
 # note that using --hidden-import does not work for these modules
 try:
       from multiprocessing import freeze_support
       from pymavlink import mavwp, mavutil
-      import matplotlib, HTMLParser
+      if getattr(sys, 'frozen', False):
+            # matplotlib is slow to import, only pull it in for frozen builds.
+            # pyinstaller finds it by scanning the imports so this is enough
+            import matplotlib, HTMLParser
       try:
             import readline
       except ImportError:
@@ -56,6 +66,7 @@ class MPStatus(object):
         self.last_mode_announced = 'MAV'
         self.logdir = None
         self.last_heartbeat = 0
+        self.first_heartbeat_time = None
         self.last_message = 0
         self.heartbeat_error = False
         self.last_apm_msg = None
@@ -104,6 +115,7 @@ def add_input(cmd, immediate=False):
         process_stdin(cmd)
     else:
         mpstate.input_queue.put(cmd)
+        mpstate.event_loop.wakeup()
 
 class MAVFunctions(object):
     '''core functions available in modules'''
@@ -131,10 +143,14 @@ class MPState(object):
               MPSetting('heartbeat', int, 1, 'Heartbeat rate', range=(0,5), increment=1),
               MPSetting('mavfwd', bool, True, 'Allow forwarded control'),
               MPSetting('mavfwd_rate', bool, False, 'Allow forwarded rate control'),
+              MPSetting('fastfwd', bool, False, 'Forward raw frames, only decoding subscribed types'),
+              MPSetting('dedup', bool, True, 'Drop duplicate packets from redundant links'),
+              MPSetting('sendqueue', int, 65536, 'Send queue size per link in bytes, 0 to disable', range=(0,10000000), increment=1024),
               MPSetting('shownoise', bool, True, 'Show non-MAVLink data'),
               MPSetting('baudrate', int, opts.baudrate, 'baudrate for new links', range=(0,10000000), increment=1),
               MPSetting('rtscts', bool, opts.rtscts, 'enable flow control'),
               MPSetting('select_timeout', float, 0.01, 'select timeout'),
+              MPSetting('idlerate', int, 50, 'module idle task rate (Hz)', range=(1,1000), increment=1),
 
               MPSetting('altreadout', int, 10, 'Altitude Readout',
                         range=(0,100), increment=1, tab='Announcements'),
@@ -143,6 +159,9 @@ class MPState(object):
               MPSetting('moddebug', int, opts.moddebug, 'Module Debug Level', range=(0,3), increment=1, tab='Debug'),
               MPSetting('compdebug', int, 0, 'Computation Debug Mask', range=(0,3), tab='Debug'),
               MPSetting('flushlogs', bool, False, 'Flush logs on every packet'),
+              MPSetting('logperiod', float, 0.2, 'Log write period (s)', range=(0.01,10)),
+              MPSetting('logfsync', str, 'none', 'Log fsync policy', choice=['none', 'periodic', 'always']),
+              MPSetting('logfsyncperiod', float, 10.0, 'Log fsync period (s)', range=(0.1,3600)),
               MPSetting('requireexit', bool, False, 'Require exit command'),
               MPSetting('wpupdates', bool, True, 'Announce waypoint updates'),
 
@@ -170,6 +189,8 @@ class MPState(object):
         self.completions = {
             "script"         : ["(FILENAME)"],
             "set"            : ["(SETTING)"],
+            "perf"           : ["<show|packet|type|idle|timer|loop|startup|reset|enable|disable|dump>"],
+            "history"        : ["<list|track|untrack|show>"],
             "status"         : ["(VARIABLE)"],
             "module"    : ["list",
                            "load (AVAILMODULES)",
@@ -190,10 +211,27 @@ class MPState(object):
 
         self.mav_param = mavparm.MAVParmDict()
         self.modules = []
+        # bumped whenever the module list or a module's message types change
+        self.module_generation = 0
         self.public_modules = {}
         self.functions = MAVFunctions()
         self.select_extra = {}
+        self.event_loop = mp_eventloop.MPEventLoop(error_handler=event_loop_error)
+        self.perf = mp_perf.MPPerf()
+        self.event_loop.perf = self.perf
+        self.perf_dump_timer = None
+        # ring buffer history of selected message fields
+        self.history = mp_history.MPHistory()
+        # attitude, position etc of the target system in shared memory for GUI children
+        self.shared_state = mp_sharedstate.SharedState()
+        # msgid to send queue priority, built once the dialect is known
+        self.send_priorities = None
+        # (name, import time, init time) for each module loaded
+        self.startup_times = []
         self.continue_mode = False
+        # --speed and --replay-exit for replay:FILE masters
+        self.replay_speed = 1.0
+        self.replay_exit = False
         self.aliases = {}
         import platform
         self.system = platform.system()
@@ -245,6 +283,12 @@ def cmd_status(args):
     '''show status'''
     if len(args) == 0:
         mpstate.status.show(sys.stdout, pattern=None)
+        print(str(mpstate.logqueue))
+        print(str(mpstate.logqueue_raw))
+        for conn in send_queue_connections():
+            q = getattr(conn, 'send_queue', None)
+            if q is not None:
+                print(str(q))
     else:
         for pattern in args:
             mpstate.status.show(sys.stdout, pattern=pattern)
@@ -276,11 +320,24 @@ def load_module(modname, quiet=False):
             return False
     for modpath in modpaths:
         try:
+            t0 = time.time()
+            # only reload if the module was imported before, e.g. after an unload,
+            # a first import is already fresh
+            imported = modpath in sys.modules
             m = import_package(modpath)
-            reload(m)
+            if imported:
+                try:
+                    reload(m)
+                except ImportError:
+                    clear_zipimport_cache()
+                    reload(m)
+            t1 = time.time()
             module = m.init(mpstate)
+            t2 = time.time()
             if isinstance(module, mp_module.MPModule):
+                mpstate.startup_times.append((modname, t1-t0, t2-t1))
                 mpstate.modules.append((module, m))
+                mpstate.module_generation += 1
                 if not quiet:
                     print("Loaded module %s" % (modname,))
                 return True
@@ -301,7 +358,9 @@ def unload_module(modname):
         if m.name == modname:
             if hasattr(m, 'unload'):
                 m.unload()
+            m.remove_timers()
             mpstate.modules.remove((m,pm))
+            mpstate.module_generation += 1
             print("Unloaded module %s" % modname)
             return True
     print("Unable to find module %s" % modname)
@@ -334,12 +393,7 @@ def cmd_module(args):
             print("Module %s not loaded" % modname)
             return
         if unload_module(modname):
-            import zipimport
-            try:
-                reload(pmodule)
-            except ImportError:
-                clear_zipimport_cache()
-                reload(pmodule)
+            # load_module reloads modules that were imported before
             if load_module(modname, quiet=True):
                 print("Reloaded module %s" % modname)
     elif args[0] == "unload":
@@ -352,6 +406,53 @@ def cmd_module(args):
         print(usage)
 
 
+def cmd_history(args):
+    '''telemetry history'''
+    usage = "usage: history <list|track MTYPE FIELD,... [SIZE]|untrack MTYPE|show MTYPE.FIELD [SECONDS] [SYSID]>"
+    history = mpstate.history
+    if len(args) < 1 or args[0] == "list":
+        for mtype in sorted(history.tracked.keys()):
+            print("%s: %s (%u samples)" % (mtype, ','.join(history.tracked[mtype]), history.sizes[mtype]))
+        for (sysid, mtype) in sorted(history.rings.keys()):
+            print("  sysid %u %s: %u samples" % (sysid, mtype, len(history.rings[(sysid, mtype)])))
+        print("%u bytes" % history.memory())
+    elif args[0] == "track":
+        if len(args) < 3:
+            print(usage)
+            return
+        size = None
+        if len(args) > 3:
+            size = int(args[3])
+        history.track(args[1].upper(), args[2].split(','), size=size)
+    elif args[0] == "untrack":
+        if len(args) < 2:
+            print(usage)
+            return
+        mtype = args[1].upper()
+        history.untrack(mtype)
+        if mtype in history.tracked:
+            print("%s is still tracked by %u graph(s)" % (mtype, len(history.owners[mtype])))
+    elif args[0] == "show":
+        if len(args) < 2 or args[1].find('.') == -1:
+            print(usage)
+            return
+        (mtype, field) = args[1].split('.', 1)
+        seconds = 30.0
+        sysid = None
+        if len(args) > 2:
+            seconds = float(args[2])
+        if len(args) > 3:
+            sysid = int(args[3])
+        (times, values) = history.window(mtype.upper(), field, seconds, sysid=sysid)
+        if len(values) == 0:
+            print("No history for %s" % args[1])
+            return
+        print("%s: %u samples over %.1fs min %f max %f mean %f latest %f" % (
+            args[1], len(values), times[-1] - times[0], min(values), max(values),
+            sum(values) / len(values), values[-1]))
+    else:
+        print(usage)
+
 def cmd_alias(args):
     '''alias commands'''
     usage = "usage: alias <add|remove|list>"
@@ -383,6 +484,71 @@ def cmd_alias(args):
         return
 
 
+def perf_dump(filename):
+    '''timer callback for periodic perf dumps'''
+    mpstate.perf.gauge('logqueue', mpstate.logqueue.pending())
+    mpstate.perf.gauge('logqueue_raw', mpstate.logqueue_raw.pending())
+    mpstate.perf.dump(filename)
+
+def startup_report():
+    '''show how long each module took to import and initialise'''
+    from MAVProxy.modules.lib import mp_util
+    print("%-16s %10s %10s" % ('module', 'import(ms)', 'init(ms)'))
+    total_import = 0
+    total_init = 0
+    for (name, import_time, init_time) in mpstate.startup_times:
+        print("%-16s %10.1f %10.1f" % (name, import_time*1000, init_time*1000))
+        total_import += import_time
+        total_init += init_time
+    print("%-16s %10.1f %10.1f" % ('total', total_import*1000, total_init*1000))
+    if mp_util.lazy_import_times:
+        print("deferred imports:")
+        for name in sorted(mp_util.lazy_import_times.keys()):
+            print("  %-14s %10.1f" % (name, mp_util.lazy_import_times[name]*1000))
+    if mpstate.status.first_heartbeat_time is not None:
+        print("first heartbeat after %.2fs" % (mpstate.status.first_heartbeat_time - startup_time))
+
+def cmd_perf(args):
+    '''performance statistics'''
+    usage = "usage: perf <show|packet|type|idle|timer|loop|startup|reset|enable|disable|dump FILENAME [PERIOD]|dump stop>"
+    perf = mpstate.perf
+    if len(args) < 1 or args[0] == "show":
+        for line in perf.report():
+            print(line)
+    elif args[0] in ['packet', 'type', 'idle', 'timer', 'loop']:
+        if len(args) > 1:
+            count = int(args[1])
+        else:
+            count = 20
+        for line in perf.report(args[0], count=count):
+            print(line)
+    elif args[0] == "startup":
+        startup_report()
+    elif args[0] == "reset":
+        perf.reset()
+    elif args[0] == "enable":
+        perf.enabled = True
+    elif args[0] == "disable":
+        perf.enabled = False
+    elif args[0] == "dump":
+        if len(args) < 2:
+            print(usage)
+            return
+        if mpstate.perf_dump_timer is not None:
+            mpstate.perf_dump_timer.cancel()
+            mpstate.perf_dump_timer = None
+        if args[1] == "stop":
+            return
+        filename = args[1]
+        if len(args) > 2:
+            mpstate.perf_dump_timer = mpstate.event_loop.add_timer(float(args[2]), perf_dump,
+                                                                   args=(filename,), name='perf')
+            print("Dumping perf statistics to %s every %.1fs" % (filename, float(args[2])))
+        else:
+            perf_dump(filename)
+    else:
+        print(usage)
+
 def clear_zipimport_cache():
     """Clear out cached entries from _zip_directory_cache.
     See http://www.digi.com/wiki/developer/index.php/Error_messages"""
@@ -422,7 +588,9 @@ command_map = {
     'set'     : (cmd_set,      'mavproxy settings'),
     'watch'   : (cmd_watch,    'watch a MAVLink pattern'),
     'module'  : (cmd_module,   'module commands'),
-    'alias'   : (cmd_alias,    'command aliases')
+    'alias'   : (cmd_alias,    'command aliases'),
+    'history' : (cmd_history,  'telemetry history'),
+    'perf'    : (cmd_perf,     'performance statistics')
     }
 
 def shlex_quotes(value):
@@ -529,7 +697,11 @@ def process_master(m):
     global mavversion
     if m.first_byte and mavversion == None:
         m.auto_mavlink_version(s)
-    msgs = m.mav.parse_buffer(s)
+    link = mpstate.module('link')
+    if link is not None and link.fastfwd_usable(m):
+        msgs = link.master_fastfwd(m, s)
+    else:
+        msgs = m.mav.parse_buffer(s)
     if msgs:
         for msg in msgs:
             sysid = msg.get_srcSystem()
@@ -551,6 +723,12 @@ def process_mavlink(slave):
         buf = slave.recv()
     except socket.error:
         return
+    link = mpstate.module('link')
+    if (link is not None and mpstate.status.watch is None and
+        mpstate.settings.mavfwd and link.fastfwd_usable(slave)):
+        link.slave_fastfwd(slave, buf)
+        mpstate.status.counters['Slave'] += 1
+        return
     try:
         global mavversion
         if slave.first_byte and mavversion == None:
@@ -584,16 +762,22 @@ def mkdir_p(dir):
 
 def log_writer():
     '''log writing thread'''
-    while True:
-        mpstate.logfile_raw.write(mpstate.logqueue_raw.get())
-        timeout = time.time() + 10
-        while not mpstate.logqueue_raw.empty() and time.time() < timeout:
-            mpstate.logfile_raw.write(mpstate.logqueue_raw.get())
-        while not mpstate.logqueue.empty() and time.time() < timeout:
-            mpstate.logfile.write(mpstate.logqueue.get())
-        if mpstate.settings.flushlogs or time.time() >= timeout:
-            mpstate.logfile.flush()
-            mpstate.logfile_raw.flush()
+    # keep our own reference, the global goes away at interpreter shutdown.
+    # Once we are exiting close_telemetry_logs() does the final flush
+    state = mpstate
+    while not state.status.exit:
+        state.logqueue.wake.wait(state.settings.logperiod)
+        state.logqueue.wake.clear()
+        for w in [state.logqueue, state.logqueue_raw]:
+            w.immediate = state.settings.flushlogs
+            w.fsync_policy = state.settings.logfsync
+            w.fsync_period = state.settings.logfsyncperiod
+            try:
+                w.flush_pending()
+            except Exception as e:
+                w.errors += 1
+                if w.errors == 1:
+                    print("ERROR: writing %s: %s" % (w.name, e))
 
 # If state_basedir is NOT set then paths for logs and aircraft
 # directories are relative to mavproxy's cwd
@@ -647,6 +831,8 @@ def open_telemetry_logs(logpath_telem, logpath_telem_raw):
     try:
         mpstate.logfile = open(logpath_telem, mode=mode)
         mpstate.logfile_raw = open(logpath_telem_raw, mode=mode)
+        mpstate.logqueue.set_file(mpstate.logfile)
+        mpstate.logqueue_raw.set_file(mpstate.logfile_raw)
         print("Log Directory: %s" % mpstate.status.logdir)
         print("Telemetry log: %s" % logpath_telem)
 
@@ -670,6 +856,14 @@ def open_telemetry_logs(logpath_telem, logpath_telem_raw):
         mpstate.status.exit = True
         return
 
+def close_telemetry_logs():
+    '''write out any queued log data and close the log files'''
+    for w in [mpstate.logqueue, mpstate.logqueue_raw]:
+        try:
+            w.close()
+        except Exception as e:
+            print("ERROR: closing %s: %s" % (w.name, e))
+
 
 def set_stream_rates():
     '''set mavlink stream rates'''
@@ -730,9 +924,14 @@ def periodic_tasks():
 
     set_stream_rates()
 
-    # call optional module idle tasks. These are called at several hundred Hz
+    # call optional module idle tasks. These are called at the idlerate
+    perf = mpstate.perf
     for (m,pm) in mpstate.modules:
         if hasattr(m, 'idle_task'):
+            # the idle task may switch perf on or off, so check it once
+            perf_enabled = perf.enabled
+            if perf_enabled:
+                t0 = time.time()
             try:
                 m.idle_task()
             except Exception as msg:
@@ -742,11 +941,129 @@ def periodic_tasks():
                     exc_type, exc_value, exc_traceback = sys.exc_info()
                     traceback.print_exception(exc_type, exc_value, exc_traceback,
                                               limit=2, file=sys.stdout)
+            if perf_enabled:
+                perf.add('idle', m.name, time.time() - t0)
 
         # also see if the module should be unloaded:
         if m.needs_unloading:
             unload_module(m.name)
 
+def event_loop_error(source, e):
+    '''report an exception from an event loop callback'''
+    if mpstate.settings.moddebug == 1:
+        print(e)
+    elif mpstate.settings.moddebug > 1:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        traceback.print_exception(exc_type, exc_value, exc_traceback,
+                                  limit=2, file=sys.stdout)
+
+def process_select_extra(fd):
+    '''call the read function a module registered in select_extra'''
+    try:
+        (fn, args) = mpstate.select_extra[fd]
+        fn(args)
+    except Exception as msg:
+        if mpstate.settings.moddebug == 1:
+            print(msg)
+        # on an exception, remove it from the select list
+        mpstate.select_extra.pop(fd, None)
+
+def event_loop_sync():
+    '''make the event loop watch the current links, outputs and
+    module file descriptors. Modules change these lists directly, so
+    we compare against what is registered rather than rebuilding'''
+    wanted = {}
+    for master in mpstate.mav_master:
+        if master.fd is not None and not master.portdead:
+            wanted[master.fd] = (process_master, master, master.port)
+    for m in mpstate.mav_outputs:
+        wanted[m.fd] = (process_mavlink, m, m.port)
+    for sysid in mpstate.sysid_outputs:
+        m = mpstate.sysid_outputs[sysid]
+        wanted[m.fd] = (process_mavlink, m, m.port)
+    for fd in mpstate.select_extra:
+        wanted[fd] = (process_select_extra, fd, mpstate.select_extra[fd])
+    loop = mpstate.event_loop
+    for fd in loop.fds():
+        if not fd in wanted:
+            loop.remove_fd(fd)
+    for fd in wanted:
+        if loop.handler(fd) != wanted[fd]:
+            (fn, args, token) = wanted[fd]
+            loop.add_fd(fd, fn, args, token=token)
+
+def send_queue_connections():
+    '''return all links and outputs that may have a send queue'''
+    return mpstate.mav_master + mpstate.mav_outputs + list(mpstate.sysid_outputs.values())
+
+def add_send_queue(conn):
+    '''queue writes to a link or output rather than writing them inline'''
+    from pymavlink import mavutil
+    if mpstate.send_priorities is None:
+        mpstate.send_priorities = mp_sendqueue.priority_map(mavutil.mavlink)
+    datagram_types = tuple([ getattr(mavutil, t) for t in ['mavudp', 'mavmcast'] if hasattr(mavutil, t) ])
+    serial = isinstance(conn, mavutil.mavserial)
+    if serial:
+        # keep serial writes small, so the queue rather than the port
+        # buffer decides what is shed when the link is slow
+        max_write = 512
+    else:
+        max_write = 16384
+    q = mp_sendqueue.MPSendQueue(conn, getattr(conn, 'address', str(conn)),
+                                 limit=mpstate.settings.sendqueue,
+                                 priorities=mpstate.send_priorities,
+                                 datagram=isinstance(conn, datagram_types),
+                                 serial=serial,
+                                 max_write=max_write)
+    q.wakeup = mpstate.event_loop.wakeup
+    conn.send_queue = q
+    return q
+
+def send_queue_drain(q):
+    '''event loop callback for a writable link or output'''
+    q.drain()
+
+def send_queue_sync():
+    '''make sure every link and output has a send queue, and watch the
+    ones with data waiting for writability. Returns the number of bytes
+    queued'''
+    limit = mpstate.settings.sendqueue
+    wanted = {}
+    total = 0
+    for conn in send_queue_connections():
+        q = getattr(conn, 'send_queue', None)
+        if limit <= 0:
+            if q is not None:
+                q.unwrap()
+                conn.send_queue = None
+            continue
+        if q is None:
+            q = add_send_queue(conn)
+        q.limit = limit
+        if q.pending() == 0:
+            continue
+        total += q.pending()
+        fd = q.fd()
+        if fd is None or getattr(conn, 'portdead', False):
+            # nothing to wait on, write it now
+            q.drain(limit=None)
+        else:
+            wanted[fd] = q
+    loop = mpstate.event_loop
+    for fd in loop.writer_fds():
+        if not fd in wanted:
+            loop.remove_writer(fd)
+    for fd in wanted:
+        loop.add_writer(fd, send_queue_drain, wanted[fd])
+    return total
+
+def flush_send_queues():
+    '''write out everything still queued, used at exit'''
+    for conn in send_queue_connections():
+        q = getattr(conn, 'send_queue', None)
+        if q is not None:
+            q.drain(limit=None)
+
 def main_loop():
     '''main processing loop'''
     if not mpstate.status.setup_mode and not opts.nowait:
@@ -757,9 +1074,17 @@ def main_loop():
                 master.wait_heartbeat()
         set_stream_rates()
 
+    if opts.startup_profile:
+        startup_report()
+
+    # module idle tasks and the core periodic checks run off a timer
+    idle_timer = mpstate.event_loop.add_timer(1.0/max(mpstate.settings.idlerate, 1), periodic_tasks, name='idle')
+
+    perf = mpstate.perf
     while True:
         if mpstate is None or mpstate.status.exit:
             return
+        t0 = time.time()
         while not mpstate.input_queue.empty():
             line = mpstate.input_queue.get()
             mpstate.input_count += 1
@@ -769,73 +1094,28 @@ def main_loop():
             for c in cmds:
                 process_stdin(c)
 
+        # ports without a file descriptor (eg. serial on windows) have to be polled
+        max_wait = None
         for master in mpstate.mav_master:
             if master.fd is None:
                 if master.port.inWaiting() > 0:
                     process_master(master)
+                if master.port.inWaiting() > 0:
+                    # more is ready (eg. a fast replay), don't wait
+                    max_wait = 0
+                elif max_wait is None:
+                    max_wait = mpstate.settings.select_timeout
 
-        periodic_tasks()
-
-        rin = []
-        for master in mpstate.mav_master:
-            if master.fd is not None and not master.portdead:
-                rin.append(master.fd)
-        for m in mpstate.mav_outputs:
-            rin.append(m.fd)
-        for sysid in mpstate.sysid_outputs:
-            m = mpstate.sysid_outputs[sysid]
-            rin.append(m.fd)
-        if rin == []:
-            time.sleep(0.0001)
-            continue
-
-        for fd in mpstate.select_extra:
-            rin.append(fd)
-        try:
-            (rin, win, xin) = select.select(rin, [], [], mpstate.settings.select_timeout)
-        except select.error:
-            continue
-
-        if mpstate is None:
-            return
+        idle_timer.set_period(1.0/max(mpstate.settings.idlerate, 1))
 
-        for fd in rin:
-            if mpstate is None:
-                  return
-            for master in mpstate.mav_master:
-                  if fd == master.fd:
-                        process_master(master)
-                        if mpstate is None:
-                              return
-                        continue
-            for m in mpstate.mav_outputs:
-                if fd == m.fd:
-                    process_mavlink(m)
-                    if mpstate is None:
-                          return
-                    continue
-
-            for sysid in mpstate.sysid_outputs:
-                m = mpstate.sysid_outputs[sysid]
-                if fd == m.fd:
-                    process_mavlink(m)
-                    if mpstate is None:
-                          return
-                    continue
-
-            # this allow modules to register their own file descriptors
-            # for the main select loop
-            if fd in mpstate.select_extra:
-                try:
-                    # call the registered read function
-                    (fn, args) = mpstate.select_extra[fd]
-                    fn(args)
-                except Exception as msg:
-                    if mpstate.settings.moddebug == 1:
-                        print(msg)
-                    # on an exception, remove it from the select list
-                    mpstate.select_extra.pop(fd)
+        event_loop_sync()
+        send_pending = send_queue_sync()
+        mpstate.event_loop.run_once(max_wait)
 
+        if perf.enabled:
+            perf.add('loop', 'iteration', time.time() - t0)
+            perf.gauge('logqueue', mpstate.logqueue.pending())
+            perf.gauge('sendqueue', send_pending)
 
 
 def input_loop():
@@ -848,6 +1128,7 @@ def input_loop():
             mpstate.status.exit = True
             sys.exit(1)
         mpstate.input_queue.put(line)
+        mpstate.event_loop.wakeup()
 
 
 def run_script(scriptfile):
@@ -953,6 +1234,9 @@ if __name__ == '__main__':
     parser.add_option("--mission", dest="mission", help="mission name", default=None)
     parser.add_option("--daemon", action='store_true', help="run in daemon mode, do not start interactive shell")
     parser.add_option("--profile", action='store_true', help="run the Yappi python profiler")
+    parser.add_option("--speed", default="1", help="replay speed for replay:FILE masters, a factor or 'max'")
+    parser.add_option("--replay-exit", action='store_true', default=False, help="exit when a replay reaches the end of the log")
+    parser.add_option("--startup-profile", action='store_true', default=False, help="show module import and init times at startup")
     parser.add_option("--state-basedir", default=None, help="base directory for logs and aircraft directories")
     parser.add_option("--version", action='store_true', help="version information")
     parser.add_option("--default-modules", default="log,signing,wp,rally,fence,param,relay,tuneopt,arm,mode,calibration,rc,auxopt,misc,cmdlong,battery,terrain,output,adsb", help='default module list')
@@ -985,9 +1269,12 @@ if __name__ == '__main__':
     mpstate.status.exit = False
     mpstate.command_map = command_map
     mpstate.continue_mode = opts.continue_mode
-    # queues for logging
-    mpstate.logqueue = Queue.Queue()
-    mpstate.logqueue_raw = Queue.Queue()
+    mpstate.replay_speed = opts.speed
+    mpstate.replay_exit = opts.replay_exit
+    # queues for logging, sharing one writer thread
+    log_wake = threading.Event()
+    mpstate.logqueue = mp_logwriter.MPLogWriter('telemetry log', wake=log_wake)
+    mpstate.logqueue_raw = mp_logwriter.MPLogWriter('raw telemetry log', wake=log_wake)
 
 
     if opts.speech:
@@ -1169,4 +1456,6 @@ if __name__ == '__main__':
             print("Unloading module %s" % m.name)
             m.unload()
 
+    flush_send_queues()
+    close_telemetry_logs()
     sys.exit(1)
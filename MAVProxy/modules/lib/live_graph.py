@@ -10,6 +10,11 @@
 
 from MAVProxy.modules.lib import mp_util
 
+class GraphHistory():
+    '''past values to start a graph with, one list per field, oldest first'''
+    def __init__(self, data):
+        self.data = data
+
 class LiveGraph():
     '''
     a live graph object using wx and matplotlib
@@ -59,6 +64,11 @@ class LiveGraph():
         if self.child.is_alive():
             self.parent_pipe.send(values)
 
+    def add_history(self, data):
+        '''add past values, one list per field sampled at tickresolution'''
+        if self.child.is_alive():
+            self.parent_pipe.send(GraphHistory(data))
+
     def close(self):
         '''close the graph'''
         self.close_graph.set()
@@ -139,6 +139,15 @@ class GraphFrame(wx.Frame):
         import time
         time.sleep(self.state.tickresolution*0.5)
 
+    def add_history(self, data):
+        '''put past values before the ones received so far'''
+        for i in range(len(self.data)):
+            self.data[i] = list(data[i]) + self.data[i]
+            while len(self.data[i]) > len(self.xdata):
+                self.data[i].pop(0)
+            if len(data[i]) and self.state.values[i] is None:
+                self.state.values[i] = data[i][-1]
+
     def on_redraw_timer(self, event):
         # if paused do not add data, but still redraw the plot
         # (to respond to scale modifications, grid change, etc.)
@@ -149,7 +158,11 @@ class GraphFrame(wx.Frame):
             self.Destroy()
             return
         while state.child_pipe.poll():
-            state.values = state.child_pipe.recv()
+            obj = state.child_pipe.recv()
+            if hasattr(obj, 'data'):
+                self.add_history(obj.data)
+            else:
+                state.values = obj
         if self.paused:
             return
         for i in range(len(self.plot_data)):
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+'''
+duplicate packet removal for redundant links
+
+when a vehicle is connected over more than one link the same packet
+arrives once per link. Packets are identified by (srcSystem,
+srcComponent, seq, msgid) and remembered in a small sliding window per
+source, so only the first copy is processed.
+
+As a side effect we learn how each link compares to the others: how
+far behind the first copy its packets arrive, and what share of the
+unique packets it delivered at all
+'''
+
+import collections
+
+class DedupLinkStats(object):
+    '''per link statistics'''
+    __slots__ = ('seen', 'first', 'dups', 'delay_avg', 'delay_max', 'unique_base')
+
+    def __init__(self, unique_base):
+        self.seen = 0
+        self.first = 0
+        self.dups = 0
+        self.delay_avg = 0.0
+        self.delay_max = 0.0
+        # number of unique packets seen before this link was added
+        self.unique_base = unique_base
+
+    def add_delay(self, delay):
+        self.delay_avg = 0.95 * self.delay_avg + 0.05 * delay
+        if delay > self.delay_max:
+            self.delay_max = delay
+
+
+class MAVDedup(object):
+    '''sliding window duplicate detector'''
+    def __init__(self, window=128, timeout=2.0):
+        # window must stay below 256 so a wrapped sequence number is
+        # never mistaken for a duplicate
+        self.window = window
+        self.timeout = timeout
+        # (srcSystem, srcComponent) -> (dict of (seq,msgid) -> (time, stats), deque of ((seq,msgid), time))
+        self.sources = {}
+        self.unique = 0
+        self.duplicates = 0
+
+    def link_stats(self):
+        '''return a statistics object for a new link'''
+        return DedupLinkStats(self.unique)
+
+    def check(self, stats, srcSystem, srcComponent, seq, msgid, now):
+        '''return True if this is the first copy of a packet'''
+        src = self.sources.get((srcSystem, srcComponent), None)
+        if src is None:
+            src = ({}, collections.deque())
+            self.sources[(srcSystem, srcComponent)] = src
+        (seen, order) = src
+        key = (seq, msgid)
+        stats.seen += 1
+        first = seen.get(key, None)
+        if first is not None and now - first[0] <= self.timeout:
+            stats.dups += 1
+            stats.add_delay(now - first[0])
+            self.duplicates += 1
+            return False
+        seen[key] = (now, stats)
+        order.append((key, now))
+        while len(order) > self.window:
+            (k, t) = order.popleft()
+            if seen.get(k, (None,))[0] == t:
+                del seen[k]
+        stats.first += 1
+        stats.add_delay(0.0)
+        self.unique += 1
+        return True
+
+    def loss(self, stats):
+        '''percentage of unique packets a link did not deliver'''
+        unique = self.unique - stats.unique_base
+        if unique <= 0:
+            return 0.0
+        return max(0.0, 100.0 * (1.0 - stats.seen / float(unique)))
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+'''
+event loop for the MAVProxy main thread
+
+file descriptors are registered with the best poller the platform
+offers (epoll, poll or select), and periodic callbacks are kept in a
+timer queue ordered by due time, so the main thread only wakes when a
+descriptor is readable or a timer is due. Descriptors with data queued
+for sending can also be watched for writability
+'''
+
+import os, select, time, heapq, errno
+
+class MPTimer(object):
+    '''a periodic (or one-shot) callback registered with the event loop'''
+    def __init__(self, loop, period, callback, args=(), oneshot=False, name=None):
+        self.loop = loop
+        self.period = period
+        self.callback = callback
+        self.args = args
+        self.oneshot = oneshot
+        self.name = name
+        self.due = time.time() + period
+        self.cancelled = False
+
+    def cancel(self):
+        '''stop this timer. It is removed from the queue lazily'''
+        self.cancelled = True
+
+    def set_period(self, period):
+        '''change the period of a timer, taking effect from now'''
+        if period == self.period:
+            return
+        self.period = period
+        self.due = time.time() + period
+        self.loop._schedule(self)
+
+    def __repr__(self):
+        return "MPTimer(%s, %.3f)" % (self.name, self.period)
+
+
+class MPEventLoop(object):
+    '''poll based event loop with a timer queue'''
+    def __init__(self, error_handler=None):
+        self.error_handler = error_handler
+        # optional mp_perf.MPPerf for timer and wait statistics
+        self.perf = None
+        self.handlers = {}
+        self.writers = {}
+        self.timers = []
+        self.timer_seq = 0
+
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.poll_type = 'epoll'
+            self.poll_in = select.EPOLLIN
+            self.poll_out = select.EPOLLOUT
+        elif hasattr(select, 'poll'):
+            self.poller = select.poll()
+            self.poll_type = 'poll'
+            self.poll_in = select.POLLIN
+            self.poll_out = select.POLLOUT
+        else:
+            # windows, select() only works on sockets
+            self.poller = None
+            self.poll_type = 'select'
+            self.poll_in = 1
+            self.poll_out = 4
+
+        # self-pipe so other threads can wake us up early
+        self.wake_rfd = None
+        self.wake_wfd = None
+        if self.poller is not None:
+            import fcntl
+            (self.wake_rfd, self.wake_wfd) = os.pipe()
+            # non-blocking, so a wakeup on a full pipe is simply dropped,
+            # the loop is going to wake anyway
+            for fd in (self.wake_rfd, self.wake_wfd):
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self.add_fd(self.wake_rfd, self._wake_read, None)
+
+    def add_fd(self, fd, callback, args, token=None):
+        '''call callback(args) when fd is readable. The token identifies
+        the object behind the fd, so a reopened port that gets the same fd
+        number can be told apart'''
+        if fd in self.handlers:
+            self.remove_fd(fd)
+        self.handlers[fd] = (callback, args, token)
+        self._register(fd)
+
+    def handler(self, fd):
+        '''return the (callback, args, token) registered for fd, or None'''
+        return self.handlers.get(fd, None)
+
+    def remove_fd(self, fd):
+        '''stop watching a file descriptor'''
+        if not fd in self.handlers:
+            return
+        self.handlers.pop(fd)
+        self._register(fd)
+
+    def add_writer(self, fd, callback, args):
+        '''call callback(args) when fd is writable'''
+        if self.writers.get(fd, None) == (callback, args):
+            return
+        self.writers[fd] = (callback, args)
+        self._register(fd)
+
+    def remove_writer(self, fd):
+        '''stop watching a file descriptor for writability'''
+        if self.writers.pop(fd, None) is not None:
+            self._register(fd)
+
+    def writer_fds(self):
+        '''return the set of file descriptors watched for writability'''
+        return set(self.writers.keys())
+
+    def _register(self, fd):
+        '''update the poller with the events wanted for fd'''
+        if self.poller is None:
+            return
+        mask = 0
+        if fd in self.handlers:
+            mask |= self.poll_in
+        if fd in self.writers:
+            mask |= self.poll_out
+        try:
+            self.poller.unregister(fd)
+        except Exception:
+            pass
+        if mask != 0:
+            try:
+                self.poller.register(fd, mask)
+            except (IOError, OSError, ValueError) as e:
+                self._error(fd, e)
+
+    def fds(self):
+        '''return the set of watched file descriptors, not including the wake pipe'''
+        ret = set(self.handlers.keys())
+        ret.discard(self.wake_rfd)
+        return ret
+
+    def add_timer(self, period, callback, args=(), oneshot=False, name=None):
+        '''call callback(*args) every period seconds. Returns a MPTimer'''
+        timer = MPTimer(self, period, callback, args=args, oneshot=oneshot, name=name)
+        self._schedule(timer)
+        return timer
+
+    def _schedule(self, timer):
+        self.timer_seq += 1
+        heapq.heappush(self.timers, (timer.due, self.timer_seq, timer))
+
+    def next_timeout(self, now, max_wait):
+        '''return how long we may sleep before the next timer is due'''
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return max_wait
+        wait = self.timers[0][0] - now
+        if wait < 0:
+            return 0
+        if max_wait is not None and wait > max_wait:
+            return max_wait
+        return wait
+
+    def wakeup(self):
+        '''wake the loop from another thread'''
+        if self.wake_wfd is None:
+            return
+        try:
+            os.write(self.wake_wfd, b'W')
+        except OSError:
+            pass
+
+    def _wake_read(self, args):
+        '''empty the wake pipe'''
+        try:
+            while os.read(self.wake_rfd, 512):
+                pass
+        except OSError:
+            pass
+
+    def _error(self, what, e):
+        if self.error_handler is not None:
+            self.error_handler(what, e)
+
+    def poll(self, timeout):
+        '''wait up to timeout seconds for descriptors to become ready,
+        returning a list of readable fds and a list of writable fds'''
+        if self.poll_type in ['epoll', 'poll']:
+            if self.poll_type == 'epoll':
+                if timeout is None:
+                    timeout = -1
+            elif timeout is not None:
+                timeout = int(timeout*1000)
+            rin = []
+            win = []
+            for (fd, ev) in self.poller.poll(timeout):
+                if ev & self.poll_out:
+                    win.append(fd)
+                if ev & ~self.poll_out:
+                    # errors and hangups are reported to the reader
+                    rin.append(fd)
+            return (rin, win)
+        rfds = list(self.handlers.keys())
+        wfds = list(self.writers.keys())
+        if not rfds and not wfds:
+            if timeout:
+                time.sleep(timeout)
+            return ([], [])
+        (rin, win, xin) = select.select(rfds, wfds, [], timeout)
+        return (rin, win)
+
+    def run_timers(self, now=None):
+        '''run all timers that are due'''
+        if now is None:
+            now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            (due, seq, timer) = heapq.heappop(self.timers)
+            if timer.cancelled:
+                continue
+            if timer.due != due:
+                # stale entry left behind by set_period()
+                continue
+            # the callback may switch perf on or off, so check it once
+            perf_enabled = self.perf is not None and self.perf.enabled
+            if perf_enabled:
+                t0 = time.time()
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                self._error(timer, e)
+            if perf_enabled:
+                self.perf.add('timer', timer.name, time.time() - t0)
+            if timer.oneshot or timer.cancelled:
+                continue
+            timer.due += timer.period
+            if timer.due <= now:
+                # we have fallen more than a period behind, don't try to catch up
+                timer.due = now + max(timer.period, 0.0001)
+            self._schedule(timer)
+
+    def run_once(self, max_wait=None):
+        '''wait for events and dispatch them. Returns the list of fds that were readable'''
+        t0 = time.time()
+        timeout = self.next_timeout(t0, max_wait)
+        try:
+            (ready, writable) = self.poll(timeout)
+            if self.perf is not None and self.perf.enabled:
+                self.perf.add('loop', 'wait', time.time() - t0)
+        except (select.error, IOError, OSError) as e:
+            if getattr(e, 'errno', None) == errno.EINTR or (len(e.args) > 0 and e.args[0] == errno.EINTR):
+                return []
+            raise
+        for fd in writable:
+            if not fd in self.writers:
+                continue
+            (callback, args) = self.writers[fd]
+            try:
+                callback(args)
+            except Exception as e:
+                self._error(fd, e)
+        for fd in ready:
+            if not fd in self.handlers:
+                continue
+            (callback, args, token) = self.handlers[fd]
+            try:
+                callback(args)
+            except Exception as e:
+                self._error(fd, e)
+        self.run_timers()
+        return ready
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+'''
+byte level MAVLink framing
+
+splits a byte stream into MAVLink1/MAVLink2 frames using only the
+header and checksum, so packets can be routed and logged without
+building message objects. Given the crc_extra of each known msgid, a
+frame is only accepted if its msgid is known and its X.25 checksum
+matches; otherwise the marker is taken as noise and the framer resyncs
+one byte on, like the full parser
+'''
+
+PROTOCOL_MARKER_V1 = 0xFE
+PROTOCOL_MARKER_V2 = 0xFD
+HEADER_LEN_V1 = 6
+HEADER_LEN_V2 = 10
+CRC_LEN = 2
+SIGNATURE_LEN = 13
+IFLAG_SIGNED = 0x01
+
+def _crc_table():
+    '''lookup table for the MAVLink X.25 (CRC-16/MCRF4XX) checksum'''
+    table = []
+    for i in range(256):
+        tmp = (i ^ (i << 4)) & 0xFF
+        table.append(((tmp << 8) ^ (tmp << 3) ^ (tmp >> 4)) & 0xFFFF)
+    return table
+
+CRC_TABLE = _crc_table()
+
+def x25crc(buf, start, end, crc_extra):
+    '''X.25 checksum of buf[start:end] followed by the crc_extra byte'''
+    table = CRC_TABLE
+    crc = 0xFFFF
+    for i in range(start, end):
+        crc = (crc >> 8) ^ table[(crc ^ buf[i]) & 0xFF]
+    return (crc >> 8) ^ table[(crc ^ crc_extra) & 0xFF]
+
+class MAVFramer(object):
+    '''incremental MAVLink framer
+
+    parse() returns a list of (msgid, srcSystem, srcComponent, seq, frame)
+    tuples. Runs of bytes that are not MAVLink are returned with a msgid
+    of None so the caller can hand them to the full parser for reporting
+    '''
+    def __init__(self, crc_extras=None):
+        self.buf = bytearray()
+        # msgid -> crc_extra. With None any msgid is accepted and
+        # checksums are not checked
+        self.crc_extras = crc_extras
+        self.frame_count = 0
+        self.junk_count = 0
+        self.crc_errors = 0
+
+    def _next_marker(self, ofs):
+        '''find the next possible start of frame at or after ofs'''
+        i1 = self.buf.find(b'\xfe', ofs)
+        i2 = self.buf.find(b'\xfd', ofs)
+        if i1 == -1:
+            return i2
+        if i2 == -1:
+            return i1
+        return min(i1, i2)
+
+    def parse(self, data):
+        '''add data to the buffer and return any complete frames'''
+        buf = self.buf
+        buf.extend(data)
+        n = len(buf)
+        ret = []
+        ofs = 0
+        junk_start = None
+        while ofs < n:
+            marker = buf[ofs]
+            if marker == PROTOCOL_MARKER_V1:
+                if n - ofs < HEADER_LEN_V1:
+                    break
+                total = HEADER_LEN_V1 + buf[ofs+1] + CRC_LEN
+                if n - ofs < total:
+                    break
+                seq = buf[ofs+2]
+                srcSystem = buf[ofs+3]
+                srcComponent = buf[ofs+4]
+                msgid = buf[ofs+5]
+                crc_end = ofs + total - CRC_LEN
+            elif marker == PROTOCOL_MARKER_V2:
+                if n - ofs < HEADER_LEN_V2:
+                    break
+                total = HEADER_LEN_V2 + buf[ofs+1] + CRC_LEN
+                crc_end = ofs + total - CRC_LEN
+                if buf[ofs+2] & IFLAG_SIGNED:
+                    total += SIGNATURE_LEN
+                if n - ofs < total:
+                    break
+                seq = buf[ofs+4]
+                srcSystem = buf[ofs+5]
+                srcComponent = buf[ofs+6]
+                msgid = buf[ofs+7] | (buf[ofs+8]<<8) | (buf[ofs+9]<<16)
+            else:
+                msgid = None
+
+            if msgid is not None and self.crc_extras is not None:
+                crc_extra = self.crc_extras.get(msgid, None)
+                if crc_extra is None:
+                    msgid = None
+                elif x25crc(buf, ofs+1, crc_end, crc_extra) != buf[crc_end] | (buf[crc_end+1]<<8):
+                    self.crc_errors += 1
+                    msgid = None
+
+            if msgid is None:
+                # not the start of a frame, skip to the next marker
+                if junk_start is None:
+                    junk_start = ofs
+                nxt = self._next_marker(ofs+1)
+                if nxt == -1:
+                    ofs = n
+                else:
+                    ofs = nxt
+                continue
+
+            if junk_start is not None:
+                ret.append((None, 0, 0, 0, bytes(buf[junk_start:ofs])))
+                self.junk_count += ofs - junk_start
+                junk_start = None
+            ret.append((msgid, srcSystem, srcComponent, seq, bytes(buf[ofs:ofs+total])))
+            self.frame_count += 1
+            ofs += total
+
+        if junk_start is not None:
+            ret.append((None, 0, 0, 0, bytes(buf[junk_start:ofs])))
+            self.junk_count += ofs - junk_start
+        del buf[:ofs]
+        return ret
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+'''
+telemetry history
+
+keeps selected numeric fields of selected message types in fixed size
+ring buffers, one ring per (sysid, message type), with one column per
+field stored in a compact array of doubles. Appending is O(1) and
+window queries like "the last 30 seconds of ATTITUDE.roll" are a
+binary search on the time column followed by slicing, optionally as
+numpy arrays.
+
+Types are tracked on behalf of an owner, and stay tracked (and decoded
+on the fast path) until every owner has untracked them. Graphs track
+the fields they plot, so a new graph starts with the recent past.
+
+    history track ATTITUDE roll,pitch,yaw
+    history show ATTITUDE.roll 30
+'''
+
+import array, time
+
+from MAVProxy.modules.lib import mp_util
+
+np = mp_util.lazy_import('numpy')
+
+class HistoryRing(object):
+    '''ring buffer of samples for one message type from one system'''
+    def __init__(self, fields, size):
+        self.fields = list(fields)
+        self.size = size
+        self.times = array.array('d', [0.0]) * size
+        self.columns = [ array.array('d', [0.0]) * size for f in self.fields ]
+        self.column_map = dict(zip(self.fields, self.columns))
+        # total number of samples ever appended
+        self.count = 0
+
+    def append(self, t, values):
+        '''add a sample, values are in the same order as fields'''
+        i = self.count % self.size
+        self.times[i] = t
+        for (col, v) in zip(self.columns, values):
+            col[i] = v
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def last_time(self):
+        if self.count == 0:
+            return 0
+        return self.times[(self.count-1) % self.size]
+
+    def _physical(self, j):
+        '''map a logical index (0 is the oldest sample held) to a ring index'''
+        return (self.count - len(self) + j) % self.size
+
+    def _first_after(self, start_time):
+        '''logical index of the first sample at or after start_time'''
+        n = len(self)
+        lo = 0
+        hi = n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.times[self._physical(mid)] < start_time:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _slice(self, col, lo, n):
+        '''return n samples of a column starting at logical index lo, oldest first'''
+        if n <= 0:
+            return col[0:0]
+        start = self._physical(lo)
+        end = start + n
+        if end <= self.size:
+            return col[start:end]
+        return col[start:] + col[0:end-self.size]
+
+    def window(self, field, start_time):
+        '''return (times, values) arrays for samples at or after start_time'''
+        lo = self._first_after(start_time)
+        n = len(self) - lo
+        return (self._slice(self.times, lo, n), self._slice(self.column_map[field], lo, n))
+
+    def latest(self, field):
+        '''return the most recent value of a field, or None'''
+        if self.count == 0:
+            return None
+        return self.column_map[field][(self.count-1) % self.size]
+
+    def reshape(self, fields, size):
+        '''change to a superset of the current fields and a size no
+        smaller than the current one, keeping the samples held. Added
+        fields read as NaN for samples taken before they were added'''
+        n = len(self)
+        pad = size - n
+        times = self._slice(self.times, 0, n) + array.array('d', [0.0]) * pad
+        columns = []
+        for f in fields:
+            if f in self.column_map:
+                col = self._slice(self.column_map[f], 0, n)
+            else:
+                col = array.array('d', [float('nan')]) * n
+            columns.append(col + array.array('d', [0.0]) * pad)
+        self.fields = list(fields)
+        self.size = size
+        self.times = times
+        self.columns = columns
+        self.column_map = dict(zip(self.fields, self.columns))
+        self.count = n
+
+
+class MPHistory(object):
+    '''history store shared by all modules'''
+    def __init__(self, size=3000):
+        self.size = size
+        # message type -> list of fields
+        self.tracked = {}
+        # message type -> ring size
+        self.sizes = {}
+        # message type -> set of owners tracking it
+        self.owners = {}
+        # (sysid, message type) -> HistoryRing
+        self.rings = {}
+        # bumped when the tracked types change
+        self.generation = 0
+
+    def track(self, mtype, fields, size=None, owner=None):
+        '''start keeping history of some fields of a message type on
+        behalf of owner, None being the history command. Adding fields
+        or growing the size keeps the samples already held'''
+        current = self.tracked.get(mtype, [])
+        new = current + [ f for f in fields if not f in current ]
+        if size is None:
+            size = self.size
+        size = max(size, self.sizes.get(mtype, 0))
+        self.owners.setdefault(mtype, set()).add(owner)
+        if new == current and size == self.sizes.get(mtype, None):
+            return
+        self.tracked[mtype] = new
+        self.sizes[mtype] = size
+        for k in self.rings:
+            if k[1] == mtype:
+                self.rings[k].reshape(new, size)
+        if not current:
+            self.generation += 1
+
+    def untrack(self, mtype, owner=None):
+        '''stop keeping history of a message type on behalf of owner.
+        The history is dropped once no owner is left'''
+        owners = self.owners.get(mtype, None)
+        if owners is None:
+            return
+        owners.discard(owner)
+        if owners:
+            return
+        self.owners.pop(mtype, None)
+        self.tracked.pop(mtype, None)
+        self.sizes.pop(mtype, None)
+        for k in list(self.rings.keys()):
+            if k[1] == mtype:
+                del self.rings[k]
+        self.generation += 1
+
+    def types(self):
+        '''return the set of tracked message types'''
+        return frozenset(self.tracked.keys())
+
+    def add(self, m):
+        '''add a message, ignored unless its type is tracked'''
+        mtype = m.get_type()
+        fields = self.tracked.get(mtype, None)
+        if fields is None:
+            return
+        key = (m.get_srcSystem(), mtype)
+        ring = self.rings.get(key, None)
+        if ring is None:
+            ring = HistoryRing(fields, self.sizes.get(mtype, self.size))
+            self.rings[key] = ring
+        values = []
+        for f in fields:
+            try:
+                values.append(float(getattr(m, f)))
+            except Exception:
+                values.append(float('nan'))
+        t = getattr(m, '_timestamp', None)
+        if t is None:
+            t = time.time()
+        ring.append(t, values)
+
+    def ring(self, mtype, sysid=None):
+        '''return the ring for a type. With no sysid the most recently
+        updated system is used'''
+        if sysid is not None:
+            return self.rings.get((sysid, mtype), None)
+        ret = None
+        for (s, t) in self.rings:
+            if t == mtype:
+                r = self.rings[(s, t)]
+                if ret is None or r.last_time() > ret.last_time():
+                    ret = r
+        return ret
+
+    def window(self, mtype, field, seconds, sysid=None, numpy=False):
+        '''return (times, values) for the last seconds of a field. The
+        window ends at the newest sample so it works for log replay too.
+        Returns array.array('d') pairs, or numpy arrays if numpy is True'''
+        ring = self.ring(mtype, sysid)
+        if ring is None or not field in ring.column_map:
+            (times, values) = (array.array('d'), array.array('d'))
+        else:
+            (times, values) = ring.window(field, ring.last_time() - seconds)
+        if numpy:
+            return (np.frombuffer(times, dtype=np.float64), np.frombuffer(values, dtype=np.float64))
+        return (times, values)
+
+    def latest(self, mtype, field, sysid=None):
+        '''return the latest value of a field, or None'''
+        ring = self.ring(mtype, sysid)
+        if ring is None or not field in ring.column_map:
+            return None
+        return ring.latest(field)
+
+    def memory(self):
+        '''return the approximate number of bytes used by the rings'''
+        return sum([ 8 * r.size * (len(r.fields)+1) for r in self.rings.values() ])
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+'''
+batched telemetry log writer
+
+records are appended into a preallocated bytearray ring and written
+out in large chunks by a writer thread. Producers are serialised with
+a lock among themselves, the writer thread never takes it: it only
+reads up to the published head and then advances the tail. A separate
+lock on the writer side lets close() run from another thread
+
+if the ring fills up records spill into a deque until the writer
+catches up, so nothing is dropped, and the spill count shows that the
+disk is not keeping up
+'''
+
+import os, time, threading, collections
+
+class MPLogWriter(object):
+    '''ring buffered log writer for one file'''
+    def __init__(self, name, size=1024*1024, wake=None):
+        self.name = name
+        self.size = size
+        self.ring = bytearray(size)
+        # head is only moved by producers, tail only by the writer
+        self.head = 0
+        self.tail = 0
+        self.spill = collections.deque()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        if wake is None:
+            wake = threading.Event()
+        self.wake = wake
+        self.file = None
+        # wake the writer on every record rather than waiting for the period
+        self.immediate = False
+        # one of 'none', 'periodic' or 'always'
+        self.fsync_policy = 'none'
+        self.fsync_period = 10.0
+        self.last_fsync = time.time()
+
+        # statistics
+        self.records = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.writes = 0
+        self.fsyncs = 0
+        self.spilled = 0
+        self.high_water = 0
+        self.errors = 0
+
+    def set_file(self, f):
+        '''attach the file to write to. Anything queued before is kept'''
+        self.file = f
+
+    def put(self, data):
+        '''queue a record for writing'''
+        n = len(data)
+        with self.lock:
+            self.records += 1
+            self.bytes_in += n
+            if self.spill or n > self.size - (self.head - self.tail):
+                # ring is full, keep order by spilling until the writer catches up
+                self.spill.append(bytes(data))
+                self.spilled += 1
+            else:
+                pos = self.head % self.size
+                first = self.size - pos
+                if n <= first:
+                    self.ring[pos:pos+n] = data
+                else:
+                    self.ring[pos:] = data[:first]
+                    self.ring[0:n-first] = data[first:]
+                # publish only after the copy is complete
+                self.head += n
+            depth = self.head - self.tail
+            if depth > self.high_water:
+                self.high_water = depth
+        if self.immediate:
+            self.wake.set()
+
+    def pending(self):
+        '''return number of bytes waiting to be written, not including spilled records'''
+        return self.head - self.tail
+
+    def flush_pending(self):
+        '''write out everything queued in as few writes as possible,
+        called from the writer thread. Returns number of bytes written'''
+        with self.flush_lock:
+            return self._flush_pending()
+
+    def _flush_pending(self):
+        if self.file is None:
+            return 0
+        total = 0
+        while True:
+            head = self.head
+            n = head - self.tail
+            if n > 0:
+                pos = self.tail % self.size
+                first = min(n, self.size - pos)
+                self.file.write(self.ring[pos:pos+first])
+                self.writes += 1
+                if first < n:
+                    self.file.write(self.ring[0:n-first])
+                    self.writes += 1
+                self.tail = head
+                total += n
+            if not self.spill:
+                break
+            if self.head != self.tail:
+                # ring data queued before the spill started goes first
+                continue
+            while self.spill:
+                data = self.spill.popleft()
+                self.file.write(data)
+                self.writes += 1
+                total += len(data)
+            break
+        if total == 0:
+            return 0
+        self.bytes_out += total
+        self.file.flush()
+        now = time.time()
+        if (self.fsync_policy == 'always' or
+            (self.fsync_policy == 'periodic' and now - self.last_fsync >= self.fsync_period)):
+            self.sync()
+        return total
+
+    def sync(self):
+        '''fsync the log file'''
+        if self.file is None:
+            return
+        try:
+            os.fsync(self.file.fileno())
+            self.fsyncs += 1
+        except Exception:
+            self.errors += 1
+        self.last_fsync = time.time()
+
+    def close(self):
+        '''write out everything and close the file'''
+        with self.flush_lock:
+            if self.file is None:
+                return
+            self._flush_pending()
+            if self.fsync_policy != 'none':
+                self.sync()
+            self.file.close()
+            self.file = None
+
+    def stats(self):
+        '''return a dictionary of writer statistics'''
+        return { 'records' : self.records,
+                 'bytes_in' : self.bytes_in,
+                 'bytes_out' : self.bytes_out,
+                 'writes' : self.writes,
+                 'fsyncs' : self.fsyncs,
+                 'pending' : self.pending(),
+                 'spill' : len(self.spill),
+                 'spilled' : self.spilled,
+                 'high_water' : self.high_water,
+                 'size' : self.size }
+
+    def __str__(self):
+        return "%s: %u records %u bytes %u writes %u fsyncs pending %u/%u (max %u) spilled %u" % (
+            self.name, self.records, self.bytes_out, self.writes, self.fsyncs,
+            self.pending(), self.size, self.high_water, self.spilled)
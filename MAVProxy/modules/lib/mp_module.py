@@ -13,6 +13,9 @@ class MPModule(object):
         self.mpstate = mpstate
         self.name = name
         self.needs_unloading = False
+        self.timers = []
+        # MAVLink message types passed to mavlink_packet(), None for all
+        self.message_types = None
 
         if description is None:
             self.description = name + " handling"
@@ -111,6 +114,26 @@ class MPModule(object):
     def add_completion_function(self, name, callback):
         self.mpstate.completion_functions[name] = callback
 
+    def set_message_types(self, types):
+        '''declare the MAVLink message types this module wants in
+        mavlink_packet(). Pass None to receive every message'''
+        if types is not None:
+            types = frozenset(types)
+        self.message_types = types
+        self.mpstate.module_generation += 1
+
+    def add_timer(self, period, callback, *args):
+        '''call callback(*args) from the main loop every period seconds'''
+        timer = self.mpstate.event_loop.add_timer(period, callback, args=args, name=self.name)
+        self.timers.append(timer)
+        return timer
+
+    def remove_timers(self):
+        '''cancel all timers added by this module'''
+        for timer in self.timers:
+            timer.cancel()
+        self.timers = []
+
     def dist_string(self, val_meters):
         '''return a distance as a string'''
         if self.settings.dist_unit == 'nm':
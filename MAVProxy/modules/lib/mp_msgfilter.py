@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+'''
+per-output message filtering
+
+an output can be limited to a whitelist of message types, have types
+blacklisted, and have a maximum rate per type. Rates are kept per
+source system and component so each vehicle gets its own budget.
+Types may be fnmatch patterns like SCALED_*. Rules are compiled to
+msgid sets so the check in the forwarding path is a few lookups
+'''
+
+import fnmatch
+
+class MsgFilter(object):
+    '''message filter for one output'''
+    def __init__(self):
+        self.allow_types = set()
+        self.deny_types = set()
+        self.rates = {}
+        # compiled forms, by msgid
+        self.allow_ids = None
+        self.deny_ids = frozenset()
+        self.intervals = {}
+        # (msgid, srcSystem, srcComponent) -> time the next message may be sent
+        self.next_send = {}
+        self.passed = 0
+        self.dropped = 0
+
+    def empty(self):
+        '''return True if the filter has no rules'''
+        return not self.allow_types and not self.deny_types and not self.rates
+
+    def _match(self, patterns, ids):
+        ret = set()
+        for p in patterns:
+            for name in fnmatch.filter(ids.keys(), p):
+                ret.add(ids[name])
+        return ret
+
+    def compile(self, ids):
+        '''compile the rules against a map of message names to msgids'''
+        if self.allow_types:
+            self.allow_ids = frozenset(self._match(self.allow_types, ids))
+        else:
+            self.allow_ids = None
+        self.deny_ids = frozenset(self._match(self.deny_types, ids))
+        self.intervals = {}
+        for p in self.rates:
+            for msgid in self._match([p], ids):
+                self.intervals[msgid] = 1.0 / self.rates[p]
+        self.next_send = {}
+
+    def allow(self, msgid, srcSystem, srcComponent, now):
+        '''return True if a message should be sent to the output'''
+        if msgid in self.deny_ids or (self.allow_ids is not None and not msgid in self.allow_ids):
+            self.dropped += 1
+            return False
+        interval = self.intervals.get(msgid, None)
+        if interval is not None:
+            key = (msgid, srcSystem, srcComponent)
+            due = self.next_send.get(key, 0)
+            if now < due:
+                self.dropped += 1
+                return False
+            # keep the average rate when messages arrive with jitter,
+            # but don't allow a burst after a gap
+            due += interval
+            if due <= now:
+                due = now + interval
+            self.next_send[key] = due
+        self.passed += 1
+        return True
+
+    def __str__(self):
+        ret = []
+        if self.allow_types:
+            ret.append("allow %s" % ','.join(sorted(self.allow_types)))
+        if self.deny_types:
+            ret.append("deny %s" % ','.join(sorted(self.deny_types)))
+        for p in sorted(self.rates.keys()):
+            ret.append("%s %.2fHz" % (p, self.rates[p]))
+        ret.append("passed %u dropped %u" % (self.passed, self.dropped))
+        return ' '.join(ret)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+'''
+hot path instrumentation
+
+keeps call counts, cumulative time, maximum and an approximate p99 for
+named handlers, grouped by category ('packet' for module mavlink_packet
+calls, 'idle' for idle tasks, 'type' for per message type handling,
+'timer', 'loop'), plus a set of gauges for sampled values like queue
+depths. Percentiles come from a log scale histogram so adding a sample
+is O(1)
+'''
+
+import math, time, json
+
+# histogram buckets: 10 per decade from 1 microsecond to 100 seconds
+HIST_MIN = 1.0e-6
+HIST_PER_DECADE = 10
+HIST_BUCKETS = 8 * HIST_PER_DECADE
+
+class PerfStat(object):
+    '''timing statistics for one handler'''
+    __slots__ = ('count', 'total', 'max', 'hist')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.hist = [0] * HIST_BUCKETS
+
+    def add(self, dt):
+        '''add a sample in seconds'''
+        self.count += 1
+        self.total += dt
+        if dt > self.max:
+            self.max = dt
+        if dt <= HIST_MIN:
+            idx = 0
+        else:
+            idx = int(math.log10(dt / HIST_MIN) * HIST_PER_DECADE)
+            if idx >= HIST_BUCKETS:
+                idx = HIST_BUCKETS-1
+        self.hist[idx] += 1
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, pct):
+        '''return the upper edge of the bucket holding the given percentile'''
+        if self.count == 0:
+            return 0.0
+        limit = self.count * pct / 100.0
+        seen = 0
+        for i in range(HIST_BUCKETS):
+            seen += self.hist[i]
+            if seen >= limit:
+                return min(HIST_MIN * 10**((i+1)/float(HIST_PER_DECADE)), self.max)
+        return self.max
+
+
+class PerfGauge(object):
+    '''a sampled value'''
+    __slots__ = ('value', 'max', 'count', 'total')
+
+    def __init__(self):
+        self.value = 0
+        self.max = 0
+        self.count = 0
+        self.total = 0
+
+    def set(self, value):
+        self.value = value
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+
+class MPPerf(object):
+    '''collection of handler timings and gauges'''
+    def __init__(self):
+        self.enabled = True
+        self.reset()
+
+    def reset(self):
+        '''clear all statistics'''
+        self.stats = {}
+        self.gauges = {}
+        self.start_time = time.time()
+
+    def add(self, category, name, dt):
+        '''record a call taking dt seconds'''
+        key = (category, name)
+        stat = self.stats.get(key, None)
+        if stat is None:
+            stat = PerfStat()
+            self.stats[key] = stat
+        stat.add(dt)
+
+    def gauge(self, name, value):
+        '''record a sampled value'''
+        g = self.gauges.get(name, None)
+        if g is None:
+            g = PerfGauge()
+            self.gauges[name] = g
+        g.set(value)
+
+    def categories(self):
+        return sorted(set([ c for (c, n) in self.stats.keys() ]))
+
+    def report(self, category=None, count=20):
+        '''return a list of report lines, busiest handlers first'''
+        elapsed = max(time.time() - self.start_time, 0.001)
+        ret = []
+        if category is None:
+            categories = self.categories()
+        else:
+            categories = [category]
+        for c in categories:
+            keys = [ k for k in self.stats.keys() if k[0] == c ]
+            keys.sort(key=lambda k: self.stats[k].total, reverse=True)
+            if not keys:
+                continue
+            ret.append("%s:" % c)
+            ret.append("  %-24s %9s %7s %9s %9s %9s %6s" % ('name', 'count', 'rate', 'mean(us)', 'p99(us)', 'max(us)', 'cpu%'))
+            for k in keys[:count]:
+                s = self.stats[k]
+                ret.append("  %-24s %9u %7.1f %9.1f %9.1f %9.1f %6.2f" % (
+                    k[1], s.count, s.count/elapsed, s.mean()*1.0e6,
+                    s.percentile(99)*1.0e6, s.max*1.0e6, 100.0*s.total/elapsed))
+        if category is None and self.gauges:
+            ret.append("gauges:")
+            for name in sorted(self.gauges.keys()):
+                g = self.gauges[name]
+                ret.append("  %-24s %9.1f max %9.1f" % (name, g.value, g.max))
+        return ret
+
+    def to_dict(self):
+        '''return all statistics as a JSON friendly dictionary'''
+        ret = { 'time' : time.time(),
+                'elapsed' : time.time() - self.start_time,
+                'stats' : [],
+                'gauges' : {} }
+        for (c, n) in sorted(self.stats.keys()):
+            s = self.stats[(c, n)]
+            ret['stats'].append({ 'category' : c,
+                                  'name' : n,
+                                  'count' : s.count,
+                                  'total' : s.total,
+                                  'mean' : s.mean(),
+                                  'p99' : s.percentile(99),
+                                  'max' : s.max })
+        for name in self.gauges:
+            g = self.gauges[name]
+            ret['gauges'][name] = { 'value' : g.value, 'max' : g.max }
+        return ret
+
+    def dump(self, filename):
+        '''append a snapshot to a file, as CSV if the name ends in .csv,
+        otherwise as one JSON object per line'''
+        d = self.to_dict()
+        f = open(filename, mode='a')
+        if filename.lower().endswith('.csv'):
+            if f.tell() == 0:
+                f.write("time,category,name,count,total,mean,p99,max\n")
+            for s in d['stats']:
+                f.write("%.3f,%s,%s,%u,%f,%f,%f,%f\n" % (d['time'], s['category'], s['name'],
+                                                        s['count'], s['total'], s['mean'],
+                                                        s['p99'], s['max']))
+            for name in sorted(d['gauges'].keys()):
+                g = d['gauges'][name]
+                f.write("%.3f,gauge,%s,,%f,,,%f\n" % (d['time'], name, g['value'], g['max']))
+        else:
+            f.write(json.dumps(d) + "\n")
+        f.close()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+'''
+telemetry log replay
+
+a MAVLink connection that plays back a .tlog as if it came from a
+vehicle, so recorded flights can be run through the normal link and
+module code. Frames are released according to their recorded
+timestamps scaled by a speed factor, or as fast as they can be
+processed with a speed of 'max'. Decoded messages carry their
+recorded timestamp. Packets sent by the ground station that made the
+log (those from our own source system) are skipped.
+
+    mavproxy.py --master=replay:flight.tlog --speed=10
+'''
+
+import os, struct, time, collections
+
+from pymavlink import mavutil
+
+class MAVReplay(mavutil.mavfile):
+    '''a mavfile reading from a telemetry log'''
+    def __init__(self, filename, speed=1.0, source_system=255, source_component=0):
+        self.filename = filename
+        self.f = open(filename, mode='rb')
+        mavutil.mavfile.__init__(self, None, 'replay:' + filename,
+                                 source_system=source_system,
+                                 source_component=source_component)
+        # the main loop polls connections without a fd through port.inWaiting()
+        self.port = self
+        self.buf = bytearray()
+        # frames handed out by recv() that have not been posted yet
+        self.frame_times = collections.deque()
+        self.next_frame = None
+        self.log_start = None
+        self.wall_start = None
+        self.speed = None
+        self.set_speed(speed)
+        self.eof = False
+        self.finished = False
+        # called with this connection when the end of the log is reached
+        self.on_finish = None
+
+        # statistics
+        self.frames = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.messages_posted = 0
+        self.writes = 0
+        self.start_time = time.time()
+        self.end_time = None
+        self.first_timestamp = None
+        self.last_timestamp = None
+
+    def set_speed(self, speed):
+        '''set playback speed, a factor or 'max' (None) for no pacing'''
+        if speed in ['max', None] or float(speed) <= 0:
+            self.speed = None
+        else:
+            self.speed = float(speed)
+        # restart pacing from the current position
+        self.log_start = None
+
+    def _read_frame(self):
+        '''read the next (timestamp, frame) from the log, or None at the end'''
+        hdr = self.f.read(8)
+        if len(hdr) < 8:
+            return None
+        (usec,) = struct.unpack('>Q', hdr)
+        marker = self.f.read(2)
+        if len(marker) < 2:
+            return None
+        b = bytearray(marker)
+        if b[0] == 0xFE:
+            rest = 4 + b[1] + 2
+        elif b[0] == 0xFD:
+            flags = self.f.read(1)
+            if len(flags) < 1:
+                return None
+            rest = 7 + b[1] + 2
+            if bytearray(flags)[0] & 0x01:
+                rest += 13
+            marker += flags
+        else:
+            # not a frame, resync one byte on
+            self.f.seek(-9, os.SEEK_CUR)
+            return (usec * 1.0e-6, b'')
+        body = self.f.read(rest)
+        if len(body) < rest:
+            return None
+        return (usec * 1.0e-6, marker + body)
+
+    def _fill(self, limit):
+        '''move frames that are due into the buffer'''
+        now = time.time()
+        while len(self.buf) < limit:
+            if self.next_frame is None:
+                self.next_frame = self._read_frame()
+                if self.next_frame is None:
+                    self.eof = True
+                    return
+            (t, frame) = self.next_frame
+            if self.speed is not None:
+                if self.log_start is None:
+                    self.log_start = t
+                    self.wall_start = now
+                if (t - self.log_start) / self.speed > now - self.wall_start:
+                    return
+            self.next_frame = None
+            if not frame:
+                continue
+            b = bytearray(frame[:6])
+            if (b[0] == 0xFE and b[3] == self.source_system) or (b[0] == 0xFD and b[5] == self.source_system):
+                self.skipped += 1
+                continue
+            if self.first_timestamp is None:
+                self.first_timestamp = t
+            self.last_timestamp = t
+            self.buf.extend(frame)
+            self.frame_times.append((bytes(frame), t))
+            if len(self.frame_times) > 1000:
+                self.frame_times.popleft()
+            self.frames += 1
+            self.bytes += len(frame)
+
+    def _finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.end_time = time.time()
+        if self.on_finish is not None:
+            self.on_finish(self)
+
+    def inWaiting(self):
+        '''number of bytes ready to be read'''
+        if not self.buf and not self.eof:
+            self._fill(1)
+        if not self.buf and self.eof:
+            self._finish()
+        return len(self.buf)
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def recv(self, n=None):
+        '''return up to n bytes of frames that are due'''
+        if n is None:
+            n = 16*1024
+        if len(self.buf) < n:
+            self._fill(n)
+        ret = bytes(self.buf[:n])
+        del self.buf[:n]
+        return ret
+
+    def post_message(self, msg):
+        '''give the message the time it was recorded at'''
+        if not '_posted' in msg.__dict__:
+            buf = bytes(msg.get_msgbuf())
+            for i in range(len(self.frame_times)):
+                if self.frame_times[i][0] == buf:
+                    self._timestamp = self.frame_times[i][1]
+                    # frames before this one were not decoded (eg. the forwarding fast path)
+                    for j in range(i+1):
+                        self.frame_times.popleft()
+                    break
+            self.messages_posted += 1
+        mavutil.mavfile.post_message(self, msg)
+
+    def write(self, buf):
+        '''data sent to a replayed vehicle is discarded'''
+        self.writes += 1
+
+    def reset(self):
+        '''restart from the beginning of the log'''
+        self.f.seek(0)
+        self.buf = bytearray()
+        self.frame_times.clear()
+        self.next_frame = None
+        self.log_start = None
+        self.eof = False
+        self.finished = False
+
+    def close(self):
+        self.f.close()
+
+    def report(self):
+        '''return a throughput summary'''
+        end = self.end_time
+        if end is None:
+            end = time.time()
+        elapsed = max(end - self.start_time, 0.001)
+        span = 0
+        if self.first_timestamp is not None:
+            span = self.last_timestamp - self.first_timestamp
+        return ("replay %s: %u frames %u bytes %u messages in %.2fs, %.0f frames/s %.0f msgs/s, "
+                "%.1fs of flight, %.1fx realtime" % (self.filename, self.frames, self.bytes,
+                                                    self.messages_posted, elapsed,
+                                                    self.frames/elapsed, self.messages_posted/elapsed,
+                                                    span, span/elapsed))
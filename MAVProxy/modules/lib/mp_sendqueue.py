@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+'''
+per-link send queues
+
+writes to a link or output are queued instead of going straight to
+the port, and the queue is drained by the event loop when the port's
+file descriptor is writable. A slow TCP output or a full serial buffer
+then only backs up its own queue instead of stalling packet processing
+for every link.
+
+Each queue is bounded. When it goes over its byte limit the oldest
+queued frames are shed, high rate streaming telemetry first, then
+everything else. Critical messages (heartbeats, commands, mission and
+parameter protocol) are never dropped.
+
+Frames are kept in one deque per priority, tagged with a sequence
+number so they are still written in the order they were queued, and
+shedding only ever pops from the front of a deque. Stream connections
+may take only part of a write; the rest goes back on the front of the
+queue and is written first next time, so a frame is never cut short.
+'''
+
+import os, threading, collections, socket, errno
+
+# never dropped
+PRIO_CRITICAL = 2
+# dropped after streaming types
+PRIO_NORMAL = 1
+# shed first
+PRIO_STREAM = 0
+
+critical_types = frozenset([ 'HEARTBEAT', 'COMMAND_LONG', 'COMMAND_INT', 'COMMAND_ACK',
+                             'SET_MODE', 'MISSION_ITEM', 'MISSION_ITEM_INT', 'MISSION_REQUEST',
+                             'MISSION_REQUEST_INT', 'MISSION_REQUEST_LIST', 'MISSION_COUNT',
+                             'MISSION_ACK', 'MISSION_CLEAR_ALL', 'MISSION_SET_CURRENT',
+                             'PARAM_SET', 'PARAM_REQUEST_READ', 'PARAM_REQUEST_LIST',
+                             'FENCE_POINT', 'FENCE_FETCH_POINT', 'RALLY_POINT', 'RALLY_FETCH_POINT',
+                             'SET_POSITION_TARGET_GLOBAL_INT', 'SET_POSITION_TARGET_LOCAL_NED',
+                             'RC_CHANNELS_OVERRIDE', 'MANUAL_CONTROL', 'SETUP_SIGNING',
+                             'FILE_TRANSFER_PROTOCOL', 'LOG_REQUEST_DATA', 'LOG_REQUEST_LIST' ])
+
+stream_types = frozenset([ 'ATTITUDE', 'ATTITUDE_QUATERNION', 'GLOBAL_POSITION_INT',
+                           'LOCAL_POSITION_NED', 'GPS_RAW_INT', 'GPS2_RAW', 'VFR_HUD',
+                           'RAW_IMU', 'SCALED_IMU', 'SCALED_IMU2', 'SCALED_IMU3',
+                           'SCALED_PRESSURE', 'SCALED_PRESSURE2', 'RC_CHANNELS',
+                           'RC_CHANNELS_RAW', 'RC_CHANNELS_SCALED', 'SERVO_OUTPUT_RAW',
+                           'NAV_CONTROLLER_OUTPUT', 'AHRS', 'AHRS2', 'AHRS3', 'SIMSTATE',
+                           'HWSTATUS', 'MEMINFO', 'POWER_STATUS', 'SYSTEM_TIME', 'WIND',
+                           'VIBRATION', 'EKF_STATUS_REPORT', 'TERRAIN_REPORT', 'RANGEFINDER',
+                           'DISTANCE_SENSOR', 'SENSOR_OFFSETS', 'MOUNT_STATUS', 'BATTERY_STATUS',
+                           'MISSION_CURRENT', 'ESC_TELEMETRY_1_TO_4', 'ESC_TELEMETRY_5_TO_8',
+                           'GIMBAL_REPORT', 'ADSB_VEHICLE', 'HIGH_LATENCY' ])
+
+def frame_msgid(buf):
+    '''return the msgid of a MAVLink frame, or None'''
+    b = bytearray(buf[:10])
+    if len(b) >= 6 and b[0] == 0xFE:
+        return b[5]
+    if len(b) >= 10 and b[0] == 0xFD:
+        return b[7] | (b[8]<<8) | (b[9]<<16)
+    return None
+
+class MPSendQueue(object):
+    '''bounded send queue for one connection
+
+    The connection's write method is replaced with our own so that
+    every sender, including module mav.send() calls, goes through the
+    queue. unwrap() restores the original'''
+    def __init__(self, conn, name, limit=65536, priorities=None, datagram=False, serial=False,
+                 max_write=16384):
+        self.conn = conn
+        self.name = name
+        self.limit = limit
+        # map of msgid to priority, anything missing is PRIO_NORMAL
+        self.priorities = priorities or {}
+        # datagram connections send one frame per write
+        self.datagram = datagram
+        # serial ports are written through their file descriptor, made
+        # non-blocking while the queue is in place
+        self.serial = serial
+        self.nonblock_fd = None
+        self.restore_flags = None
+        self.max_write = max_write
+        # priority -> deque of (seq, buf)
+        self.queues = dict([ (p, collections.deque()) for p in (PRIO_STREAM, PRIO_NORMAL, PRIO_CRITICAL) ])
+        self.seq = 0
+        # seq of a frame that has been partly written, which can't be shed
+        self.partial_seq = None
+        self.queued_bytes = 0
+        self.lock = threading.Lock()
+        self.owner = threading.current_thread()
+        # called when a thread other than the owner queues data
+        self.wakeup = None
+        self.raw_write = conn.write
+        conn.write = self.write
+
+        # statistics
+        self.frames_in = 0
+        self.frames_out = 0
+        self.bytes_out = 0
+        self.writes = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self.high_water = 0
+        self.errors = 0
+
+    def unwrap(self):
+        '''flush and restore the connection's own write method'''
+        self.drain(limit=None)
+        if self.conn.__dict__.get('write', None) == self.write:
+            del self.conn.__dict__['write']
+        if self.restore_flags is not None and self.nonblock_fd == getattr(self.conn, 'fd', None):
+            import fcntl
+            try:
+                fcntl.fcntl(self.nonblock_fd, fcntl.F_SETFL, self.restore_flags)
+            except Exception:
+                pass
+        self.nonblock_fd = None
+        self.restore_flags = None
+
+    def fd(self):
+        '''file descriptor to wait on for writability, or None'''
+        return getattr(self.conn, 'fd', None)
+
+    def pending(self):
+        return self.queued_bytes
+
+    def write(self, buf):
+        '''queue a buffer for sending'''
+        msgid = frame_msgid(buf)
+        prio = self.priorities.get(msgid, PRIO_NORMAL)
+        n = len(buf)
+        with self.lock:
+            was_empty = self.queued_bytes == 0
+            self.seq += 1
+            self.queues[prio].append((self.seq, buf))
+            self.queued_bytes += n
+            self.frames_in += 1
+            if self.queued_bytes > self.limit:
+                self._shed()
+            if self.queued_bytes > self.high_water:
+                self.high_water = self.queued_bytes
+        if was_empty and self.wakeup is not None and threading.current_thread() != self.owner:
+            self.wakeup()
+
+    def _shed(self):
+        '''drop the oldest frames, lowest priority first, until under the limit'''
+        for prio in (PRIO_STREAM, PRIO_NORMAL):
+            q = self.queues[prio]
+            head = None
+            if q and q[0][0] == self.partial_seq:
+                # the rest of a partly written frame has to go out
+                head = q.popleft()
+            while q and self.queued_bytes > self.limit:
+                (seq, buf) = q.popleft()
+                self.queued_bytes -= len(buf)
+                self.dropped += 1
+                self.dropped_bytes += len(buf)
+            if head is not None:
+                q.appendleft(head)
+            if self.queued_bytes <= self.limit:
+                return
+
+    def _pop(self):
+        '''remove and return (seq, buf, prio) of the oldest queued frame,
+        or None if nothing is queued'''
+        best = None
+        for (prio, q) in self.queues.items():
+            if q and (best is None or q[0][0] < self.queues[best][0][0]):
+                best = prio
+        if best is None:
+            return None
+        (seq, buf) = self.queues[best].popleft()
+        return (seq, buf, best)
+
+    def _fd_write(self, fd, data):
+        '''write to a serial port file descriptor without blocking'''
+        if fd != self.nonblock_fd:
+            import fcntl
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            if not flags & os.O_NONBLOCK:
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+                self.restore_flags = flags
+            else:
+                self.restore_flags = None
+            self.nonblock_fd = fd
+        try:
+            return os.write(fd, data)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            raise
+
+    def _write_failed(self, e):
+        '''let the connection react to a failed write the way its own
+        write method would, without writing the data again'''
+        conn = self.conn
+        if isinstance(e, socket.error):
+            if e.errno in (errno.ECONNRESET, errno.EPIPE) and hasattr(conn, 'handle_disconnect'):
+                try:
+                    conn.handle_disconnect()
+                except Exception:
+                    pass
+        elif hasattr(conn, 'portdead'):
+            # a serial port
+            if not conn.portdead:
+                print("Device %s is dead" % getattr(conn, 'device', self.name))
+            conn.portdead = True
+            if getattr(conn, 'autoreconnect', False):
+                conn.reset()
+
+    def _stream_write(self, data):
+        '''write to a stream connection, returning the number of bytes
+        taken. Sockets and serial ports are written directly without
+        blocking, as the connection write methods block or don't all
+        report short writes'''
+        send = getattr(getattr(self.conn, 'port', None), 'send', None)
+        fd = None
+        if send is None and self.serial:
+            fd = getattr(self.conn, 'fd', None)
+        try:
+            if send is not None:
+                return send(data)
+            if fd is not None:
+                return self._fd_write(fd, data)
+            n = self.raw_write(data)
+        except (socket.error, OSError) as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            self._write_failed(e)
+            raise
+        if n is None:
+            return len(data)
+        if n < 0:
+            raise IOError("write failed")
+        return n
+
+    def drain(self, limit=-1):
+        '''write queued data to the port. Stream connections get the
+        frames joined into writes of up to max_write bytes, a limit of
+        None writes as much as the port will take. Returns the number of
+        bytes written'''
+        if limit == -1:
+            limit = self.max_write
+        if self.datagram:
+            with self.lock:
+                chunks = []
+                while True:
+                    f = self._pop()
+                    if f is None:
+                        break
+                    chunks.append(f[1])
+                self.queued_bytes = 0
+                self.frames_out += len(chunks)
+            sent = 0
+            for b in chunks:
+                try:
+                    self.raw_write(b)
+                    self.writes += 1
+                    sent += len(b)
+                except Exception:
+                    self.errors += 1
+            self.bytes_out += sent
+            return sent
+
+        sent = 0
+        while True:
+            with self.lock:
+                if self.queued_bytes == 0:
+                    break
+                frames = []
+                total = 0
+                while True:
+                    f = self._pop()
+                    if f is None:
+                        break
+                    (seq, buf, prio) = f
+                    if total > 0 and limit is not None and total + len(buf) > limit:
+                        self.queues[prio].appendleft((seq, buf))
+                        break
+                    frames.append((seq, buf, prio))
+                    total += len(buf)
+            data = b''.join([ bytes(buf) for (seq, buf, prio) in frames ])
+            failed = False
+            try:
+                n = self._stream_write(data)
+                self.writes += 1
+            except Exception:
+                # the connection is failing, drop what we tried to write
+                self.errors += 1
+                failed = True
+                n = 0
+            with self.lock:
+                if failed:
+                    self.queued_bytes -= len(data)
+                    self.dropped += len(frames)
+                    self.dropped_bytes += len(data)
+                    self.partial_seq = None
+                    break
+                # frames written in full
+                done = 0
+                i = 0
+                while i < len(frames) and done + len(frames[i][1]) <= n:
+                    if frames[i][0] == self.partial_seq:
+                        self.partial_seq = None
+                    done += len(frames[i][1])
+                    i += 1
+                self.frames_out += i
+                # put the rest back on the front of the queue, the first
+                # of them without the part that was written
+                for j in range(len(frames)-1, i-1, -1):
+                    (seq, buf, prio) = frames[j]
+                    if j == i and done < n:
+                        buf = buf[n-done:]
+                        self.partial_seq = seq
+                    self.queues[prio].appendleft((seq, buf))
+                self.queued_bytes -= n
+            self.bytes_out += n
+            sent += n
+            if limit is not None or n < len(data):
+                break
+        return sent
+
+    def stats(self):
+        '''return a dictionary of queue statistics'''
+        return { 'frames_in' : self.frames_in,
+                 'frames_out' : self.frames_out,
+                 'bytes_out' : self.bytes_out,
+                 'writes' : self.writes,
+                 'pending' : self.queued_bytes,
+                 'dropped' : self.dropped,
+                 'dropped_bytes' : self.dropped_bytes,
+                 'high_water' : self.high_water,
+                 'errors' : self.errors,
+                 'limit' : self.limit }
+
+    def __str__(self):
+        return "%s: %u frames in %u out %u bytes %u writes pending %u/%u (max %u) dropped %u errors %u" % (
+            self.name, self.frames_in, self.frames_out, self.bytes_out, self.writes,
+            self.queued_bytes, self.limit, self.high_water, self.dropped, self.errors)
+
+def priority_map(mavlink):
+    '''build a msgid to priority map from a mavlink dialect module'''
+    ret = {}
+    for (names, prio) in ((stream_types, PRIO_STREAM), (critical_types, PRIO_CRITICAL)):
+        for name in names:
+            msgid = getattr(mavlink, 'MAVLINK_MSG_ID_' + name, None)
+            if msgid is not None:
+                ret[msgid] = prio
+    return ret
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+'''
+shared memory telemetry snapshot
+
+high rate scalar state like attitude, position, speeds and battery is
+kept in a block of shared memory that the main process writes and the
+GUI child processes read at their redraw rate, instead of pickling
+each update through a pipe. The block has to exist before a child is
+started so the child inherits it.
+
+Updates are protected by a sequence lock. The sequence number is odd
+while the writer is part way through an update, and a reader copies
+the block again if it sees an odd number or the number changes while
+it copies. There is only one writer, so the writer never waits
+'''
+
+import multiprocessing, time
+
+# (field name, message field, scale) for each message type we keep
+MESSAGE_FIELDS = {
+    'ATTITUDE' : [ ('roll', 'roll', 1.0),
+                   ('pitch', 'pitch', 1.0),
+                   ('yaw', 'yaw', 1.0),
+                   ('rollspeed', 'rollspeed', 1.0),
+                   ('pitchspeed', 'pitchspeed', 1.0),
+                   ('yawspeed', 'yawspeed', 1.0) ],
+    'GLOBAL_POSITION_INT' : [ ('lat', 'lat', 1.0e-7),
+                              ('lon', 'lon', 1.0e-7),
+                              ('alt', 'alt', 1.0e-3),
+                              ('relative_alt', 'relative_alt', 1.0e-3),
+                              ('vx', 'vx', 0.01),
+                              ('vy', 'vy', 0.01),
+                              ('vz', 'vz', 0.01),
+                              ('hdg', 'hdg', 0.01) ],
+    'VFR_HUD' : [ ('airspeed', 'airspeed', 1.0),
+                  ('groundspeed', 'groundspeed', 1.0),
+                  ('heading', 'heading', 1.0),
+                  ('throttle', 'throttle', 1.0),
+                  ('climb', 'climb', 1.0) ],
+    'SYS_STATUS' : [ ('voltage', 'voltage_battery', 1.0e-3),
+                     ('current', 'current_battery', 0.01),
+                     ('battery_remaining', 'battery_remaining', 1.0) ],
+    }
+
+def update_time_field(mtype):
+    '''name of the field holding the time a message type was last written'''
+    return mtype.lower() + '_time'
+
+class SharedState(object):
+    '''a seqlock protected block of named doubles in shared memory'''
+    def __init__(self, message_fields=MESSAGE_FIELDS):
+        self.message_fields = message_fields
+        self.fields = []
+        # field name -> name of the time field of its message type
+        self.time_fields = {}
+        for mtype in sorted(message_fields.keys()):
+            for (name, mfield, scale) in message_fields[mtype]:
+                self.fields.append(name)
+                self.time_fields[name] = update_time_field(mtype)
+            self.fields.append(update_time_field(mtype))
+        self.index = dict([ (f, i) for (i, f) in enumerate(self.fields) ])
+        # per message type, list of (index, message field, scale) and the index of its time field
+        self.layout = {}
+        for mtype in message_fields:
+            self.layout[mtype] = ([ (self.index[name], mfield, scale) for (name, mfield, scale) in message_fields[mtype] ],
+                                  self.index[update_time_field(mtype)])
+        self.seq = multiprocessing.RawValue('L', 0)
+        self.values = multiprocessing.RawArray('d', len(self.fields))
+        # statistics, local to each process
+        self.writes = 0
+        self.reads = 0
+        self.retries = 0
+
+    def message_types(self):
+        '''the message types update() uses'''
+        return frozenset(self.layout.keys())
+
+    def update(self, m):
+        '''write the fields of a message, ignoring types we don't keep'''
+        layout = self.layout.get(m.get_type(), None)
+        if layout is None:
+            return
+        (fields, time_index) = layout
+        t = getattr(m, '_timestamp', None)
+        if t is None:
+            t = time.time()
+        values = self.values
+        self.seq.value += 1
+        for (i, mfield, scale) in fields:
+            values[i] = getattr(m, mfield) * scale
+        values[time_index] = t
+        self.seq.value += 1
+        self.writes += 1
+
+    def set(self, **kwargs):
+        '''write named fields'''
+        values = self.values
+        self.seq.value += 1
+        for name in kwargs:
+            values[self.index[name]] = kwargs[name]
+        self.seq.value += 1
+        self.writes += 1
+
+    def sequence(self):
+        '''the current sequence number. A reader can skip its redraw if this
+        has not changed since its last snapshot'''
+        return self.seq.value
+
+    def snapshot(self, retries=100):
+        '''return (sequence, dict of field values) from a consistent copy of
+        the block, or (None, None) if the writer kept changing it'''
+        for i in range(retries):
+            seq1 = self.seq.value
+            if seq1 & 1:
+                self.retries += 1
+                time.sleep(0)
+                continue
+            values = self.values[:]
+            if self.seq.value == seq1:
+                self.reads += 1
+                return (seq1, dict(zip(self.fields, values)))
+            self.retries += 1
+        return (None, None)
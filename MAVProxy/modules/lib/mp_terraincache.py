@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+'''
+terrain grid block cache
+
+ArduPilot asks for terrain in grid blocks of 7x8 sub-blocks, each of
+4x4 points. A TERRAIN_REQUEST names the south west corner and spacing
+of a grid block and a mask of the sub-blocks wanted. The same grid
+blocks are asked for on every flight in an area, so once the heights
+of a grid block have been worked out from SRTM they are kept in a
+SQLite file and served from there.
+
+grid_block_corner() follows the grid layout of AP_Terrain, so grid
+blocks for an area can be generated before a flight. The corners it
+gives may differ from the ones the vehicle works out in single
+precision by a few 1e-7 degrees, so lookups match a corner within
+CORNER_TOLERANCE of the one asked for.
+'''
+
+import math
+import os
+import struct
+import threading
+
+from MAVProxy.modules.lib import mp_util
+
+np = mp_util.lazy_import('numpy')
+
+# layout of a grid block, from AP_Terrain
+GRID_MAVLINK_SIZE = 4
+GRID_BLOCK_MUL_X = 7
+GRID_BLOCK_MUL_Y = 8
+GRID_BLOCK_SPACING_X = (GRID_BLOCK_MUL_X-1) * GRID_MAVLINK_SIZE
+GRID_BLOCK_SPACING_Y = (GRID_BLOCK_MUL_Y-1) * GRID_MAVLINK_SIZE
+GRID_BLOCKS = GRID_BLOCK_MUL_X * GRID_BLOCK_MUL_Y
+BLOCK_POINTS = GRID_MAVLINK_SIZE * GRID_MAVLINK_SIZE
+
+LOCATION_SCALING_FACTOR = 0.011131884502145034
+LOCATION_SCALING_FACTOR_INV = 89.83204953368922
+
+# largest difference, in 1e-7 degrees, between a corner asked for and
+# a cached corner that is taken to be the same
+CORNER_TOLERANCE = 10
+
+def longitude_scale(lat):
+    '''scale of longitude at a latitude in 1e-7 degrees'''
+    return min(max(math.cos(math.radians(lat * 1.0e-7)), 0.01), 1.0)
+
+def grid_block_corner(lat, lon, grid_spacing):
+    '''return the (lat, lon) in 1e-7 degrees of the south west corner of
+    the grid block holding a position given in degrees, as AP_Terrain
+    calculates it'''
+    lat = int(lat * 1.0e7)
+    lon = int(lon * 1.0e7)
+    # grids start on whole degrees
+    ref_lat = (lat // 10000000) * 10000000
+    ref_lon = (lon // 10000000) * 10000000
+    offset_x = (lat - ref_lat) * LOCATION_SCALING_FACTOR
+    offset_y = (lon - ref_lon) * LOCATION_SCALING_FACTOR * longitude_scale(lat)
+    grid_idx_x = int(offset_x / grid_spacing) // GRID_BLOCK_SPACING_X
+    grid_idx_y = int(offset_y / grid_spacing) // GRID_BLOCK_SPACING_Y
+    dlat = grid_idx_x * GRID_BLOCK_SPACING_X * grid_spacing * LOCATION_SCALING_FACTOR_INV
+    dlon = grid_idx_y * GRID_BLOCK_SPACING_Y * grid_spacing * LOCATION_SCALING_FACTOR_INV / longitude_scale(ref_lat)
+    return (ref_lat + int(dlat), ref_lon + int(dlon))
+
+def grid_block_points(lat, lon, grid_spacing):
+    '''return arrays of the latitudes and longitudes in degrees of all
+    the points of a grid block, in the order of its sub-blocks, for a
+    corner in 1e-7 degrees'''
+    lat = lat * 1.0e-7
+    lon = lon * 1.0e-7
+    bit_spacing = grid_spacing * GRID_MAVLINK_SIZE
+    lats = []
+    lons = []
+    for bit in range(GRID_BLOCKS):
+        (lat1, lon1) = mp_util.gps_offset(lat, lon,
+                                          east=bit_spacing * (bit % GRID_BLOCK_MUL_Y),
+                                          north=bit_spacing * (bit // GRID_BLOCK_MUL_Y))
+        for i in range(BLOCK_POINTS):
+            y = i % GRID_MAVLINK_SIZE
+            x = i // GRID_MAVLINK_SIZE
+            (lat2, lon2) = mp_util.gps_offset(lat1, lon1,
+                                              east=grid_spacing * y,
+                                              north=grid_spacing * x)
+            lats.append(lat2)
+            lons.append(lon2)
+    return (lats, lons)
+
+def compute_grid_block(elevation_model, lat, lon, grid_spacing):
+    '''work out the heights of a grid block. Returns a list of
+    GRID_BLOCKS entries, each a list of BLOCK_POINTS heights, or None
+    where a height is not known'''
+    (lats, lons) = grid_block_points(lat, lon, grid_spacing)
+    alts = elevation_model.GetElevationArray(lats, lons)
+    blocks = []
+    for bit in range(GRID_BLOCKS):
+        block = alts[bit*BLOCK_POINTS:(bit+1)*BLOCK_POINTS]
+        if np.any(np.isnan(block)):
+            blocks.append(None)
+        else:
+            blocks.append([int(a) for a in block])
+    return blocks
+
+
+class TerrainBlockCache(object):
+    '''persistent cache of grid block heights, keyed by
+    (lat, lon, grid_spacing) of the grid block'''
+    def __init__(self, filename):
+        import sqlite3
+        self.filename = filename
+        d = os.path.dirname(filename)
+        if d and not os.path.exists(d):
+            mp_util.mkdir_p(d)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute('CREATE TABLE IF NOT EXISTS blocks (lat INTEGER, lon INTEGER, '
+                        'grid_spacing INTEGER, mask INTEGER, data BLOB, '
+                        'PRIMARY KEY (lat, lon, grid_spacing))')
+        self.db.commit()
+        # grid blocks in memory, key -> list of blocks
+        self.grids = {}
+        # (lat, lon) bucket -> keys, for matching corners within CORNER_TOLERANCE
+        self.buckets = {}
+        for (lat, lon, grid_spacing) in self.db.execute('SELECT lat, lon, grid_spacing FROM blocks'):
+            self._index((lat, lon, grid_spacing))
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return sum([len(keys) for keys in self.buckets.values()])
+
+    def _bucket(self, lat, lon, grid_spacing):
+        return (lat // (4*CORNER_TOLERANCE), lon // (4*CORNER_TOLERANCE), grid_spacing)
+
+    def _index(self, key):
+        bucket = self._bucket(*key)
+        keys = self.buckets.setdefault(bucket, [])
+        if not key in keys:
+            keys.append(key)
+
+    def _find(self, lat, lon, grid_spacing):
+        '''find the stored key matching a corner, or None'''
+        (blat, blon, spacing) = self._bucket(lat, lon, grid_spacing)
+        for dlat in (-1, 0, 1):
+            for dlon in (-1, 0, 1):
+                for key in self.buckets.get((blat+dlat, blon+dlon, spacing), []):
+                    if abs(key[0] - lat) <= CORNER_TOLERANCE and abs(key[1] - lon) <= CORNER_TOLERANCE:
+                        return key
+        return None
+
+    def get(self, lat, lon, grid_spacing):
+        '''return the list of blocks of a grid block, with None for blocks
+        not known, or None if nothing is cached for it'''
+        with self.lock:
+            key = self._find(lat, lon, grid_spacing)
+            if key is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if key in self.grids:
+                return self.grids[key]
+            row = self.db.execute('SELECT mask, data FROM blocks WHERE lat=? AND lon=? AND grid_spacing=?',
+                                  key).fetchone()
+            if row is None:
+                return None
+            (mask, data) = row
+            values = struct.unpack('<%uh' % (GRID_BLOCKS*BLOCK_POINTS), str(data))
+            blocks = []
+            for bit in range(GRID_BLOCKS):
+                if mask & (1<<bit):
+                    blocks.append(list(values[bit*BLOCK_POINTS:(bit+1)*BLOCK_POINTS]))
+                else:
+                    blocks.append(None)
+            self.grids[key] = blocks
+            return blocks
+
+    def put(self, lat, lon, grid_spacing, blocks):
+        '''store the blocks of a grid block'''
+        import sqlite3
+        mask = 0
+        values = []
+        for bit in range(GRID_BLOCKS):
+            if blocks[bit] is None:
+                values.extend([0] * BLOCK_POINTS)
+            else:
+                mask |= 1<<bit
+                values.extend(blocks[bit])
+        data = struct.pack('<%uh' % len(values), *values)
+        key = (lat, lon, grid_spacing)
+        with self.lock:
+            old = self._find(lat, lon, grid_spacing)
+            if old is not None and old != key:
+                self.db.execute('DELETE FROM blocks WHERE lat=? AND lon=? AND grid_spacing=?', old)
+                self.buckets[self._bucket(*old)].remove(old)
+                self.grids.pop(old, None)
+            self.db.execute('INSERT OR REPLACE INTO blocks VALUES (?,?,?,?,?)',
+                            (lat, lon, grid_spacing, mask, sqlite3.Binary(data)))
+            self.db.commit()
+            self._index(key)
+            self.grids[key] = blocks
+
+    def close(self):
+        with self.lock:
+            self.db.close()
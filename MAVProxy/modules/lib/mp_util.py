@@ -293,3 +293,47 @@ def quaternion_to_axis_angle(q):
     if angle > math.pi:
         angle = angle - 2 * math.pi
     return Vector3(angle * b / n, angle * c / n, angle * d / n)
+
+# time taken by each deferred import, for the startup profile
+lazy_import_times = {}
+
+class LazyModule(object):
+    '''stand-in for a module that is only imported when an attribute is
+    first used. Lets modules that only occasionally need heavy
+    libraries like numpy or cv2 load quickly'''
+    def __init__(self, name):
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_module'] = None
+
+    def _lazy_load(self):
+        mod = self.__dict__['_lazy_module']
+        if mod is None:
+            import importlib, time
+            name = self.__dict__['_lazy_name']
+            t0 = time.time()
+            mod = importlib.import_module(name)
+            lazy_import_times[name] = time.time() - t0
+            self.__dict__['_lazy_module'] = mod
+        return mod
+
+    def __getattr__(self, attr):
+        return getattr(self._lazy_load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._lazy_load(), attr, value)
+
+    def __repr__(self):
+        if self.__dict__['_lazy_module'] is None:
+            return "<lazy module '%s' (not loaded)>" % self.__dict__['_lazy_name']
+        return repr(self.__dict__['_lazy_module'])
+
+def lazy_import(name):
+    '''return a module proxy that imports name on first use.
+
+    numpy and cv2 each add a noticeable delay to startup, and many
+    modules only need them for occasional work (drawing a tile,
+    loading terrain). Binding them with lazy_import() at module level
+    keeps the usual "np.foo" spelling while deferring the import cost
+    until the first attribute access. The time taken is recorded in
+    lazy_import_times for the startup profile'''
+    return LazyModule(name)
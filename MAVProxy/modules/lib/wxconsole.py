@@ -5,7 +5,7 @@
 """
 import threading
 import textconsole, sys, time
-from wxconsole_util import Value, Text
+from wxconsole_util import Value, Text, SharedValue
 import platform
 if platform.system() == 'Darwin':
     from billiard import Pipe, Process, Event, forking_enable
@@ -17,11 +17,16 @@ class MessageConsole(textconsole.SimpleConsole):
     a message console for MAVProxy
     '''
     def __init__(self,
-                 title='MAVProxy: console'):
+                 title='MAVProxy: console', shared=None):
         if platform.system() == 'Darwin':
             forking_enable(False)
         textconsole.SimpleConsole.__init__(self)
         self.title  = title
+        # optional mp_sharedstate.SharedState for status values bound to it
+        self.shared = shared
+        # status values last sent, so unchanged values are not sent again
+        self.status_sent = {}
+        self.status_bound = set()
         self.menu_callback = None
         self.parent_pipe_recv,self.child_pipe_send = Pipe(duplex=False)
         self.child_pipe_recv,self.parent_pipe_send = Pipe(duplex=False)
@@ -70,8 +75,25 @@ class MessageConsole(textconsole.SimpleConsole):
 
     def set_status(self, name, text='', row=0, fg='black', bg='white'):
         '''set a status value'''
+        if name in self.status_bound:
+            return
+        v = (text, row, fg, bg)
+        if self.status_sent.get(name, None) == v:
+            return
         if self.is_alive():
             self.parent_pipe_send.send(Value(name, text, row, fg, bg))
+            self.status_sent[name] = v
+
+    def bind_status(self, name, fmt, field, scale=1.0, row=0, fg='black', bg='white'):
+        '''have the console fill a status value from a shared state field
+        at its redraw rate. Later set_status() calls for it are ignored'''
+        if self.shared is None or not field in self.shared.time_fields:
+            return False
+        if self.is_alive():
+            self.parent_pipe_send.send(SharedValue(name, fmt, field, self.shared.time_fields[field],
+                                                   scale, row, fg, bg))
+            self.status_bound.add(name)
+        return True
 
     def set_menu(self, menu, callback):
         if self.is_alive():
@@ -1,7 +1,7 @@
 import time
 import os
 import mp_menu
-from wxconsole_util import Value, Text
+from wxconsole_util import Value, Text, SharedValue
 from wx_loader import wx
 
 class ConsoleFrame(wx.Frame):
@@ -15,6 +15,9 @@ class ConsoleFrame(wx.Frame):
 
         # values for the status bar
         self.values = {}
+        # status values filled from shared state, and the last sequence seen
+        self.shared_values = {}
+        self.shared_seq = None
 
         self.menu = None
         self.menu_callback = None
@@ -71,6 +74,43 @@ class ConsoleFrame(wx.Frame):
     def on_idle(self, event):
         time.sleep(0.05)
 
+    def status_value(self, name, text, row):
+        '''get a status field, creating it if needed'''
+        if not name in self.values:
+            # create a new status field
+            value = wx.StaticText(self.panel, -1, text)
+            # possibly add more status rows
+            for i in range(len(self.status), row+1):
+                self.status.append(wx.BoxSizer(wx.HORIZONTAL))
+                self.vbox.Insert(len(self.status)-1, self.status[i], 0, flag=wx.ALIGN_LEFT | wx.TOP)
+                self.vbox.Layout()
+            self.status[row].Add(value, border=5)
+            self.status[row].AddSpacer(20)
+            self.values[name] = value
+        return self.values[name]
+
+    def update_shared_values(self):
+        '''fill status values bound to shared state'''
+        shared = self.state.shared
+        if shared is None or not self.shared_values or shared.sequence() == self.shared_seq:
+            return
+        (seq, snapshot) = shared.snapshot()
+        if seq is None:
+            return
+        self.shared_seq = seq
+        changed = False
+        for obj in self.shared_values.values():
+            if snapshot[obj.time_field] == 0:
+                # not received yet
+                continue
+            text = obj.fmt % (snapshot[obj.field] * obj.scale)
+            value = self.values[obj.name]
+            if value.GetLabel() != text:
+                value.SetLabel(text)
+                changed = True
+        if changed:
+            self.panel.Layout()
+
     def on_timer(self, event):
         state = self.state
         if state.close_event.wait(0.001):
@@ -81,22 +121,18 @@ class ConsoleFrame(wx.Frame):
             obj = state.child_pipe_recv.recv()
             if isinstance(obj, Value):
                 # request to set a status field
-                if not obj.name in self.values:
-                    # create a new status field
-                    value = wx.StaticText(self.panel, -1, obj.text)
-                    # possibly add more status rows
-                    for i in range(len(self.status), obj.row+1):
-                        self.status.append(wx.BoxSizer(wx.HORIZONTAL))
-                        self.vbox.Insert(len(self.status)-1, self.status[i], 0, flag=wx.ALIGN_LEFT | wx.TOP)
-                        self.vbox.Layout()
-                    self.status[obj.row].Add(value, border=5)
-                    self.status[obj.row].AddSpacer(20)
-                    self.values[obj.name] = value
-                value = self.values[obj.name]
+                value = self.status_value(obj.name, obj.text, obj.row)
                 value.SetForegroundColour(obj.fg)
                 value.SetBackgroundColour(obj.bg)
                 value.SetLabel(obj.text)
                 self.panel.Layout()
+            elif isinstance(obj, SharedValue):
+                # request to fill a status field from shared state
+                value = self.status_value(obj.name, '', obj.row)
+                value.SetForegroundColour(obj.fg)
+                value.SetBackgroundColour(obj.bg)
+                self.shared_values[obj.name] = obj
+                self.shared_seq = None
             elif isinstance(obj, Text):
                 '''request to add text to the console'''
                 self.pending.append(obj)
@@ -118,3 +154,4 @@ class ConsoleFrame(wx.Frame):
                     self.Bind(wx.EVT_MENU, self.on_menu)
                 self.Refresh()
                 self.Update()
+        self.update_shared_values()
@@ -12,4 +12,16 @@ class Value():
         self.text = text
         self.row = row
         self.fg = fg
-        self.bg = bg
\ No newline at end of file
+        self.bg = bg
+
+class SharedValue():
+    '''a value for the status bar formatted from a shared state field'''
+    def __init__(self, name, fmt, field, time_field, scale=1.0, row=0, fg='black', bg='white'):
+        self.name = name
+        self.fmt = fmt
+        self.field = field
+        self.time_field = time_field
+        self.scale = scale
+        self.row = row
+        self.fg = fg
+        self.bg = bg
@@ -10,8 +10,10 @@ class HorizonIndicator():
     '''
     A horizon indicator for MAVProxy.
     '''
-    def __init__(self,title='MAVProxy: Horizon Indicator'):
+    def __init__(self,title='MAVProxy: Horizon Indicator',shared=None):
         self.title  = title
+        # Optional mp_sharedstate.SharedState for attitude, altitude, speed and battery
+        self.shared = shared
         # Create Pipe to send attitude information from module to UI
         self.child_pipe_recv,self.parent_pipe_send = multiprocessing.Pipe(duplex=False)
         self.close_event = multiprocessing.Event()
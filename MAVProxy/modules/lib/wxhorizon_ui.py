@@ -1,5 +1,5 @@
 import time
-from wxhorizon_util import Attitude, VFR_HUD, Global_Position_INT, BatteryInfo, FlightState, WaypointInfo, FPS
+from wxhorizon_util import Attitude, VFR_HUD, Global_Position_INT, BatteryInfo, FlightState, WaypointInfo, FPS, shared_objects
 from wx_loader import wx
 import math, time
 
@@ -27,6 +27,9 @@ class HorizonFrame(wx.Frame):
         self.startTime = time.time()
         self.nextTime = 0.0
         self.fps = 10.0
+        # Last shared state sequence number and message times seen
+        self.sharedSeq = None
+        self.sharedTimes = {}
 
     def initData(self):
         # Initialise Attitude
@@ -581,8 +584,11 @@ class HorizonFrame(wx.Frame):
             self.on_idle(0)
         
         # Get attitude information
+        objLists = []
         while state.child_pipe_recv.poll():           
-            objList = state.child_pipe_recv.recv()
+            objLists.append(state.child_pipe_recv.recv())
+        objLists.append(self.readShared())
+        for objList in objLists:
             for obj in objList:
                 self.calcFontScaling()
                 if isinstance(obj,Attitude):
@@ -674,6 +680,17 @@ class HorizonFrame(wx.Frame):
             else:
                 self.nextTime = time.time()
                 
+    def readShared(self):
+        '''Get attitude, altitude, speed and battery information from shared memory.'''
+        shared = self.state.shared
+        if shared is None or shared.sequence() == self.sharedSeq:
+            return []
+        (seq,snapshot) = shared.snapshot()
+        if seq is None:
+            return []
+        self.sharedSeq = seq
+        return shared_objects(snapshot,self.sharedTimes)
+
     def on_KeyPress(self,event):
         '''To adjust the distance between pitch markers.'''
         if event.GetKeyCode() == wx.WXK_UP:
@@ -49,4 +49,26 @@ class FPS():
         self.fps = fps # if fps is zero, then the frame rate is unrestricted
         
         
-        
\ No newline at end of file
+        
+class SharedFields():
+    '''Message-like view of a shared state snapshot.'''
+    def __init__(self,snapshot):
+        self.__dict__.update(snapshot)
+        self.relative_alt = snapshot['relative_alt']*1000.0
+        self.voltage_battery = snapshot['voltage']*1000.0
+        self.current_battery = snapshot['current']*100.0
+
+def shared_objects(snapshot,lastTimes):
+    '''Build the objects for the message types updated in a shared state
+    snapshot since the times in lastTimes, which is updated.'''
+    ret = []
+    fields = SharedFields(snapshot)
+    for (timeField,make) in [('attitude_time',lambda: Attitude(fields)),
+                             ('vfr_hud_time',lambda: VFR_HUD(fields)),
+                             ('global_position_int_time',lambda: Global_Position_INT(fields,snapshot['global_position_int_time'])),
+                             ('sys_status_time',lambda: BatteryInfo(fields))]:
+        t = snapshot[timeField]
+        if t != 0 and t != lastTimes.get(timeField,None):
+            lastTimes[timeField] = t
+            ret.append(make())
+    return ret
@@ -11,7 +11,6 @@ from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.mavproxy_map import mp_slipmap
 from MAVProxy.modules.lib import mp_settings
 from MAVProxy.modules.lib.mp_menu import *  # popup menus
-from pymavlink import mavutil
 
 
 class ADSBVehicle(object):
@@ -39,6 +38,7 @@ class ADSBModule(mp_module.MPModule):
 
     def __init__(self, mpstate):
         super(ADSBModule, self).__init__(mpstate, "adsb", "ADS-B data support")
+        self.set_message_types(['ADSB_VEHICLE', 'GLOBAL_POSITION_INT'])
         self.threat_vehicles = {}
         self.active_threat_ids = []  # holds all threat ids the vehicle is evading
 
@@ -52,8 +52,8 @@ class ADSBModule(mp_module.MPModule):
                                                      # threat_radius_clear = threat_radius*threat_radius_clear_multiplier
                                                      ("threat_radius_clear_multiplier", int, 2),
                                                      ("show_threat_radius_clear", bool, False)])
-        self.threat_detection_timer = mavutil.periodic_event(2)
-        self.threat_timeout_timer = mavutil.periodic_event(2)
+        self.add_timer(0.5, self.check_threat_timeout)
+        self.add_timer(0.5, self.perform_threat_detection)
 
     def cmd_ADSB(self, args):
         '''adsb command parser'''
@@ -205,16 +205,6 @@ class ADSBModule(mp_module.MPModule):
             # so update the distance between vehicle and threat here
             self.update_threat_distances((m.lat * 1e-7, m.lon * 1e-7, m.alt * 1e-3))
 
-    def idle_task(self):
-        '''called on idle'''
-        if self.threat_timeout_timer.trigger():
-            self.check_threat_timeout()
-
-        if self.threat_detection_timer.trigger():
-            self.perform_threat_detection()
-            # TODO: possibly evade detected threats with ids in
-            # self.active_threat_ids
-
 
 def init(mpstate):
     '''initialise module'''
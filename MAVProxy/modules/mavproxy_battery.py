@@ -2,7 +2,6 @@
 '''battery commands'''
 
 import time, math
-from pymavlink import mavutil
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib.mp_settings import MPSetting
@@ -10,6 +9,7 @@ from MAVProxy.modules.lib.mp_settings import MPSetting
 class BatteryModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(BatteryModule, self).__init__(mpstate, "battery", "battery commands")
+        self.set_message_types(['SYS_STATUS', 'BATTERY2', 'POWER_STATUS'])
         self.add_command('bat', self.cmd_bat, "show battery information")
         self.last_battery_announce = 0
         self.last_battery_announce_time = 0
@@ -33,7 +33,7 @@ class BatteryModule(mp_module.MPModule):
         self.settings.append(
             MPSetting('vccwarn', float, 4.3, 'Vcc voltage warning level'))
         self.settings.append(MPSetting('numcells', int, 0, range=(0,10), increment=1))
-        self.battery_period = mavutil.periodic_event(5)
+        self.add_timer(0.2, self.battery_report)
 
     def cmd_bat(self, args):
         '''show battery levels'''
@@ -127,8 +127,6 @@ class BatteryModule(mp_module.MPModule):
             self.battery2_voltage = m.voltage * 0.001
         if mtype == "POWER_STATUS":
             self.power_status_update(m)
-        if self.battery_period.trigger():
-            self.battery_report()
 
 def init(mpstate):
     '''initialise module'''
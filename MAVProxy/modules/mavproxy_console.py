@@ -18,13 +18,20 @@ from MAVProxy.modules.lib.mp_menu import *
 class ConsoleModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(ConsoleModule, self).__init__(mpstate, "console", "GUI console", public=True)
+        # includes the types read with master.field()
+        self.set_message_types(['GPS_RAW', 'GPS_RAW_INT', 'GPS_STATUS', 'GPS2_RAW', 'VFR_HUD',
+                                'GLOBAL_POSITION_INT', 'TERRAIN_REPORT',
+                                'SYS_STATUS', 'WIND', 'EKF_STATUS_REPORT', 'HWSTATUS',
+                                'POWER_STATUS', 'RADIO', 'RADIO_STATUS', 'HEARTBEAT',
+                                'WAYPOINT_CURRENT', 'MISSION_CURRENT',
+                                'NAV_CONTROLLER_OUTPUT'])
         self.in_air = False
         self.start_time = 0.0
         self.total_time = 0.0
         self.speed = 0
         self.max_link_num = 0
         self.last_sys_status_health = 0
-        mpstate.console = wxconsole.MessageConsole(title='Console')
+        mpstate.console = wxconsole.MessageConsole(title='Console', shared=mpstate.shared_state)
 
         # setup some default status information
         mpstate.console.set_status('Mode', 'UNKNOWN', row=0, fg='blue')
@@ -48,6 +55,10 @@ class ConsoleModule(mp_module.MPModule):
         mpstate.console.set_status('Roll', 'Roll ---', row=2)
         mpstate.console.set_status('Pitch', 'Pitch ---', row=2)
         mpstate.console.set_status('Wind', 'Wind ---/---', row=2)
+        # high rate values are filled by the console from shared memory
+        mpstate.console.bind_status('Thr', 'Thr %u', 'throttle', row=2)
+        mpstate.console.bind_status('Roll', 'Roll %u', 'roll', scale=math.degrees(1), row=2)
+        mpstate.console.bind_status('Pitch', 'Pitch %u', 'pitch', scale=math.degrees(1), row=2)
         mpstate.console.set_status('WP', 'WP --', row=3)
         mpstate.console.set_status('WPDist', 'Distance ---', row=3)
         mpstate.console.set_status('WPBearing', 'Bearing ---', row=3)
@@ -195,7 +206,6 @@ class ConsoleModule(mp_module.MPModule):
             self.console.set_status('Alt', 'Alt %s' % self.height_string(rel_alt))
             self.console.set_status('AirSpeed', 'AirSpeed %s' % self.speed_string(msg.airspeed))
             self.console.set_status('GPSSpeed', 'GPSSpeed %s' % self.speed_string(msg.groundspeed))
-            self.console.set_status('Thr', 'Thr %u' % msg.throttle)
             t = time.localtime(msg._timestamp)
             flying = False
             if self.mpstate.vehicle_type == 'copter':
@@ -212,9 +222,6 @@ class ConsoleModule(mp_module.MPModule):
                 self.in_air = False
                 self.total_time = time.mktime(t) - self.start_time
                 self.console.set_status('FlightTime', 'FlightTime %u:%02u' % (int(self.total_time)/60, int(self.total_time)%60))
-        elif type == 'ATTITUDE':
-            self.console.set_status('Roll', 'Roll %u' % math.degrees(msg.roll))
-            self.console.set_status('Pitch', 'Pitch %u' % math.degrees(msg.pitch))
         elif type in ['SYS_STATUS']:
             sensors = { 'AS'   : mavutil.mavlink.MAV_SYS_STATUS_SENSOR_DIFFERENTIAL_PRESSURE,
                         'MAG'  : mavutil.mavlink.MAV_SYS_STATUS_SENSOR_3D_MAG,
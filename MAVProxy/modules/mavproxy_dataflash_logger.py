@@ -29,6 +29,7 @@ class dataflash_logger(mp_module.MPModule):
     def __init__(self, mpstate):
         """Initialise module.  We start poking the UAV for messages after this is called"""
         super(dataflash_logger, self).__init__(mpstate, "dataflash_logger", "logging of mavlink dataflash messages")
+        self.set_message_types(['REMOTE_LOG_DATA_BLOCK'])
         self.sender = None
         self.stopped = False
         self.time_last_start_packet_sent = 0
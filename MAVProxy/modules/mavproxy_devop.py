@@ -9,6 +9,7 @@ from MAVProxy.modules.lib import mp_module
 class DeviceOpModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(DeviceOpModule, self).__init__(mpstate, "DeviceOp")
+        self.set_message_types(['DEVICE_OP_READ_REPLY', 'DEVICE_OP_WRITE_REPLY'])
         self.add_command('devop', self.cmd_devop, "device operations",
                          ["<read|write> <spi|i2c>"])
         self.request_id = 1
@@ -11,6 +11,7 @@ if mp_util.has_wxpython:
 class FenceModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(FenceModule, self).__init__(mpstate, "fence", "geo-fence management", public = True)
+        self.set_message_types(['FENCE_STATUS', 'SYS_STATUS'])
         self.fenceloader = mavwp.MAVFenceLoader()
         self.last_fence_breach = 0
         self.last_fence_status = 0
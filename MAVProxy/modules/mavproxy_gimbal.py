@@ -18,6 +18,7 @@ if mp_util.has_wxpython:
 class GimbalModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(GimbalModule, self).__init__(mpstate, "gimbal", "gimbal control module")
+        self.set_message_types(['GIMBAL_REPORT'])
         self.add_command('gimbal', self.cmd_gimbal, "gimbal link control",
                          ['<rate|point|roi|roivel|mode|status>'])
         if mp_util.has_wxpython:
@@ -5,7 +5,7 @@
 """
 
 from pymavlink import mavutil
-import re, os, sys
+import re, os, sys, bisect
 
 from MAVProxy.modules.lib import live_graph
 
@@ -68,6 +68,9 @@ def init(mpstate):
     '''initialise module'''
     return GraphModule(mpstate)
 
+# an expression that is a single message field
+re_field = re.compile(r'^([A-Z_][A-Z0-9_]+)\.([A-Za-z_][A-Za-z0-9_]*)$')
+
 class Graph():
     '''a graph instance'''
     def __init__(self, state, fields):
@@ -89,6 +92,55 @@ class Graph():
                                               tickresolution=state.tickresolution,
                                               title=self.fields[0])
 
+        # graphs of plain MTYPE.field start with what the telemetry
+        # history holds, and keep it for the next graph
+        history = state.mpstate.history
+        self.history_fields = []
+        for f in self.fields:
+            m = re_field.match(f)
+            if m is None:
+                self.history_fields.append(None)
+            else:
+                self.history_fields.append(m.groups())
+        past = self.history_values(history, state.timespan, state.tickresolution)
+        if True in [ len(p) > 0 for p in past ]:
+            self.livegraph.add_history(past)
+        tracked = {}
+        for hf in self.history_fields:
+            if hf is not None:
+                tracked.setdefault(hf[0], []).append(hf[1])
+        for (mtype, fields) in tracked.items():
+            history.track(mtype, fields, owner=self)
+        self.history = history
+        self.history_types = list(tracked.keys())
+
+    def history_values(self, history, timespan, tickresolution):
+        '''return one list per field of its values over the last timespan
+        from the telemetry history, sampled every tickresolution seconds
+        and oldest first. Fields with no history get an empty list'''
+        windows = []
+        end = None
+        for hf in self.history_fields:
+            if hf is None:
+                windows.append(None)
+                continue
+            (times, values) = history.window(hf[0], hf[1], timespan)
+            windows.append((times, values))
+            if len(times) and (end is None or times[-1] > end):
+                end = times[-1]
+        ret = []
+        for w in windows:
+            past = []
+            if w is not None and end is not None and len(w[0]):
+                (times, values) = w
+                ticks = int(timespan / tickresolution)
+                for k in range(ticks-1, -1, -1):
+                    i = bisect.bisect_right(times, end - k*tickresolution) - 1
+                    if i >= 0:
+                        past.append(values[i])
+            ret.append(past)
+        return ret
+
     def is_alive(self):
         '''check if this graph is still alive'''
         if self.livegraph:
@@ -100,6 +152,9 @@ class Graph():
         if self.livegraph:
             self.livegraph.close()
         self.livegraph = None
+        for mtype in self.history_types:
+            self.history.untrack(mtype, owner=self)
+        self.history_types = []
 
     def add_mavlink_packet(self, msg):
         '''add data to the graph'''
@@ -6,7 +6,7 @@
 
 from MAVProxy.modules.lib import wxhorizon
 from MAVProxy.modules.lib import mp_module
-from MAVProxy.modules.lib.wxhorizon_util import Attitude, VFR_HUD, Global_Position_INT, BatteryInfo, FlightState, WaypointInfo, FPS
+from MAVProxy.modules.lib.wxhorizon_util import FlightState, WaypointInfo, FPS
 
 import time
 
@@ -14,7 +14,11 @@ class HorizonModule(mp_module.MPModule):
     def __init__(self, mpstate):
         # Define module load/unload reference and window title
         super(HorizonModule, self).__init__(mpstate, "horizon", "Horizon Indicator", public=True)
-        self.mpstate.horizonIndicator = wxhorizon.HorizonIndicator(title='Horizon Indicator')
+        # attitude, altitude, speed and battery are read by the horizon
+        # from the shared state, which the link module writes
+        self.set_message_types(['HEARTBEAT', 'WAYPOINT_CURRENT', 'MISSION_CURRENT',
+                                'NAV_CONTROLLER_OUTPUT'])
+        self.mpstate.horizonIndicator = wxhorizon.HorizonIndicator(title='Horizon Indicator', shared=mpstate.shared_state)
         self.mode = ''
         self.armed = ''
         self.currentWP = 0
@@ -73,18 +77,6 @@ class HorizonModule(mp_module.MPModule):
                 self.mode = master.flightmode
                 # Send Flight State information down pipe
                 self.msgList.append(FlightState(self.mode,self.armed))
-        elif msgType == 'ATTITUDE':
-            # Send attitude information down pipe
-            self.msgList.append(Attitude(msg))
-        elif msgType == 'VFR_HUD':
-            # Send HUD information down pipe
-            self.msgList.append(VFR_HUD(msg))
-        elif msgType == 'GLOBAL_POSITION_INT':
-            # Send altitude information down pipe
-            self.msgList.append(Global_Position_INT(msg,time.time()))
-        elif msgType == 'SYS_STATUS':
-            # Mode and Arm State
-            self.msgList.append(BatteryInfo(msg))
         elif msgType in ['WAYPOINT_CURRENT', 'MISSION_CURRENT']:
             # Waypoints
             self.currentWP = msg.seq
@@ -105,7 +97,7 @@ class HorizonModule(mp_module.MPModule):
         if self.mpstate.horizonIndicator.close_event.wait(0.001):
             self.needs_unloading = True   # tell MAVProxy to unload this module
     
-        if (time.time() - self.lastSend) > self.sendDelay:
+        if self.msgList and (time.time() - self.lastSend) > self.sendDelay:
             self.mpstate.horizonIndicator.parent_pipe_send.send(self.msgList)
             self.msgList = []
             self.lastSend = time.time()
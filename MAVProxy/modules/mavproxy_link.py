@@ -11,6 +11,9 @@ import time, struct, math, sys, fnmatch, traceback
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_framer
+from MAVProxy.modules.lib import mp_dedup
+from MAVProxy.modules.lib import mp_replay
 
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import *
@@ -20,13 +23,20 @@ delayedPackets = frozenset([ 'MISSION_CURRENT', 'SYS_STATUS', 'VFR_HUD',
                   'GPS_RAW_INT', 'SCALED_PRESSURE', 'GLOBAL_POSITION_INT',
                   'NAV_CONTROLLER_OUTPUT' ])
 activityPackets = frozenset([ 'HEARTBEAT', 'GPS_RAW_INT', 'GPS_RAW', 'GLOBAL_POSITION_INT', 'SYS_STATUS' ])
+# message types the forwarding fast path always decodes, as the link
+# module itself and master.field() users depend on them
+coreDecodePackets = frozenset([ 'HEARTBEAT', 'SYS_STATUS', 'STATUSTEXT', 'VFR_HUD',
+                                'GPS_RAW', 'GPS_RAW_INT', 'GLOBAL_POSITION_INT', 'ATTITUDE',
+                                'NAV_CONTROLLER_OUTPUT', 'COMPASSMOT_STATUS', 'COMMAND_ACK',
+                                'MISSION_ACK', 'MISSION_CURRENT', 'PARAM_VALUE' ])
+base_mavlink_packet = getattr(mp_module.MPModule.mavlink_packet, '__func__', mp_module.MPModule.mavlink_packet)
 
 class LinkModule(mp_module.MPModule):
 
     def __init__(self, mpstate):
         super(LinkModule, self).__init__(mpstate, "link", "link control", public=True)
         self.add_command('link', self.cmd_link, "link control",
-                         ["<list|ports>",
+                         ["<list|ports|replay>",
                           'add (SERIALPORT)',
                           'remove (LINKS)'])
         self.no_fwd_types = set()
@@ -34,6 +44,18 @@ class LinkModule(mp_module.MPModule):
         self.add_completion_function('(SERIALPORT)', self.complete_serial_ports)
         self.add_completion_function('(LINKS)', self.complete_links)
         self.last_altitude_announce = 0.0
+        # per message type list of modules to pass packets to
+        self.packet_handlers = {}
+        self.packet_handlers_generation = -1
+        # state for the forwarding fast path
+        self.fastfwd_decode_ids = None
+        self.fastfwd_generation = None
+        self.fastfwd_route_key = None
+        self.fastfwd_route_ids = None
+        self.msgid_by_name = None
+        self.liveness_ids = None
+        # duplicate removal for redundant links
+        self.dedup = mp_dedup.MAVDedup()
 
         self.menu_added_console = False
         if mp_util.has_wxpython:
@@ -87,8 +109,10 @@ class LinkModule(mp_module.MPModule):
                 print("Usage: link remove LINK")
                 return
             self.cmd_link_remove(args[1:])
+        elif args[0] == "replay":
+            self.cmd_link_replay(args[1:])
         else:
-            print("usage: link <list|add|remove>")
+            print("usage: link <list|add|remove|replay>")
 
     def show_link(self):
         '''show link information'''
@@ -110,13 +134,20 @@ class LinkModule(mp_module.MPModule):
             except AttributeError as e:
                 # some mav objects may not have a "signing" attribute
                 pass
-            print("link %u %s (%u packets, %.2fs delay, %u lost, %.1f%% loss%s)" % (master.linknum+1,
-                                                                                    status,
-                                                                                    self.status.counters['MasterIn'][master.linknum],
-                                                                                    linkdelay,
-                                                                                    master.mav_loss,
-                                                                                    master.packet_loss(),
-                                                                                    sign_string))
+            dedup_string = ''
+            stats = getattr(master, 'dedup_stats', None)
+            if len(self.mpstate.mav_master) > 1 and stats is not None and stats.seen > 0:
+                dedup_string = ", first %u dup %u, +%.0fms avg %.0fms max, %.1f%% missed" % (
+                    stats.first, stats.dups, stats.delay_avg*1000, stats.delay_max*1000,
+                    self.dedup.loss(stats))
+            print("link %u %s (%u packets, %.2fs delay, %u lost, %.1f%% loss%s%s)" % (master.linknum+1,
+                                                                                      status,
+                                                                                      self.status.counters['MasterIn'][master.linknum],
+                                                                                      linkdelay,
+                                                                                      master.mav_loss,
+                                                                                      master.packet_loss(),
+                                                                                      dedup_string,
+                                                                                      sign_string))
     def cmd_link_list(self):
         '''list links'''
         print("%u links" % len(self.mpstate.mav_master))
@@ -128,9 +159,14 @@ class LinkModule(mp_module.MPModule):
         '''add new link'''
         try:
             print("Connect %s source_system=%d" % (device, self.settings.source_system))
-            conn = mavutil.mavlink_connection(device, autoreconnect=True,
-                                              source_system=self.settings.source_system,
-                                              baud=self.settings.baudrate)
+            if device.startswith('replay:'):
+                conn = mp_replay.MAVReplay(device[7:], speed=self.mpstate.replay_speed,
+                                           source_system=self.settings.source_system)
+                conn.on_finish = self.replay_finished
+            else:
+                conn = mavutil.mavlink_connection(device, autoreconnect=True,
+                                                  source_system=self.settings.source_system,
+                                                  baud=self.settings.baudrate)
             conn.mav.srcComponent = self.settings.source_component
         except Exception as msg:
             print("Failed to connect to %s : %s" % (device, msg))
@@ -147,6 +183,8 @@ class LinkModule(mp_module.MPModule):
         conn.last_heartbeat = 0
         conn.last_message = 0
         conn.highest_msec = 0
+        conn.dup_msec_time = 0
+        conn.dedup_stats = self.dedup.link_stats()
         self.mpstate.mav_master.append(conn)
         self.status.counters['MasterIn'].append(0)
         try:
@@ -161,6 +199,23 @@ class LinkModule(mp_module.MPModule):
         print("Adding link %s" % device)
         self.link_add(device)
 
+    def cmd_link_replay(self, args):
+        '''show replay progress, optionally changing the speed'''
+        replays = [ m for m in self.mpstate.mav_master if isinstance(m, mp_replay.MAVReplay) ]
+        if not replays:
+            print("No replay links")
+            return
+        for m in replays:
+            if len(args) > 0:
+                m.set_speed(args[0])
+            print(m.report())
+
+    def replay_finished(self, conn):
+        '''called when a replay link reaches the end of its log'''
+        print(conn.report())
+        if self.mpstate.replay_exit:
+            self.mpstate.status.exit = True
+
     def cmd_link_ports(self):
         '''show available ports'''
         ports = mavutil.auto_detect_serial(preferred_list=['*FTDI*',"*Arduino_Mega_2560*", "*3D_Robotics*", "*USB_to_UART*", '*PX4*', '*FMU*'])
@@ -274,13 +329,280 @@ class LinkModule(mp_module.MPModule):
             self.say("height %u" % rounded_alt, priority='notification')
 
 
+    def get_packet_handlers(self, mtype):
+        '''return the modules that want messages of type mtype. The list
+        is cached per type until a module is loaded or unloaded, or changes
+        the message types it is interested in'''
+        if self.packet_handlers_generation != self.mpstate.module_generation:
+            self.packet_handlers = {}
+            self.packet_handlers_generation = self.mpstate.module_generation
+        handlers = self.packet_handlers.get(mtype, None)
+        if handlers is not None:
+            return handlers
+        handlers = []
+        for (mod,pm) in self.mpstate.modules:
+            if not hasattr(mod, 'mavlink_packet'):
+                continue
+            if getattr(mod.mavlink_packet, '__func__', None) is base_mavlink_packet:
+                # module doesn't override the default handler
+                continue
+            types = getattr(mod, 'message_types', None)
+            if types is not None and mtype not in types:
+                continue
+            handlers.append(mod)
+        self.packet_handlers[mtype] = handlers
+        return handlers
+
+    def message_ids(self):
+        '''return a dictionary mapping message type names to msgids'''
+        if self.msgid_by_name is None:
+            self.msgid_by_name = {}
+            for (msgid, cls) in mavutil.mavlink.mavlink_map.items():
+                name = getattr(cls, 'name', None)
+                if name is None:
+                    # MAVLink_foo_bar_message -> FOO_BAR
+                    name = cls.__name__[8:-8].upper()
+                self.msgid_by_name[name] = msgid
+        return self.msgid_by_name
+
+    def ids_for_types(self, types):
+        '''convert a set of message type names to a set of msgids'''
+        ids = self.message_ids()
+        return frozenset([ ids[t] for t in types if t in ids ])
+
+    def get_fastfwd_decode_ids(self):
+        '''return the msgids the fast path needs to decode, or None to decode everything'''
+        generation = (self.mpstate.module_generation, self.status.watch, self.mpstate.history.generation)
+        if self.fastfwd_generation == generation:
+            return self.fastfwd_decode_ids
+        self.fastfwd_generation = generation
+        self.fastfwd_decode_ids = None
+        if self.status.watch is not None:
+            return None
+        types = set(coreDecodePackets)
+        types.update(self.mpstate.history.types())
+        # written to the shared state for the GUI children
+        types.update(self.mpstate.shared_state.message_types())
+        for (mod,pm) in self.mpstate.modules:
+            if not hasattr(mod, 'mavlink_packet'):
+                continue
+            if getattr(mod.mavlink_packet, '__func__', None) is base_mavlink_packet:
+                continue
+            mtypes = getattr(mod, 'message_types', None)
+            if mtypes is None:
+                # a legacy module wants everything
+                return None
+            types.update(mtypes)
+        self.fastfwd_decode_ids = self.ids_for_types(types)
+        return self.fastfwd_decode_ids
+
+    def fastfwd_usable(self, master):
+        '''see if the forwarding fast path can be used for a connection'''
+        if not self.settings.fastfwd or self.status.setup_mode:
+            return False
+        try:
+            if master.mav.signing.secret_key is not None:
+                # signatures need checking by the full parser
+                return False
+        except AttributeError:
+            pass
+        return True
+
+    def fastfwd_count(self, master, srcSystem, srcComponent, seq):
+        '''keep packet loss statistics for frames that are not decoded,
+        matching the accounting in mavutil post_message()'''
+        src_tuple = (srcSystem, srcComponent)
+        if src_tuple == (ord('3'), ord('D')):
+            return
+        last_seq = master.last_seq.get(src_tuple, -1)
+        if last_seq != -1:
+            master.mav_loss += (seq - (last_seq+1)) % 256
+        master.last_seq[src_tuple] = seq
+        master.mav_count += 1
+
+    def dedup_active(self):
+        '''see if duplicate removal is needed'''
+        return self.mpstate.settings.dedup and len(self.mpstate.mav_master) > 1
+
+    def get_liveness_ids(self):
+        '''return (activity msgids, msgids with a boot time) of the
+        duplicates the fast path decodes to keep link state current'''
+        if self.liveness_ids is None:
+            msec_ids = set()
+            for (msgid, cls) in mavutil.mavlink.mavlink_map.items():
+                if 'time_boot_ms' in getattr(cls, 'fieldnames', []):
+                    msec_ids.add(msgid)
+            msec_ids.difference_update(self.ids_for_types(['GLOBAL_POSITION_INT']))
+            self.liveness_ids = (self.ids_for_types(activityPackets), frozenset(msec_ids))
+        return self.liveness_ids
+
+    def duplicate_activity(self, m, master, now):
+        '''update the state of a link for a message that was a duplicate
+        of one already processed from another link. The slower of two
+        healthy links only ever delivers duplicates, but it is still up'''
+        mtype = m.get_type()
+        if getattr(m, 'time_boot_ms', None) is not None:
+            master.dup_msec_time = now
+            self.handle_msec_timestamp(m, master)
+        if m.get_srcComponent() == mavutil.mavlink.MAV_COMP_ID_GIMBAL and mtype == 'HEARTBEAT':
+            return
+        if mtype in activityPackets:
+            if master.linkerror:
+                master.linkerror = False
+                self.say("link %u OK" % (master.linknum+1))
+            master.last_message = now
+        if mtype == 'HEARTBEAT' and m.type != mavutil.mavlink.MAV_TYPE_GCS:
+            master.last_heartbeat = now
+
+    def duplicate_frame(self, master, msgid, frame, now):
+        '''link state for a duplicate frame on the fast path. Only the
+        frames duplicate_activity() needs are decoded, and boot times at
+        most twice a second'''
+        (activity_ids, msec_ids) = self.get_liveness_ids()
+        if not msgid in activity_ids and not (msgid in msec_ids and now - master.dup_msec_time > 0.5):
+            return
+        try:
+            m = master.mav.decode(bytearray(frame))
+        except Exception:
+            return
+        self.duplicate_activity(m, master, now)
+
+    def get_fastfwd_route_ids(self):
+        '''return (no_fwd_ids, no_log_ids, delayed_ids, gpi_id, heartbeat_id)
+        for the fast path, recomputed only when the settings they depend on change'''
+        key = (self.mpstate.settings.mavfwd_rate, frozenset(self.no_fwd_types))
+        if self.fastfwd_route_key == key:
+            return self.fastfwd_route_ids
+        ids = self.message_ids()
+        no_fwd_ids = self.ids_for_types(self.no_fwd_types)
+        if not self.mpstate.settings.mavfwd_rate:
+            no_fwd_ids = no_fwd_ids.union([ids.get('REQUEST_DATA_STREAM', -1)])
+        self.fastfwd_route_ids = (no_fwd_ids,
+                                  self.ids_for_types(dataPackets),
+                                  self.ids_for_types(delayedPackets),
+                                  ids.get('GLOBAL_POSITION_INT', -1),
+                                  ids.get('HEARTBEAT', -1))
+        self.fastfwd_route_key = key
+        return self.fastfwd_route_ids
+
+    def get_framer(self, conn):
+        '''return the byte level framer for a connection'''
+        framer = getattr(conn, 'framer', None)
+        if framer is None:
+            crc_extras = dict([ (msgid, cls.crc_extra) for (msgid, cls) in mavutil.mavlink.mavlink_map.items() ])
+            framer = mp_framer.MAVFramer(crc_extras=crc_extras)
+            conn.framer = framer
+        return framer
+
+    def master_fastfwd(self, master, buf):
+        '''forwarding fast path for data from a master. Frames are
+        logged and written to the outputs as raw bytes, and only message
+        types that a module wants are decoded. Returns the decoded messages'''
+        decode_ids = self.get_fastfwd_decode_ids()
+        (no_fwd_ids, no_log_ids, delayed_ids, gpi_id, heartbeat_id) = self.get_fastfwd_route_ids()
+        sysid_outputs = self.mpstate.sysid_outputs
+        outputs = [ (r, getattr(r, 'msg_filter', None)) for r in self.mpstate.mav_outputs ]
+        logqueue = self.mpstate.logqueue
+        now = time.time()
+        if self.dedup_active():
+            dedup = self.dedup
+        else:
+            dedup = None
+        ret = []
+        for (msgid, srcSystem, srcComponent, seq, frame) in self.get_framer(master).parse(buf):
+            if msgid is None:
+                # not MAVLink, let the full parser report it as BAD_DATA
+                msgs = master.mav.parse_buffer(frame)
+                if msgs:
+                    ret.extend(msgs)
+                continue
+
+            if dedup is not None and not dedup.check(master.dedup_stats, srcSystem, srcComponent, seq, msgid, now):
+                # already seen on another link
+                self.duplicate_frame(master, msgid, frame, now)
+                self.fastfwd_count(master, srcSystem, srcComponent, seq)
+                self.status.counters['MasterIn'][master.linknum] += 1
+                continue
+
+            if srcSystem in sysid_outputs:
+                if msgid == gpi_id and self.module('map') is not None:
+                    # needs decoding for the map, master_callback forwards it
+                    master.fastfwd_active = True
+                    try:
+                        msgs = master.mav.parse_buffer(frame)
+                    finally:
+                        master.fastfwd_active = False
+                    if msgs:
+                        ret.extend(msgs)
+                else:
+                    r = sysid_outputs[srcSystem]
+                    f = getattr(r, 'msg_filter', None)
+                    if f is None or f.allow(msgid, srcSystem, srcComponent, now):
+                        r.write(frame)
+                continue
+
+            if logqueue and not msgid in no_log_ids:
+                usec = self.get_usec()
+                usec = (usec & ~3) | master.linknum
+                logqueue.put(struct.pack('>Q', usec) + frame)
+
+            if (not msgid in no_fwd_ids and
+                not (master.link_delayed and msgid in delayed_ids) and
+                not (msgid == heartbeat_id and srcComponent == mavutil.mavlink.MAV_COMP_ID_GIMBAL)):
+                for (r, f) in outputs:
+                    if f is None or f.allow(msgid, srcSystem, srcComponent, now):
+                        r.write(frame)
+
+            if decode_ids is None or msgid in decode_ids:
+                # master_callback sees fastfwd_active and skips logging and forwarding
+                master.fastfwd_active = True
+                try:
+                    msgs = master.mav.parse_buffer(frame)
+                finally:
+                    master.fastfwd_active = False
+                if msgs:
+                    ret.extend(msgs)
+            else:
+                self.fastfwd_count(master, srcSystem, srcComponent, seq)
+                self.status.counters['MasterIn'][master.linknum] += 1
+        return ret
+
+    def slave_fastfwd(self, slave, buf):
+        '''forwarding fast path for data from an output, returns the number of frames forwarded'''
+        count = 0
+        master = self.mpstate.master()
+        for (msgid, srcSystem, srcComponent, seq, frame) in self.get_framer(slave).parse(buf):
+            if msgid is None:
+                continue
+            master.write(frame)
+            count += 1
+        return count
+
     def master_callback(self, m, master):
         '''process mavlink message m on master, sending any messages to recipients'''
 
+        # the fast path has already removed duplicates, logged and forwarded
+        fastfwd = getattr(master, 'fastfwd_active', False)
+
+        now = time.time()
+        if (not fastfwd and self.dedup_active() and m.get_type() != 'BAD_DATA' and
+            not self.dedup.check(master.dedup_stats, m.get_srcSystem(), m.get_srcComponent(),
+                                 m.get_seq(), m.get_msgId(), now)):
+            # already seen on another link, only count it for the link
+            # statistics and keep the link state current
+            self.duplicate_activity(m, master, now)
+            if getattr(m, '_timestamp', None) is None:
+                master.post_message(m)
+            self.status.counters['MasterIn'][master.linknum] += 1
+            return
+
         # see if it is handled by a specialised sysid connection
         sysid = m.get_srcSystem()
         if sysid in self.mpstate.sysid_outputs:
-            self.mpstate.sysid_outputs[sysid].write(m.get_msgbuf())
+            r = self.mpstate.sysid_outputs[sysid]
+            f = getattr(r, 'msg_filter', None)
+            if f is None or f.allow(m.get_msgId(), sysid, m.get_srcComponent(), time.time()):
+                r.write(m.get_msgbuf())
             if m.get_type() == "GLOBAL_POSITION_INT" and self.module('map') is not None:
                 self.module('map').set_secondary_vehicle_position(m)
             return
@@ -292,7 +614,7 @@ class LinkModule(mp_module.MPModule):
         mtype = m.get_type()
 
         # and log them
-        if mtype not in dataPackets and self.mpstate.logqueue:
+        if mtype not in dataPackets and self.mpstate.logqueue and not fastfwd:
             # put link number in bottom 2 bits, so we can analyse packet
             # delay in saved logs
             usec = self.get_usec()
@@ -304,6 +626,9 @@ class LinkModule(mp_module.MPModule):
         if not m.get_type() in self.status.msg_count:
             self.status.msg_count[m.get_type()] = 0
         self.status.msg_count[m.get_type()] += 1
+        self.mpstate.history.add(m)
+        if sysid == self.settings.target_system or self.settings.target_system == 0:
+            self.mpstate.shared_state.update(m)
 
         if m.get_srcComponent() == mavutil.mavlink.MAV_COMP_ID_GIMBAL and m.get_type() == 'HEARTBEAT':
             # silence gimbal heartbeat packets for now
@@ -339,6 +664,8 @@ class LinkModule(mp_module.MPModule):
 
             self.status.last_heartbeat = time.time()
             master.last_heartbeat = self.status.last_heartbeat
+            if self.status.first_heartbeat_time is None:
+                self.status.first_heartbeat_time = self.status.last_heartbeat
 
             armed = self.master.motors_armed()
             if armed != self.status.armed:
@@ -453,14 +780,22 @@ class LinkModule(mp_module.MPModule):
             # would lead a conflict in stream rate setting between mavproxy and the other
             # GCS
             if self.mpstate.settings.mavfwd_rate or mtype != 'REQUEST_DATA_STREAM':
-                if not mtype in self.no_fwd_types:
+                if not mtype in self.no_fwd_types and not fastfwd:
+                    now = time.time()
                     for r in self.mpstate.mav_outputs:
-                        r.write(m.get_msgbuf())
+                        f = getattr(r, 'msg_filter', None)
+                        if f is None or f.allow(m.get_msgId(), m.get_srcSystem(), m.get_srcComponent(), now):
+                            r.write(m.get_msgbuf())
 
             # pass to modules
-            for (mod,pm) in self.mpstate.modules:
-                if not hasattr(mod, 'mavlink_packet'):
-                    continue
+            # a handler may switch perf on or off, so check it once
+            perf = self.mpstate.perf
+            perf_enabled = perf.enabled
+            if perf_enabled:
+                tstart = time.time()
+            for mod in self.get_packet_handlers(mtype):
+                if perf_enabled:
+                    t0 = time.time()
                 try:
                     mod.mavlink_packet(m)
                 except Exception as msg:
@@ -470,6 +805,10 @@ class LinkModule(mp_module.MPModule):
                         exc_type, exc_value, exc_traceback = sys.exc_info()
                         traceback.print_exception(exc_type, exc_value, exc_traceback,
                                                   limit=2, file=sys.stdout)
+                if perf_enabled:
+                    perf.add('packet', mod.name, time.time() - t0)
+            if perf_enabled:
+                perf.add('type', mtype, time.time() - tstart)
 
 def init(mpstate):
     '''initialise module'''
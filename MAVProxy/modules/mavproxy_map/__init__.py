@@ -55,9 +55,12 @@ class MapModule(mp_module.MPModule):
         service='OviHybrid'
         if 'MAP_SERVICE' in os.environ:
             service = os.environ['MAP_SERVICE']
+        # a cache directory or SQLite file (.mbtiles) to keep tiles in
+        tile_store = os.environ.get('MAP_TILE_STORE', None)
         import platform
         from MAVProxy.modules.mavproxy_map import mp_slipmap
-        mpstate.map = mp_slipmap.MPSlipMap(service=service, elevation=True, title='Map')
+        mpstate.map = mp_slipmap.MPSlipMap(service=service, elevation=True, title='Map', coalesce=True,
+                                           tile_store=tile_store)
         mpstate.map_functions = { 'draw_lines' : self.draw_lines }
 
         mpstate.map.add_callback(functools.partial(self.map_callback))
@@ -386,6 +389,7 @@ class MapModule(mp_module.MPModule):
 
     def idle_task(self):
         now = time.time()
+        self.mpstate.map.flush()
         if self.last_unload_check_time + self.unload_check_interval < now:
             self.last_unload_check_time = now
             if not self.mpstate.map.is_alive():
@@ -5,25 +5,30 @@ It will grab the altitude of a long,lat pair from the SRTM database
 Created by Stephen Dade (stephen_dade@hotmail.com)
 '''
 
+import collections
 import os
 import sys
 import time
-
-import numpy
+import math
 
 from MAVProxy.modules.mavproxy_map import srtm
+from MAVProxy.modules.lib import mp_util
+
+np = mp_util.lazy_import('numpy')
 
 class ElevationModel():
     '''Elevation Model. Only SRTM for now'''
 
-    def __init__(self, database='srtm', offline=0, debug=False):
+    def __init__(self, database='srtm', offline=0, debug=False, max_tiles=16):
         '''Use offline=1 to disable any downloading of tiles, regardless of whether the
-        tile exists'''
+        tile exists. At most max_tiles SRTM tiles are kept open, least recently
+        used first to go'''
         self.database = database
         if self.database == 'srtm':
             self.downloader = srtm.SRTMDownloader(offline=offline, debug=debug)
             self.downloader.loadFileList()
-            self.tileDict = dict()
+            self.tileDict = collections.OrderedDict()
+            self.max_tiles = max_tiles
 
         '''Use the Geoscience Australia database instead - watch for the correct database path'''
         if self.database == 'geoscience':
@@ -36,26 +41,81 @@ class ElevationModel():
         if latitude is None or longitude is None:
             return None
         if self.database == 'srtm':
-            TileID = (numpy.floor(latitude), numpy.floor(longitude))
-            if TileID in self.tileDict:
-                alt = self.tileDict[TileID].getAltitudeFromLatLon(latitude, longitude)
-            else:
-                tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                if tile == 0:
-                    if timeout > 0:
-                        t0 = time.time()
-                        while time.time() < t0+timeout and tile == 0:
-                            tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                            if tile == 0:
-                                time.sleep(0.1)
-                if tile == 0:
-                    return None
-                self.tileDict[TileID] = tile
-                alt = tile.getAltitudeFromLatLon(latitude, longitude)
+            tile = self.GetTile(math.floor(latitude), math.floor(longitude), timeout)
+            if tile is None:
+                return None
+            alt = tile.getAltitudeFromLatLon(latitude, longitude)
         if self.database == 'geoscience':
              alt = self.mappy.getAltitudeAtPoint(latitude, longitude)
         return alt
 
+    def GetTile(self, lat, lon, timeout=0):
+        '''Returns the SRTM tile with its south west corner at a whole lat/lon, or None
+        if it isn't available'''
+        TileID = (lat, lon)
+        tile = self.tileDict.pop(TileID, None)
+        if tile is not None:
+            # most recently used tiles are kept at the end
+            self.tileDict[TileID] = tile
+            return tile
+        tile = self.downloader.getTile(lat, lon)
+        if tile == 0 and timeout > 0:
+            self.downloader.waitTile(lat, lon, timeout)
+            tile = self.downloader.getTile(lat, lon)
+        if tile == 0:
+            return None
+        self.tileDict[TileID] = tile
+        while len(self.tileDict) > self.max_tiles:
+            self.tileDict.popitem(last=False)
+        return tile
+
+    def Prefetch(self, points, margin=0, callback=None):
+        '''Start fetching in the background the SRTM tiles covering a list of
+        (lat, lon) points and the area within margin meters of them. Returns
+        the list of SRTMFutures for tiles being fetched. callback(future) is
+        called from the fetch thread as each completes'''
+        futures = []
+        if self.database != 'srtm':
+            return futures
+        tiles = set()
+        dlat = margin / 111319.5
+        for (lat, lon) in points:
+            dlon = dlat / max(math.cos(math.radians(lat)), 0.01)
+            for tlat in range(int(math.floor(lat-dlat)), int(math.floor(lat+dlat))+1):
+                for tlon in range(int(math.floor(lon-dlon)), int(math.floor(lon+dlon))+1):
+                    tiles.add((tlat, tlon))
+        for (tlat, tlon) in sorted(tiles):
+            future = self.downloader.fetchTile(tlat, tlon)
+            if future is not None:
+                if callback is not None:
+                    future.add_done_callback(callback)
+                futures.append(future)
+        return futures
+
+    def GetElevationArray(self, latitudes, longitudes, timeout=0):
+        '''Returns a numpy array of the altitudes (m ASL) of arrays of lat/long points,
+        with NaN where the altitude is unknown'''
+        lats = np.asarray(latitudes, dtype=float)
+        lons = np.asarray(longitudes, dtype=float)
+        alts = np.empty(lats.shape)
+        alts.fill(np.nan)
+        if self.database == 'srtm':
+            tile_lats = np.floor(lats)
+            tile_lons = np.floor(lons)
+            # look up each tile once, and interpolate all its points together
+            for (tlat, tlon) in set(zip(tile_lats.tolist(), tile_lons.tolist())):
+                tile = self.GetTile(tlat, tlon, timeout)
+                if tile is None:
+                    continue
+                idx = (tile_lats == tlat) & (tile_lons == tlon)
+                alts[idx] = tile.getAltitudeArray(lats[idx], lons[idx])
+        if self.database == 'geoscience':
+            for i in range(len(lats)):
+                alt = self.mappy.getAltitudeAtPoint(lats[i], lons[i])
+                if alt is not None:
+                    alts[i] = alt
+        return alts
+
 
 if __name__ == "__main__":
 
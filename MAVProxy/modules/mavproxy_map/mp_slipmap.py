@@ -10,14 +10,15 @@ import functools
 import math
 import os, sys
 import time
-import cv2
-import numpy as np
 
 from MAVProxy.modules.mavproxy_map import mp_elevation
 from MAVProxy.modules.mavproxy_map import mp_tile
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.mavproxy_map.mp_slipmap_util import *
 
+cv2 = mp_util.lazy_import('cv2')
+np = mp_util.lazy_import('numpy')
+
 
 class MPSlipMap():
     '''
@@ -37,7 +38,10 @@ class MPSlipMap():
                  brightness=1.0,
                  elevation=False,
                  download=True,
-                 show_flightmode_legend=True):
+                 show_flightmode_legend=True,
+                 coalesce=False,
+                 flush_interval=0.05,
+                 tile_store=None):
         import multiprocessing
 
         self.lat = lat
@@ -54,9 +58,21 @@ class MPSlipMap():
         self.oldtext = None
         self.brightness = brightness
         self.legend = show_flightmode_legend
+        self.tile_store = tile_store
 
         self.drag_step = 10
 
+        # with coalesce set, updates are held until flush() and only the
+        # latest position and shape of each object is sent, in one batch
+        self.coalesce = coalesce
+        self.flush_interval = flush_interval
+        self.last_flush = 0
+        self.pending = []
+        # coalescing key -> index in pending
+        self.pending_index = {}
+        self.updates = 0
+        self.batches = 0
+
         self.title = title
         from MAVProxy.modules.lib.multiprocessing_queue import makeIPCQueue
         self.event_queue = makeIPCQueue()
@@ -82,19 +98,24 @@ class MPSlipMap():
                                  service=self.service,
                                  tile_delay=self.tile_delay,
                                  debug=self.debug,
-                                 max_zoom=self.max_zoom)
+                                 max_zoom=self.max_zoom,
+                                 tile_store=self.tile_store)
         state.layers = {}
         state.info = {}
         state.need_redraw = True
+        # (layer, key) of objects changed since the last redraw
+        state.dirty_objects = set()
 
         self.app = wx.App(False)
         self.app.SetExitOnFrameDelete(True)
         self.app.frame = MPSlipMapFrame(state=self)
         self.app.frame.Show()
         self.app.MainLoop()
+        self.mt.close()
 
     def close(self):
         '''close the window'''
+        self.flush(force=True)
         self.close_window.release()
         count=0
         while self.child.is_alive() and count < 30: # 3 seconds to die...
@@ -110,21 +131,72 @@ class MPSlipMap():
         '''check if graph is still going'''
         return self.child.is_alive()
 
+    def _drop_pending(self, ckey):
+        '''drop a pending update by coalescing key'''
+        idx = self.pending_index.pop(ckey, None)
+        if idx is not None:
+            self.pending[idx] = None
+
+    def _queue(self, obj, ckey=None):
+        '''send an object to the map, or hold it until the next flush'''
+        self.updates += 1
+        if not self.coalesce:
+            self.object_queue.put(obj)
+            return
+        if ckey is not None and ckey in self.pending_index:
+            # replace the pending update in place
+            self.pending[self.pending_index[ckey]] = obj
+            return
+        if ckey is not None:
+            self.pending_index[ckey] = len(self.pending)
+        self.pending.append(obj)
+
+    def flush(self, force=False):
+        '''send held updates to the map as one batch. Without force this
+        happens at most once per flush_interval'''
+        if not self.pending:
+            return
+        now = time.time()
+        if not force and now - self.last_flush < self.flush_interval:
+            return
+        self.last_flush = now
+        objects = [ obj for obj in self.pending if obj is not None ]
+        self.pending = []
+        self.pending_index = {}
+        if len(objects) == 1:
+            self.object_queue.put(objects[0])
+        elif objects:
+            self.object_queue.put(SlipBatch(objects))
+        self.batches += 1
+
     def add_object(self, obj):
         '''add or update an object on the map'''
-        self.object_queue.put(obj)
+        if not isinstance(obj, SlipObject):
+            self._queue(obj)
+            return
+        # a new copy of an object replaces any pending copy and position
+        self._drop_pending(('object', obj.key, obj.layer))
+        self._drop_pending(('position', obj.key))
+        # a later hide must come after the new copy
+        self.pending_index.pop(('hide', obj.key), None)
+        self._queue(obj, ('object', obj.key, obj.layer))
 
     def remove_object(self, key):
         '''remove an object on the map by key'''
-        self.object_queue.put(SlipRemoveObject(key))
+        self._drop_pending(('position', key))
+        for ckey in list(self.pending_index.keys()):
+            if ckey[0] == 'object' and ckey[1] == key:
+                self._drop_pending(ckey)
+        self.pending_index.pop(('hide', key), None)
+        self._queue(SlipRemoveObject(key))
 
     def hide_object(self, key, hide=True):
         '''hide an object on the map by key'''
-        self.object_queue.put(SlipHideObject(key, hide))
+        self._queue(SlipHideObject(key, hide), ('hide', key))
 
     def set_position(self, key, latlon, layer=None, rotation=0):
         '''move an object on the map'''
-        self.object_queue.put(SlipPosition(key, latlon, layer, rotation))
+        self._queue(SlipPosition(key, latlon, layer, rotation), ('position', key))
 
     def event_count(self):
         '''return number of events waiting to be processed'''
@@ -2,11 +2,107 @@ from MAVProxy.modules.lib.mp_menu import *
 from ..lib.wx_loader import wx
 import mp_elevation
 import os
+import math
 import functools
 from mp_slipmap_util import *
 import cv2
 import numpy as np
 
+class SlipLayer(dict):
+    '''the objects in one layer, by key, with a grid index of their
+    bounding boxes so drawing and clicks only look at objects near the
+    view. Call moved() when an object changes position or visibility'''
+    def __init__(self, cell_size=0.01, max_cells=64):
+        dict.__init__(self)
+        # cell size in degrees
+        self.cell_size = cell_size
+        # objects covering more cells than this are kept in self.large
+        self.max_cells = max_cells
+        # (i,j) -> set of keys
+        self.cells = {}
+        # key -> list of cells, or None for unbounded or large objects
+        self.object_cells = {}
+        # objects without a bounding box, always drawn
+        self.unbounded = set()
+        self.large = set()
+
+    def _cell_range(self, bounds):
+        (x, y, w, h) = bounds
+        c = self.cell_size
+        return (int(math.floor(x/c)), int(math.floor((x+w)/c)),
+                int(math.floor(y/c)), int(math.floor((y+h)/c)))
+
+    def _index(self, key, obj):
+        bounds = obj.bounds()
+        if bounds is None:
+            self.unbounded.add(key)
+            self.object_cells[key] = None
+            return
+        (i1, i2, j1, j2) = self._cell_range(bounds)
+        if (i2-i1+1)*(j2-j1+1) > self.max_cells:
+            self.large.add(key)
+            self.object_cells[key] = None
+            return
+        cells = []
+        for i in range(i1, i2+1):
+            for j in range(j1, j2+1):
+                if not (i,j) in self.cells:
+                    self.cells[(i,j)] = set()
+                self.cells[(i,j)].add(key)
+                cells.append((i,j))
+        self.object_cells[key] = cells
+
+    def _unindex(self, key):
+        cells = self.object_cells.pop(key, None)
+        if cells is None:
+            self.unbounded.discard(key)
+            self.large.discard(key)
+            return
+        for c in cells:
+            s = self.cells[c]
+            s.discard(key)
+            if not s:
+                del self.cells[c]
+
+    def __setitem__(self, key, obj):
+        if key in self:
+            self._unindex(key)
+        dict.__setitem__(self, key, obj)
+        self._index(key, obj)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._unindex(key)
+
+    def pop(self, key, *args):
+        if key in self:
+            self._unindex(key)
+        return dict.pop(self, key, *args)
+
+    def moved(self, key):
+        '''re-index an object after its bounds changed'''
+        if key in self:
+            self._unindex(key)
+            self._index(key, self[key])
+
+    def query(self, bounds):
+        '''return the keys of objects that may overlap bounds'''
+        (i1, i2, j1, j2) = self._cell_range(bounds)
+        ret = set(self.unbounded)
+        ret.update(self.large)
+        if (i2-i1+1)*(j2-j1+1) > len(self.cells):
+            # zoomed out, quicker to look at the cells in use
+            for (i,j) in self.cells:
+                if i1 <= i <= i2 and j1 <= j <= j2:
+                    ret.update(self.cells[(i,j)])
+        else:
+            for i in range(i1, i2+1):
+                for j in range(j1, j2+1):
+                    s = self.cells.get((i,j), None)
+                    if s is not None:
+                        ret.update(s)
+        return ret
+
 class MPSlipMapFrame(wx.Frame):
     """ The main frame of the viewer
     """
@@ -129,9 +225,9 @@ class MPSlipMapFrame(wx.Frame):
         state = self.state
         if not obj.layer in state.layers:
             # its a new layer
-            state.layers[obj.layer] = {}
+            state.layers[obj.layer] = SlipLayer()
         state.layers[obj.layer][obj.key] = obj
-        state.need_redraw = True
+        state.dirty_objects.add((obj.layer, obj.key))
         if (not self.legend_checkbox_menuitem_added and
             isinstance(obj, SlipFlightModeLegend)):
             self.add_legend_checkbox_menuitem()
@@ -142,8 +238,71 @@ class MPSlipMapFrame(wx.Frame):
         '''remove an object by key from all layers'''
         state = self.state
         for layer in state.layers:
-            state.layers[layer].pop(key, None)
-        state.need_redraw = True
+            if key in state.layers[layer]:
+                state.layers[layer].pop(key)
+                state.dirty_objects.add((layer, key))
+
+    def handle_object(self, obj):
+        '''handle a display object from the parent'''
+        state = self.state
+
+        if isinstance(obj, SlipObject):
+            self.add_object(obj)
+
+        if isinstance(obj, SlipPosition):
+            # move an object
+            object = self.find_object(obj.key, obj.layer)
+            if object is not None:
+                object.update_position(obj)
+                state.layers[object.layer].moved(object.key)
+                if getattr(object, 'follow', False):
+                    self.follow(object)
+                state.dirty_objects.add((object.layer, object.key))
+
+        if isinstance(obj, SlipDefaultPopup):
+            state.default_popup = obj
+
+        if isinstance(obj, SlipInformation):
+            # see if its a existing one or a new one
+            if obj.key in state.info:
+#                    print('update %s' % str(obj.key))
+                state.info[obj.key].update(obj)
+            else:
+#                    print('add %s' % str(obj.key))
+                state.info[obj.key] = obj
+            state.need_redraw = True
+
+        if isinstance(obj, SlipCenter):
+            # move center
+            (lat,lon) = obj.latlon
+            state.panel.re_center(state.width/2, state.height/2, lat, lon)
+            state.need_redraw = True
+
+        if isinstance(obj, SlipBrightness):
+            # set map brightness
+            state.brightness = obj.brightness
+            state.need_redraw = True
+
+        if isinstance(obj, SlipClearLayer):
+            # remove all objects from a layer
+            if obj.layer in state.layers:
+                state.layers.pop(obj.layer)
+            state.need_redraw = True
+
+        if isinstance(obj, SlipRemoveObject):
+            # remove an object by key
+            for layer in state.layers:
+                if obj.key in state.layers[layer]:
+                    state.layers[layer].pop(obj.key)
+                    state.dirty_objects.add((layer, obj.key))
+
+        if isinstance(obj, SlipHideObject):
+            # hide an object by key
+            for layer in state.layers:
+                if obj.key in state.layers[layer]:
+                    state.layers[layer][obj.key].set_hidden(obj.hide)
+                    state.layers[layer].moved(obj.key)
+                    state.dirty_objects.add((layer, obj.key))
 
     def on_idle(self, event):
         '''prevent the main loop spinning too fast'''
@@ -158,61 +317,11 @@ class MPSlipMapFrame(wx.Frame):
         while not state.object_queue.empty():
             obj = state.object_queue.get()
 
-            if isinstance(obj, SlipObject):
-                self.add_object(obj)
-
-            if isinstance(obj, SlipPosition):
-                # move an object
-                object = self.find_object(obj.key, obj.layer)
-                if object is not None:
-                    object.update_position(obj)
-                    if getattr(object, 'follow', False):
-                        self.follow(object)
-                    state.need_redraw = True
-
-            if isinstance(obj, SlipDefaultPopup):
-                state.default_popup = obj
-
-            if isinstance(obj, SlipInformation):
-                # see if its a existing one or a new one
-                if obj.key in state.info:
-#                    print('update %s' % str(obj.key))
-                    state.info[obj.key].update(obj)
-                else:
-#                    print('add %s' % str(obj.key))
-                    state.info[obj.key] = obj
-                state.need_redraw = True
-
-            if isinstance(obj, SlipCenter):
-                # move center
-                (lat,lon) = obj.latlon
-                state.panel.re_center(state.width/2, state.height/2, lat, lon)
-                state.need_redraw = True
-
-            if isinstance(obj, SlipBrightness):
-                # set map brightness
-                state.brightness = obj.brightness
-                state.need_redraw = True
-
-            if isinstance(obj, SlipClearLayer):
-                # remove all objects from a layer
-                if obj.layer in state.layers:
-                    state.layers.pop(obj.layer)
-                state.need_redraw = True
-
-            if isinstance(obj, SlipRemoveObject):
-                # remove an object by key
-                for layer in state.layers:
-                    if obj.key in state.layers[layer]:
-                        state.layers[layer].pop(obj.key)
-                state.need_redraw = True
-
-            if isinstance(obj, SlipHideObject):
-                # hide an object by key
-                for layer in state.layers:
-                    if obj.key in state.layers[layer]:
-                        state.layers[layer][obj.key].set_hidden(obj.hide)
-                state.need_redraw = True
+            if isinstance(obj, SlipBatch):
+                for o in obj.objects:
+                    self.handle_object(o)
+            else:
+                self.handle_object(obj)
 
         if obj is None:
             time.sleep(0.05)
@@ -226,8 +335,15 @@ class MPSlipMapPanel(wx.Panel):
 
         wx.Panel.__init__(self, parent)
         self.state = state
+        # the map with objects drawn on it
         self.img = None
-        self.map_img = None
+        # the tiles (and grid) for the view, and the view they are for
+        self.base_img = None
+        self.base_key = None
+        # (layer, key) -> pixel extent of the objects drawn on self.img
+        self.drawn = {}
+        self.full_redraws = 0
+        self.partial_redraws = 0
         self.redraw_timer = wx.Timer(self)
         self.Bind(wx.EVT_TIMER, self.on_redraw_timer, self.redraw_timer)
         self.Bind(wx.EVT_SET_FOCUS, self.on_focus)
@@ -382,9 +498,16 @@ class MPSlipMapPanel(wx.Panel):
         (lat,lon) = (latlon[0], latlon[1])
         return state.mt.coord_to_pixel(state.lat, state.lon, state.width, state.ground_width, lat, lon)
 
-    def draw_objects(self, objects, bounds, img):
-        '''draw objects on the image'''
-        keys = objects.keys()
+    def view_bounds(self):
+        '''return the (lat,lon,dlat,dlon) bounding box of the view'''
+        state = self.state
+        (lat2,lon2) = self.coordinates(state.width-1, state.height-1)
+        return (lat2, state.lon, state.lat-lat2, lon2-state.lon)
+
+    def draw_objects(self, layer, objects, bounds, img, rect):
+        '''draw objects on the image. If rect is not None only objects
+        that touch that pixel area are drawn'''
+        keys = list(objects.query(bounds))
         keys.sort()
         for k in keys:
             obj = objects[k]
@@ -392,47 +515,109 @@ class MPSlipMapPanel(wx.Panel):
                 continue
             bounds2 = obj.bounds()
             if bounds2 is None or mp_util.bounds_overlap(bounds, bounds2):
+                extent = self.drawn.get((layer, k), None)
+                if extent is None:
+                    extent = obj.pixel_extent(self.pixmapper)
+                if rect is not None and extent is not None and not extent_overlap(rect, extent):
+                    continue
                 obj.draw(img, self.pixmapper, bounds)
+                self.drawn[(layer, k)] = extent
+
+    def update_base(self):
+        '''get the map tiles for the view, returning True if the view changed'''
+        state = self.state
+        key = (self.current_view(), state.brightness, state.grid)
+        if self.base_img is not None and key == self.base_key:
+            return False
+        img = state.mt.area_to_image(state.lat, state.lon,
+                                     state.width, state.height, state.ground_width)
+        if state.brightness != 1.0:
+            img = np.uint8(np.clip(img*state.brightness, 0, 255))
+
+        # possibly draw a grid
+        if state.grid:
+            SlipGrid('grid', layer=3, linewidth=1, colour=(255,255,0)).draw(img, self.pixmapper, self.view_bounds())
+        self.base_img = img
+        self.base_key = key
+        return True
+
+    def dirty_rect(self):
+        '''return the pixel area that needs redrawing for the changed
+        objects, or None if it is not known'''
+        state = self.state
+        rect = None
+        for (layer, key) in state.dirty_objects:
+            if (layer, key) in self.drawn:
+                old = self.drawn.pop((layer, key))
+                if old is None:
+                    return None
+                rect = extent_union(rect, old)
+            obj = state.layers.get(layer, {}).get(key, None)
+            if obj is not None and not obj.hidden:
+                new = obj.pixel_extent(self.pixmapper)
+                if new is None:
+                    return None
+                rect = extent_union(rect, new)
+        if rect is None:
+            return (0, 0, 0, 0)
+        # grow the area until it holds all of every object it touches, so
+        # objects drawn again don't land on top of ones drawn after them
+        extents = self.drawn.values()
+        if None in extents:
+            return None
+        changed = True
+        while changed:
+            changed = False
+            for e in extents:
+                if extent_overlap(rect, e) and extent_union(rect, e) != rect:
+                    rect = extent_union(rect, e)
+                    changed = True
+        (height, width) = self.base_img.shape[:2]
+        return (max(rect[0], 0), max(rect[1], 0), min(rect[2], width), min(rect[3], height))
 
     def redraw_map(self):
-        '''redraw the map with current settings'''
+        '''redraw the map with current settings. The tiles for the view are
+        kept, and if only some objects have changed, only the area they
+        cover is redrawn'''
         state = self.state
 
-        view_same = (self.last_view is not None and self.map_img is not None and self.last_view == self.current_view())
+        view_same = (self.last_view is not None and self.img is not None and self.last_view == self.current_view())
 
-        if view_same and not state.need_redraw:
+        if view_same and not state.need_redraw and not state.dirty_objects:
             return
 
-        # get the new map
-        self.map_img = state.mt.area_to_image(state.lat, state.lon,
-                                              state.width, state.height, state.ground_width)
-        if state.brightness != 1.0:
-            self.map_img = self.map_img*state.brightness
-
+        view_changed = self.update_base()
 
         # find display bounding box
-        (lat2,lon2) = self.coordinates(state.width-1, state.height-1)
-        bounds = (lat2, state.lon, state.lat-lat2, lon2-state.lon)
+        bounds = self.view_bounds()
 
-        # get the image
-        img = self.map_img.copy()
+        rect = None
+        if not view_changed and not state.need_redraw and self.img is not None:
+            rect = self.dirty_rect()
 
-        # possibly draw a grid
-        if state.grid:
-            SlipGrid('grid', layer=3, linewidth=1, colour=(255,255,0)).draw(img, self.pixmapper, bounds)
-
-        # draw layer objects
         keys = state.layers.keys()
         keys.sort()
-        for k in keys:
-            self.draw_objects(state.layers[k], bounds, img)
+        if rect is None:
+            # draw everything
+            self.img = self.base_img.copy()
+            self.drawn = {}
+            for k in keys:
+                self.draw_objects(k, state.layers[k], bounds, self.img, None)
+            self.full_redraws += 1
+        elif rect[2] > rect[0] and rect[3] > rect[1]:
+            (x1, y1, x2, y2) = rect
+            self.img[y1:y2, x1:x2] = self.base_img[y1:y2, x1:x2]
+            for k in keys:
+                self.draw_objects(k, state.layers[k], bounds, self.img, rect)
+            self.partial_redraws += 1
+        state.dirty_objects.clear()
 
         # draw information objects
         for key in state.info:
             state.info[key].draw(state.panel, state.panel.information)
 
         # display the image
-        self.imagePanel.set_image(img)
+        self.imagePanel.set_image(self.img)
 
         self.update_position()
 
@@ -472,8 +657,10 @@ class MPSlipMapPanel(wx.Panel):
         state = self.state
         selected = []
         (px, py) = pos
+        # only objects in view can have been clicked on
+        bounds = self.view_bounds()
         for layer in state.layers:
-            for key in state.layers[layer]:
+            for key in state.layers[layer].query(bounds):
                 obj = state.layers[layer][key]
                 distance = obj.clicked(px, py)
                 if distance is not None:
@@ -563,6 +750,7 @@ class MPSlipMapPanel(wx.Panel):
                 if (isinstance(state.layers[l][key], SlipThumbnail)
                     and not isinstance(state.layers[l][key], SlipIcon)):
                     state.layers[l].pop(key)
+                    state.dirty_objects.add((l, key))
 
     def on_key_down(self, event):
         '''handle keyboard input'''
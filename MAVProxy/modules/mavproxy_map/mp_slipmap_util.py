@@ -10,18 +10,37 @@ import functools
 import math
 import os, sys
 import time
-import cv2
-import numpy as np
 
 from MAVProxy.modules.mavproxy_map import mp_elevation
 from MAVProxy.modules.mavproxy_map import mp_tile
 from MAVProxy.modules.lib import mp_util
 
+cv2 = mp_util.lazy_import('cv2')
+np = mp_util.lazy_import('numpy')
+
 def image_shape(img):
     '''handle different image formats, returning (width,height) tuple'''
     if hasattr(img, 'shape'):
         return (img.shape[1], img.shape[0])
     return (img.width, img.height)
+
+def extent_union(e1, e2):
+    '''return the union of two (x1,y1,x2,y2) pixel extents'''
+    if e1 is None:
+        return e2
+    if e2 is None:
+        return e1
+    return (min(e1[0], e2[0]), min(e1[1], e2[1]), max(e1[2], e2[2]), max(e1[3], e2[3]))
+
+def extent_overlap(e1, e2):
+    '''return true if two pixel extents overlap'''
+    return e1[0] < e2[2] and e2[0] < e1[2] and e1[1] < e2[3] and e2[1] < e1[3]
+
+def points_extent(points, margin):
+    '''return the pixel extent of a list of pixel points, grown by margin'''
+    xs = [ p[0] for p in points ]
+    ys = [ p[1] for p in points ]
+    return (min(xs)-margin, min(ys)-margin, max(xs)+margin+1, max(ys)+margin+1)
     
 
 class SlipObject:
@@ -80,6 +99,11 @@ class SlipObject:
         '''return bounding box or None'''
         return None
 
+    def pixel_extent(self, pixmapper):
+        '''return the (x1,y1,x2,y2) pixel area draw() will change, or
+        None if not known'''
+        return None
+
     def set_hidden(self, hidden):
         '''set hidden attribute'''
         self.hidden = hidden
@@ -107,6 +131,12 @@ class SlipLabel(SlipObject):
             return None
         return (self.point[0], self.point[1], 0, 0)
 
+    def pixel_extent(self, pixmapper):
+        '''return pixel area of the label'''
+        (px, py) = pixmapper(self.point)
+        ((tw, th), baseline) = cv2.getTextSize(self.label, cv2.FONT_HERSHEY_SIMPLEX, 1.0, 1)
+        return (px-2, py-th-2, px+tw+2, py+baseline+2)
+
 class SlipArrow(SlipObject):
     '''an arrow to display direction of movement'''
     def __init__(self, key, layer, xy_pix, colour, linewidth, rotation, reverse = False, arrow_size = 7, popup_menu=None):
@@ -148,9 +178,8 @@ class SlipCircle(SlipObject):
         self.linewidth = linewidth
         self.arrow = arrow
 
-    def draw(self, img, pixmapper, bounds):
-        if self.hidden:
-            return
+    def radius_pixels(self, pixmapper):
+        '''return the radius in pixels'''
         center_px = pixmapper(self.latlon)
         # figure out pixels per meter
         ref_pt = (self.latlon[0] + 1.0, self.latlon[1])
@@ -158,7 +187,13 @@ class SlipCircle(SlipObject):
         ref_px = pixmapper(ref_pt)
         dis_px = math.sqrt(float(center_px[1] - ref_px[1]) ** 2.0)
         pixels_per_meter = dis_px / dis
-        radius_px = int(self.radius * pixels_per_meter)
+        return int(self.radius * pixels_per_meter)
+
+    def draw(self, img, pixmapper, bounds):
+        if self.hidden:
+            return
+        center_px = pixmapper(self.latlon)
+        radius_px = self.radius_pixels(pixmapper)
         cv2.circle(img, center_px, radius_px, self.color, self.linewidth)
         if self.arrow:
             SlipArrow(self.key, self.layer, (center_px[0]-radius_px, center_px[1]),
@@ -172,6 +207,13 @@ class SlipCircle(SlipObject):
             return None
         return (self.latlon[0], self.latlon[1], 0, 0)
 
+    def pixel_extent(self, pixmapper):
+        '''return pixel area of the circle and its arrows'''
+        margin = self.radius_pixels(pixmapper) + self.linewidth + 2
+        if self.arrow:
+            margin += 12
+        return points_extent([pixmapper(self.latlon)], margin)
+
 class SlipPolygon(SlipObject):
     '''a polygon to display on the map'''
     def __init__(self, key, points, layer, colour, linewidth, arrow = False, popup_menu=None):
@@ -190,6 +232,15 @@ class SlipPolygon(SlipObject):
             return None
         return self._bounds
 
+    def pixel_extent(self, pixmapper):
+        '''return pixel area of the lines, vertex circles and arrows'''
+        if len(self.points) == 0:
+            return None
+        margin = 2*self.linewidth + 2
+        if self.arrow:
+            margin += 12
+        return points_extent([ pixmapper(p) for p in self.points ], margin)
+
     def draw_line(self, img, pixmapper, pt1, pt2, colour, linewidth):
         '''draw a line on the image'''
         pix1 = pixmapper(pt1)
@@ -356,6 +407,12 @@ class SlipFlightModeLegend(SlipObject):
         py = 5
         img[py:py+h,px:px+w] = self._img
 
+    def pixel_extent(self, pixmapper):
+        '''return pixel area of the legend'''
+        if self._img is None:
+            self._img = self.draw_legend()
+        return (5, 5, 5+self._img.shape[1], 5+self._img.shape[0])
+
 class SlipThumbnail(SlipObject):
     '''a thumbnail to display on the map'''
     def __init__(self, key, latlon, layer, img,
@@ -379,6 +436,11 @@ class SlipThumbnail(SlipObject):
             return None
         return (self.latlon[0], self.latlon[1], 0, 0)
 
+    def pixel_extent(self, pixmapper):
+        '''return pixel area of the image'''
+        (px, py) = pixmapper(self.latlon)
+        return (px-self.width/2-1, py-self.height/2-1, px+self.width/2+2, py+self.height/2+2)
+
     def img(self):
         '''return a cv image for the thumbnail'''
         if self._img is not None:
@@ -437,6 +499,12 @@ class SlipTrail:
             while len(self.points) > self.count:
                 self.points.pop(0)
 
+    def pixel_extent(self, pixmapper):
+        '''return pixel area of the trail, or None if it is empty'''
+        if len(self.points) == 0:
+            return None
+        return points_extent([ pixmapper(p) for p in self.points ], 2)
+
     def draw(self, img, pixmapper, bounds):
         '''draw the trail'''
         for p in self.points:
@@ -467,6 +535,16 @@ class SlipIcon(SlipThumbnail):
             self._rotated = self._img
         return self._rotated
 
+    def pixel_extent(self, pixmapper):
+        '''return pixel area of the icon and its trail'''
+        # the rotated icon is drawn into a height x width area
+        size = max(self.width, self.height)
+        (px, py) = pixmapper(self.latlon)
+        ret = (px-size/2-1, py-size/2-1, px+size/2+2, py+size/2+2)
+        if self.trail is not None:
+            ret = extent_union(ret, self.trail.pixel_extent(pixmapper))
+        return ret
+
     def draw(self, img, pixmapper, bounds):
         '''draw the icon on the image'''
 
@@ -526,6 +604,11 @@ class SlipHideObject:
         self.key = key
         self.hide = hide
 
+class SlipBatch:
+    '''a list of map objects sent as one message'''
+    def __init__(self, objects):
+        self.objects = objects
+
 
 class SlipInformation:
     '''an object to display in the information box'''
@@ -11,18 +11,20 @@ released under GNU GPL v3 or later
 
 import collections
 import errno
-import hashlib
-import urllib2
 import math
-import threading
 import os
 import sys
 import string
+import threading
 import time
-import cv2
-import numpy as np
+import weakref
 
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.mavproxy_map import mp_tile_downloader
+from MAVProxy.modules.mavproxy_map import mp_tilestore
+
+cv2 = mp_util.lazy_import('cv2')
+np = mp_util.lazy_import('numpy')
 
 class TileException(Exception):
 	'''tile error class'''
@@ -153,12 +155,100 @@ class TileInfoScaled(TileInfo):
 		(self.dstx, self.dsty) = dst
 
 
+class TileCache:
+	'''LRU cache of decoded tile images, limited by the total bytes of
+	the images it holds'''
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.lock = threading.Lock()
+		try:
+			self._cache = collections.OrderedDict()
+		except AttributeError:
+			# OrderedDicts in python 2.6 come from the ordereddict module
+			# which is a 3rd party package, not in python2.6 distribution
+			import ordereddict
+			self._cache = ordereddict.OrderedDict()
+
+	def __len__(self):
+		return len(self._cache)
+
+	def __contains__(self, key):
+		return key in self._cache
+
+	def get(self, key):
+		'''return a cached value, making it the most recently used, or None'''
+		with self.lock:
+			try:
+				(value, nbytes) = self._cache.pop(key)
+			except KeyError:
+				self.misses += 1
+				return None
+			self._cache[key] = (value, nbytes)
+			self.hits += 1
+			return value
+
+	def peek(self, key, touch=False):
+		'''return a cached value or None, without counting the lookup.
+		With touch a value found is made the most recently used'''
+		with self.lock:
+			try:
+				entry = self._cache[key]
+			except KeyError:
+				return None
+			if touch:
+				del self._cache[key]
+				self._cache[key] = entry
+			return entry[0]
+
+	def put(self, key, value, nbytes=None):
+		'''add a value, evicting the least recently used values to stay
+		within the byte budget. nbytes defaults to the size of the image'''
+		if nbytes is None:
+			nbytes = value.nbytes
+		with self.lock:
+			old = self._cache.pop(key, None)
+			if old is not None:
+				self.bytes -= old[1]
+			self._cache[key] = (value, nbytes)
+			self.bytes += nbytes
+			while self.bytes > self.max_bytes and len(self._cache) > 1:
+				(k, (v, n)) = self._cache.popitem(last=False)
+				self.bytes -= n
+				self.evictions += 1
+
+	def remove(self, key):
+		'''remove a value if present'''
+		with self.lock:
+			old = self._cache.pop(key, None)
+			if old is not None:
+				self.bytes -= old[1]
+
+	def clear(self):
+		'''remove all values'''
+		with self.lock:
+			self._cache.clear()
+			self.bytes = 0
+
+	def stats(self):
+		'''return a statistics summary'''
+		total = self.hits + self.misses
+		if total == 0:
+			total = 1
+		return "%u tiles %.1f/%.1f MB, %u hits %u misses (%.0f%%), %u evictions" % (
+			len(self._cache), self.bytes/1.0e6, self.max_bytes/1.0e6,
+			self.hits, self.misses, 100.0*self.hits/total, self.evictions)
+
 
 class MPTile:
 	'''map tile object'''
 	def __init__(self, cache_path=None, download=True, cache_size=500,
 		     service="MicrosoftSat", tile_delay=0.3, debug=False,
-		     max_zoom=19, refresh_age=30*24*60*60):
+		     max_zoom=19, refresh_age=30*24*60*60, download_threads=4,
+		     cache_bytes=None, scaled_cache_bytes=None, tile_store=None):
 
 		if cache_path is None:
 			try:
@@ -183,18 +273,38 @@ class MPTile:
 		if service not in TILE_SERVICES:
 			raise TileException('unknown tile service %s' % service)
 
-		# _download_pending is a dictionary of TileInfo objects
-		self._download_pending = {}
-		self._download_thread = None
+		# tile_store may be a store object, or the path of a cache
+		# directory or SQLite file. By default tiles are kept as files
+		# under cache_path
+		if tile_store is None:
+			tile_store = mp_tilestore.DirectoryTileStore(cache_path)
+		elif isinstance(tile_store, str):
+			tile_store = mp_tilestore.open_tile_store(tile_store)
+		self.store = tile_store
+
+		self._downloader = mp_tile_downloader.TileDownloader(self.store,
+								     workers=download_threads,
+								     tile_delay=tile_delay,
+								     blank_tiles=BLANK_TILES,
+								     on_result=self._download_result,
+								     debug=debug)
+		# (lat, lon, zoom) of the middle of the last area drawn, used
+		# to prioritise downloads
+		self._view = None
 		self._loading = mp_icon('loading.jpg')
 		self._unavailable = mp_icon('unavailable.jpg')
-		try:
-			self._tile_cache = collections.OrderedDict()
-		except AttributeError:
-			# OrderedDicts in python 2.6 come from the ordereddict module
-			# which is a 3rd party package, not in python2.6 distribution
-			import ordereddict
-			self._tile_cache = ordereddict.OrderedDict()
+
+		# decoded tiles are cached in two tiers, each with a byte
+		# budget. Full resolution tiles as loaded from disk go in
+		# _tile_cache, and the lower resolution fill-ins and the
+		# scaled tiles made from them go in _scaled_cache. The budget
+		# defaults to cache_size full resolution tiles
+		if cache_bytes is None:
+			cache_bytes = cache_size * TILES_WIDTH * TILES_HEIGHT * 3
+		if scaled_cache_bytes is None:
+			scaled_cache_bytes = cache_bytes // 4
+		self._tile_cache = TileCache(cache_bytes)
+		self._scaled_cache = TileCache(scaled_cache_bytes)
 
 	def set_service(self, service):
 		'''set tile service'''
@@ -238,81 +348,58 @@ class MPTile:
 
 	def tiles_pending(self):
 		'''return number of tiles pending download'''
-		return len(self._download_pending)
-
-	def downloader(self):
-		'''the download thread'''
-		while self.tiles_pending() > 0:
-			time.sleep(self.tile_delay)
-
-			keys = self._download_pending.keys()[:]
-
-			# work out which one to download next, choosing by request_time
-			tile_info = self._download_pending[keys[0]]
-			for key in keys:
-				if self._download_pending[key].request_time > tile_info.request_time:
-					tile_info = self._download_pending[key]
-
-			url = tile_info.url(self.service)
-			path = self.tile_to_path(tile_info)
-			key = tile_info.key()
-
-			try:
-				if self.debug:
-					print("Downloading %s [%u left]" % (url, len(keys)))
-				req = urllib2.Request(url)
-				if url.find('google') != -1:
-					req.add_header('Referer', 'https://maps.google.com/')
-				resp = urllib2.urlopen(req)
-				headers = resp.info()
-			except urllib2.URLError as e:
-				#print('Error loading %s' % url)
-				if not key in self._tile_cache:
-					self._tile_cache[key] = self._unavailable
-				self._download_pending.pop(key)
-				if self.debug:
-					print("Failed %s: %s" % (url, str(e)))
-				continue
-			if 'content-type' not in headers or headers['content-type'].find('image') == -1:
-				if not key in self._tile_cache:
-					self._tile_cache[key] = self._unavailable
-				self._download_pending.pop(key)
-				if self.debug:
-					print("non-image response %s" % url)
-				continue
-			else:
-				img = resp.read()
-
-			# see if its a blank/unavailable tile
-			md5 = hashlib.md5(img).hexdigest()
-			if md5 in BLANK_TILES:
-				if self.debug:
-					print("blank tile %s" % url)
-					if not key in self._tile_cache:
-						self._tile_cache[key] = self._unavailable
-				self._download_pending.pop(key)
-				continue
-
-			mp_util.mkdir_p(os.path.dirname(path))
-			h = open(path+'.tmp','wb')
-			h.write(img)
-			h.close()
-			try:
-				os.unlink(path)
-			except Exception:
-				pass
-			os.rename(path+'.tmp', path)
-			self._download_pending.pop(key)
-		self._download_thread = None
-
-	def start_download_thread(self):
-		'''start the downloader'''
-		if self._download_thread:
+		return self._downloader.tiles_pending()
+
+	def download_stats(self):
+		'''return tile download statistics'''
+		return self._downloader.stats()
+
+	def download_priority(self, tile):
+		'''download priority of a tile, lower is sooner. Tiles at the zoom
+		being viewed and close to the middle of the view come first.
+		With no view the newest request comes first'''
+		if self._view is None:
+			return (0, -tile.request_time)
+		(lat, lon, zoom) = self._view
+		return (abs(tile.zoom - zoom), tile.distance(lat, lon))
+
+	def set_view(self, lat, lon, zoom):
+		'''set the middle and zoom of the area being viewed, reprioritising
+		pending downloads'''
+		view = (lat, lon, zoom)
+		if view == self._view:
 			return
-		t = threading.Thread(target=self.downloader)
-		t.daemon = True
-		self._download_thread = t
-		t.start()
+		self._view = view
+		self._downloader.reprioritise(lambda key: self.download_priority(TileInfo(key[0], key[1], key[2])))
+
+	def _download_result(self, key, ok):
+		'''called from a download thread when a tile has been fetched'''
+		if ok:
+			# the fill-in for this tile is no longer needed
+			self._scaled_cache.remove(('lowres', key))
+		elif not key in self._tile_cache:
+			self._tile_cache.put(key, self._unavailable, nbytes=0)
+
+	def start_download(self, tile):
+		'''queue a tile for download, or update its priority'''
+		self._downloader.request(tile.key(), tile.url(self.service),
+					 self.service, self.download_priority(tile))
+
+	def close(self):
+		'''stop downloading and write out any tiles held by the store'''
+		self._downloader.stop()
+		self.store.close()
+
+	def load_stored_tile(self, tile):
+		'''return (image, mtime) of a tile from the tile store, or
+		(None, None) if it is not stored'''
+		(data, mtime) = self.store.get(tile.key())
+		if data is None:
+			return (None, None)
+		img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+		if img is None:
+			return (None, None)
+		return (img, mtime)
 
 	def load_tile_lowres(self, tile):
 		'''load a lower resolution tile from cache to fill in a
@@ -320,6 +407,13 @@ class MPTile:
 		if tile.zoom == self.min_zoom:
 			return None
 
+		# these are probes for a stand in tile, so they don't count as
+		# cache hits or misses, but tiles found are still in use
+		lowres_key = ('lowres', tile.key())
+		img = self._scaled_cache.peek(lowres_key, touch=True)
+		if img is not None:
+			return img
+
 		# find the equivalent lower res tile
 		(lat,lon) = tile.coord()
 
@@ -337,19 +431,15 @@ class MPTile:
 
 			# see if its in the tile cache
 			key = tile_info.key()
-			if key in self._tile_cache:
-				img = self._tile_cache[key]
-				if np.array_equal(img, np.array(self._unavailable)):
-					continue
-			else:
-				path = self.tile_to_path(tile_info)
-				img = cv2.imread(path)
+			img = self._tile_cache.peek(key, touch=True)
+			if img is self._unavailable:
+				continue
+			if img is None:
+				(img, mtime) = self.load_stored_tile(tile_info)
 				if img is None:
 					continue
 				# add it to the tile cache
-				self._tile_cache[key] = img
-				while len(self._tile_cache) > self.cache_size:
-					self._tile_cache.popitem(0)
+				self._tile_cache.put(key, img)
 
 			# copy out the quadrant we want
 			availx = min(TILES_WIDTH - tile_info.offsetx, width2)
@@ -361,6 +451,7 @@ class MPTile:
 			# and scale it
 			scaled = cv2.resize(roi, (TILES_HEIGHT,TILES_WIDTH))
 			#cv.Rectangle(scaled, (0,0), (255,255), (0,255,0), 1)
+			self._scaled_cache.put(lowres_key, scaled)
 			return scaled
 		return None
 
@@ -369,30 +460,25 @@ class MPTile:
 
 		# see if its in the tile cache
 		key = tile.key()
-		if key in self._tile_cache:
-			img = self._tile_cache[key]
-			if np.array_equal(img, self._unavailable):
-				img = self.load_tile_lowres(tile)
-				if img is None:
-					img = self._unavailable
-				return img
+		img = self._tile_cache.get(key)
+		if img is self._unavailable:
+			img = self.load_tile_lowres(tile)
+			if img is None:
+				img = self._unavailable
+			return img
+		if img is not None:
+			return img
 
 
-		path = self.tile_to_path(tile)
-		ret = cv2.imread(path)
+		(ret, mtime) = self.load_stored_tile(tile)
 		if ret is not None:
 			# if it is an old tile, then try to refresh
-			if os.path.getmtime(path) + self.refresh_age < time.time():
-				try:
-						self._download_pending[key].refresh_time()
-				except Exception:
-						self._download_pending[key] = tile
-				self.start_download_thread()
-					
+			if mtime + self.refresh_age < time.time():
+				self.start_download(tile)
+
 			# add it to the tile cache
-			self._tile_cache[key] = ret
-			while len(self._tile_cache) > self.cache_size:
-				self._tile_cache.popitem(0)
+			self._tile_cache.put(key, ret)
+			self._scaled_cache.remove(('lowres', key))
 			return ret
 
 		if not self.download:
@@ -401,11 +487,7 @@ class MPTile:
 				img = self._unavailable
 			return img
 
-		try:
-			self._download_pending[key].refresh_time()
-		except Exception:
-			self._download_pending[key] = tile
-		self.start_download_thread()
+		self.start_download(tile)
 
 		img = self.load_tile_lowres(tile)
 		if img is None:
@@ -418,9 +500,23 @@ class MPTile:
 		width = int(TILES_WIDTH / tile.scale)
 		height = int(TILES_HEIGHT / tile.scale)
 		full_tile = self.load_tile(tile)
+		if full_tile.shape[:2] == (width, height):
+			return full_tile
+		# reuse the last scaling of this tile if it was made from the
+		# same image at the same size. The source is held by a weak
+		# reference so it is not kept alive after leaving _tile_cache
+		scaled_key = ('scaled', tile.key())
+		cached = self._scaled_cache.get(scaled_key)
+		if cached is not None and cached[0]() is full_tile and cached[1].shape[:2] == (width, height):
+			return cached[1]
 		scaled_tile = cv2.resize(full_tile, (height, width))
+		self._scaled_cache.put(scaled_key, (weakref.ref(full_tile), scaled_tile), nbytes=scaled_tile.nbytes)
 		return scaled_tile
 
+	def cache_stats(self):
+		'''return tile cache statistics'''
+		return "full: %s\nscaled: %s" % (self._tile_cache.stats(), self._scaled_cache.stats())
+
 
 	def coord_from_area(self, x, y, lat, lon, width, ground_width):
 		'''return (lat,lon) for a pixel in an area image'''
@@ -520,10 +616,12 @@ class MPTile:
 
 		tlist = self.area_to_tile_list(lat, lon, width, height, ground_width, zoom)
 
-		# order the display by distance from the middle, so the download happens
-		# close to the middle of the image first
+		# downloads are prioritised by distance from the middle, so the
+		# download happens close to the middle of the image first
+		(midlat, midlon) = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
+		if len(tlist) > 0:
+			self.set_view(midlat, midlon, tlist[0].zoom)
 		if ordered:
-			(midlat, midlon) = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
 			tlist.sort(key=lambda d: d.distance(midlat, midlon), reverse=True)
 
 		for t in tlist:
@@ -535,6 +633,9 @@ class MPTile:
 				scaled_tile_roi = scaled_tile[t.srcy:t.srcy+h, t.srcx:t.srcx+w]
 				img[t.dsty:t.dsty+h, t.dstx:t.dstx+w] = scaled_tile_roi.copy()
 
+		# cancel downloads of tiles that have scrolled out of view
+		self._downloader.retain(set([t.key() for t in tlist]))
+
 		# return as an RGB image
 		img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 		return img
@@ -569,6 +670,9 @@ if __name__ == "__main__":
 	parser.add_option("--zoom", default=None, type='int', help="zoom level")
 	parser.add_option("--max-zoom", type='int', default=19, help="maximum tile zoom")
 	parser.add_option("--delay", type='float', default=1.0, help="tile download delay")
+	parser.add_option("--threads", type='int', default=4, help="number of download threads")
+	parser.add_option("--tile-store", default=None, help="tile cache directory or SQLite file")
+	parser.add_option("--service-url", default=None, help="URL template for a custom tile service, eg http://localhost:8000/${ZOOM}/${X}/${Y}.png")
 	parser.add_option("--boundary", default=None, help="region boundary")
 	parser.add_option("--debug", action='store_true', default=False, help="show debug info")
 	(opts, args) = parser.parse_args()
@@ -586,8 +690,13 @@ if __name__ == "__main__":
 				   mp_util.gps_distance(lat, lon, lat-bounds[2], lon))
 		print lat, lon, ground_width
 
+	if opts.service_url is not None:
+		TILE_SERVICES['Custom'] = opts.service_url
+		opts.service = 'Custom'
+
 	mt = MPTile(debug=opts.debug, service=opts.service,
-			tile_delay=opts.delay, max_zoom=opts.max_zoom)
+			tile_delay=opts.delay, max_zoom=opts.max_zoom,
+			download_threads=opts.threads, tile_store=opts.tile_store)
 	if opts.zoom is None:
 		zooms = range(mt.min_zoom, mt.max_zoom+1)
 	else:
@@ -601,4 +710,7 @@ if __name__ == "__main__":
 		while mt.tiles_pending() > 0:
 			time.sleep(2)
 			print("Waiting on %u tiles" % mt.tiles_pending())
+	print(mt.download_stats())
+	print(mt.cache_stats())
+	mt.close()
 	print('Done')
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+'''
+parallel map tile downloader
+
+a pool of worker threads fetching tiles for mp_tile into a tile
+store (see mp_tilestore). Pending tiles are
+kept in a heap ordered by a priority the caller supplies (mp_tile uses
+zoom and distance from the middle of the view), so the tiles the user
+is looking at come first. Tiles that are no longer wanted can be
+cancelled before they are fetched. Each worker keeps one keep-alive
+HTTP connection per host, and requests to each tile service are
+limited to a maximum rate.
+'''
+
+import hashlib
+import heapq
+import httplib
+import socket
+import threading
+import time
+import urlparse
+
+# maximum requests per second for each tile service
+TILE_RATE_LIMITS = {
+    'OpenStreetMap' : 2.0,
+    'OSMARender'    : 2.0,
+    'OpenCycleMap'  : 2.0,
+    }
+DEFAULT_RATE_LIMIT = 20.0
+
+class TileJob(object):
+    '''a tile waiting to be downloaded'''
+    __slots__ = ('key', 'url', 'service', 'priority', 'seq', 'request_time')
+
+    def __init__(self, key, url, service, priority, seq):
+        self.key = key
+        self.url = url
+        self.service = service
+        self.priority = priority
+        self.seq = seq
+        self.request_time = time.time()
+
+
+class TileDownloader(object):
+    '''pool of tile download threads'''
+    def __init__(self, store, workers=4, tile_delay=0.0, rate_limits=None, blank_tiles=None,
+                 on_result=None, timeout=10, debug=False):
+        self.store = store
+        self.num_workers = workers
+        self.tile_delay = tile_delay
+        self.rate_limits = dict(TILE_RATE_LIMITS)
+        if rate_limits is not None:
+            self.rate_limits.update(rate_limits)
+        self.blank_tiles = blank_tiles or set()
+        # called as on_result(key, ok) from a worker when a tile is done
+        self.on_result = on_result
+        self.timeout = timeout
+        self.debug = debug
+        self.lock = threading.Condition()
+        # key -> TileJob, for tiles waiting to be fetched
+        self.pending = {}
+        # heap of (priority, seq, key). Entries whose seq no longer
+        # matches the job are stale and skipped
+        self.heap = []
+        # keys being fetched now
+        self.active = set()
+        self.seq = 0
+        # service -> earliest time of the next request
+        self.next_request = {}
+        self.workers = []
+        self.stopping = False
+        self.idle_timeout = 2.0
+        # tile_delay is a pause each worker takes after a tile, the
+        # per-service rate limits apply across all workers
+
+        # statistics
+        self.downloaded = 0
+        self.unavailable = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.bytes = 0
+        self.connections = 0
+        self.requests = 0
+
+    def _push(self, job):
+        self.seq += 1
+        job.seq = self.seq
+        heapq.heappush(self.heap, (job.priority, job.seq, job.key))
+        if len(self.heap) > 4 * len(self.pending) + 64:
+            # drop stale entries left by re-queued and cancelled tiles
+            self.heap = [ (j.priority, j.seq, j.key) for j in self.pending.values() ]
+            heapq.heapify(self.heap)
+
+    def request(self, key, url, service, priority):
+        '''ask for a tile to be downloaded. Asking again for a pending tile
+        updates its priority'''
+        with self.lock:
+            if key in self.active:
+                return
+            job = self.pending.get(key, None)
+            if job is None:
+                job = TileJob(key, url, service, priority, 0)
+                self.pending[key] = job
+            elif job.priority == priority:
+                return
+            job.priority = priority
+            self._push(job)
+            self.lock.notify()
+        self._start_workers()
+
+    def reprioritise(self, priority_fn):
+        '''recompute the priority of every pending tile, with
+        priority_fn(key) returning the new priority'''
+        with self.lock:
+            self.heap = []
+            for job in self.pending.values():
+                job.priority = priority_fn(job.key)
+                self._push(job)
+
+    def retain(self, keys):
+        '''cancel pending tiles that are not in keys'''
+        with self.lock:
+            for key in list(self.pending.keys()):
+                if not key in keys:
+                    self.pending.pop(key)
+                    self.cancelled += 1
+
+    def tiles_pending(self):
+        '''return number of tiles waiting or being fetched'''
+        return len(self.pending) + len(self.active)
+
+    def _start_workers(self):
+        if len(self.workers) >= self.num_workers or self.stopping:
+            return
+        with self.lock:
+            while len(self.workers) < min(self.num_workers, len(self.pending)):
+                t = threading.Thread(target=self._worker, name='tile-download-%u' % len(self.workers))
+                t.daemon = True
+                self.workers.append(t)
+                t.start()
+
+    def stop(self, timeout=5.0):
+        '''stop the workers once their current tile is done, waiting up
+        to timeout seconds for them to finish so the store can be closed'''
+        with self.lock:
+            self.stopping = True
+            self.lock.notify_all()
+            workers = list(self.workers)
+        end = time.time() + timeout
+        for t in workers:
+            if t is threading.current_thread():
+                continue
+            t.join(max(0, end - time.time()))
+
+    def _next_job(self):
+        '''wait for the highest priority tile, or None when stopping or
+        when there has been nothing to do for idle_timeout seconds'''
+        idle_start = time.time()
+        with self.lock:
+            while not self.stopping:
+                while self.heap:
+                    (priority, seq, key) = heapq.heappop(self.heap)
+                    job = self.pending.get(key, None)
+                    if job is None or job.seq != seq:
+                        # cancelled or re-queued with a new priority
+                        continue
+                    self.pending.pop(key)
+                    self.active.add(key)
+                    return job
+                remaining = idle_start + self.idle_timeout - time.time()
+                if remaining <= 0:
+                    break
+                self.lock.wait(remaining)
+            self.workers.remove(threading.current_thread())
+        return None
+
+    def _rate_limit(self, service):
+        '''wait until we may send another request to a service'''
+        interval = 1.0 / self.rate_limits.get(service, DEFAULT_RATE_LIMIT)
+        with self.lock:
+            now = time.time()
+            t = max(now, self.next_request.get(service, 0))
+            self.next_request[service] = t + interval
+        if t > now:
+            time.sleep(t - now)
+
+    def _fetch(self, connections, url):
+        '''fetch a URL over a kept-alive connection, returning (status, headers, data)'''
+        u = urlparse.urlsplit(url)
+        path = u.path or '/'
+        if u.query:
+            path += '?' + u.query
+        headers = { 'User-Agent' : 'MAVProxy', 'Connection' : 'keep-alive' }
+        if url.find('google') != -1:
+            headers['Referer'] = 'https://maps.google.com/'
+        ckey = (u.scheme, u.netloc)
+        for attempt in range(2):
+            conn = connections.get(ckey, None)
+            if conn is None:
+                if u.scheme == 'https':
+                    conn = httplib.HTTPSConnection(u.netloc, timeout=self.timeout)
+                else:
+                    conn = httplib.HTTPConnection(u.netloc, timeout=self.timeout)
+                connections[ckey] = conn
+                self.connections += 1
+            try:
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+                if resp.getheader('connection', '').lower() == 'close':
+                    conn.close()
+                    connections.pop(ckey, None)
+                return (resp.status, resp, data)
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                connections.pop(ckey, None)
+                # the server may have closed an idle connection, try once more
+                if attempt == 1:
+                    raise
+        return None
+
+    def _worker(self):
+        '''a download thread'''
+        connections = {}
+        while True:
+            job = self._next_job()
+            if job is None:
+                break
+            self._rate_limit(job.service)
+            if self.stopping:
+                with self.lock:
+                    self.active.discard(job.key)
+                    self.workers.remove(threading.current_thread())
+                break
+            ok = False
+            try:
+                if self.debug:
+                    print("Downloading %s [%u left]" % (job.url, len(self.pending)))
+                self.requests += 1
+                (status, resp, data) = self._fetch(connections, job.url)
+                ctype = resp.getheader('content-type', '')
+                if status != 200:
+                    self.unavailable += 1
+                    if self.debug:
+                        print("HTTP %u for %s" % (status, job.url))
+                elif ctype.find('image') == -1:
+                    self.unavailable += 1
+                    if self.debug:
+                        print("non-image response %s" % job.url)
+                elif hashlib.md5(data).hexdigest() in self.blank_tiles:
+                    self.unavailable += 1
+                    if self.debug:
+                        print("blank tile %s" % job.url)
+                else:
+                    self.store.put(job.key, data)
+                    self.downloaded += 1
+                    self.bytes += len(data)
+                    ok = True
+            except Exception as e:
+                self.failed += 1
+                if self.debug:
+                    print("Failed %s: %s" % (job.url, str(e)))
+            with self.lock:
+                self.active.discard(job.key)
+            if self.on_result is not None:
+                self.on_result(job.key, ok)
+            if self.tile_delay > 0:
+                time.sleep(self.tile_delay)
+        for conn in connections.values():
+            conn.close()
+        try:
+            self.store.flush()
+        except Exception as e:
+            # the store was closed while we were still fetching
+            if self.debug:
+                print("Tile store flush failed: %s" % str(e))
+
+    def stats(self):
+        '''return a statistics summary'''
+        return ("%u pending %u active, %u downloaded (%u bytes), %u unavailable, %u failed, "
+                "%u cancelled, %u requests on %u connections" % (
+                    len(self.pending), len(self.active), self.downloaded, self.bytes,
+                    self.unavailable, self.failed, self.cancelled, self.requests, self.connections))
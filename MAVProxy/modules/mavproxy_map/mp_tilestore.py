@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+'''
+map tile stores
+
+the downloaded tiles used by mp_tile are kept in a tile store. The
+DirectoryTileStore is the traditional layout of one image file per
+tile under <cache_path>/<service>/<zoom>/<y>/<x>.img. The
+SQLiteTileStore keeps all tiles in one MBTiles-like SQLite file,
+which is much faster on SD cards and easy to copy to another machine.
+
+Unlike a strict MBTiles file the SQLite store holds tiles of several
+services, uses the same x/y numbering as the tile servers (not TMS
+rows) and stores the time each tile was downloaded, so refresh checks
+don't need to stat a file.
+
+Tiles are identified by the mp_tile key ((x, y), zoom, service).
+
+To copy tiles between stores, for example to pack a directory cache
+into a single file:
+
+  mp_tilestore.py ~/.tilecache ~/tiles.mbtiles
+'''
+
+import os
+import threading
+import time
+
+from MAVProxy.modules.lib import mp_util
+
+class DirectoryTileStore(object):
+    '''tiles as one file each under a cache directory'''
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        if not os.path.exists(cache_path):
+            mp_util.mkdir_p(cache_path)
+
+    def tile_path(self, key):
+        '''return full path to a tile'''
+        ((x, y), zoom, service) = key
+        return os.path.join(self.cache_path, service, '%u' % zoom, '%u' % y, '%u.img' % x)
+
+    def get(self, key):
+        '''return (data, mtime) for a tile, or (None, None) if not stored'''
+        path = self.tile_path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return (None, None)
+        data = f.read()
+        mtime = os.fstat(f.fileno()).st_mtime
+        f.close()
+        return (data, mtime)
+
+    def put(self, key, data, mtime=None):
+        '''store a tile'''
+        path = self.tile_path(key)
+        mp_util.mkdir_p(os.path.dirname(path))
+        h = open(path+'.tmp','wb')
+        h.write(data)
+        h.close()
+        try:
+            os.unlink(path)
+        except Exception:
+            pass
+        os.rename(path+'.tmp', path)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def keys(self):
+        '''iterate over the keys of all stored tiles'''
+        for service in sorted(os.listdir(self.cache_path)):
+            spath = os.path.join(self.cache_path, service)
+            if not os.path.isdir(spath):
+                continue
+            for (dirpath, dirnames, filenames) in os.walk(spath):
+                rel = os.path.relpath(dirpath, spath).split(os.sep)
+                if len(rel) != 2 or not rel[0].isdigit() or not rel[1].isdigit():
+                    continue
+                for f in filenames:
+                    if f.endswith('.img') and f[:-4].isdigit():
+                        yield ((int(f[:-4]), int(rel[1])), int(rel[0]), service)
+
+    def flush(self):
+        '''tiles are written immediately'''
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteTileStore(object):
+    '''tiles in a single SQLite file. Writes are batched, and held
+    tiles are committed once batch_size tiles are waiting or
+    flush_interval seconds have passed since the last commit'''
+    def __init__(self, filename, batch_size=32, flush_interval=2.0):
+        import sqlite3
+        self.filename = filename
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        d = os.path.dirname(filename)
+        if d and not os.path.exists(d):
+            mp_util.mkdir_p(d)
+        # the connection is shared by the download threads, so all
+        # access is under the lock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS tiles (service TEXT, zoom_level INTEGER, '
+                        'tile_column INTEGER, tile_row INTEGER, mtime REAL, tile_data BLOB)')
+        self.db.execute('CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles '
+                        '(service, zoom_level, tile_column, tile_row)')
+        self.db.execute("INSERT OR IGNORE INTO metadata VALUES ('name', 'MAVProxy tile cache')")
+        self.db.execute("INSERT OR IGNORE INTO metadata VALUES ('format', 'image')")
+        self.db.commit()
+        # key -> (data, mtime) of tiles waiting to be written
+        self.pending = {}
+        self.last_flush = time.time()
+
+    def get(self, key):
+        '''return (data, mtime) for a tile, or (None, None) if not stored'''
+        ((x, y), zoom, service) = key
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            row = self.db.execute('SELECT tile_data, mtime FROM tiles WHERE service=? AND zoom_level=? '
+                                  'AND tile_column=? AND tile_row=?', (service, zoom, x, y)).fetchone()
+        if row is None:
+            return (None, None)
+        return (str(row[0]), row[1])
+
+    def put(self, key, data, mtime=None):
+        '''store a tile'''
+        if mtime is None:
+            mtime = time.time()
+        with self.lock:
+            self.pending[key] = (data, mtime)
+            if (len(self.pending) >= self.batch_size or
+                time.time() - self.last_flush > self.flush_interval):
+                self._flush()
+
+    def _flush(self):
+        if len(self.pending) > 0:
+            import sqlite3
+            rows = [ (service, zoom, x, y, mtime, sqlite3.Binary(data))
+                     for (((x, y), zoom, service), (data, mtime)) in self.pending.items() ]
+            self.db.executemany('INSERT OR REPLACE INTO tiles VALUES (?,?,?,?,?,?)', rows)
+            self.db.commit()
+            self.pending = {}
+        self.last_flush = time.time()
+
+    def flush(self):
+        '''write any tiles waiting in the batch'''
+        with self.lock:
+            self._flush()
+
+    def keys(self):
+        '''iterate over the keys of all stored tiles'''
+        self.flush()
+        with self.lock:
+            rows = self.db.execute('SELECT service, zoom_level, tile_column, tile_row FROM tiles').fetchall()
+        for (service, zoom, x, y) in rows:
+            yield ((x, y), zoom, service)
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.db.close()
+
+
+def open_tile_store(path):
+    '''open a tile store. Files ending in .mbtiles, .sqlite or .db are
+    SQLite stores, anything else is a cache directory'''
+    if os.path.splitext(path)[1].lower() in ['.mbtiles', '.sqlite', '.db']:
+        return SQLiteTileStore(path)
+    return DirectoryTileStore(path)
+
+def copy_tiles(src, dst, service=None, progress=None):
+    '''copy tiles from one store to another, keeping their download
+    times. Returns the number of tiles copied'''
+    count = 0
+    for key in src.keys():
+        if service is not None and key[2] != service:
+            continue
+        (data, mtime) = src.get(key)
+        if data is None:
+            continue
+        dst.put(key, data, mtime)
+        count += 1
+        if progress is not None and count % 1000 == 0:
+            progress(count)
+    dst.flush()
+    return count
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser("mp_tilestore.py [options] SOURCE DEST")
+    parser.add_option("--service", default=None, help="only copy tiles of this service")
+    (opts, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.print_help()
+        raise SystemExit(1)
+
+    def show_progress(count):
+        print("Copied %u tiles" % count)
+
+    src = open_tile_store(args[0])
+    dst = open_tile_store(args[1])
+    count = copy_tiles(src, dst, service=opts.service, progress=show_progress)
+    src.close()
+    dst.close()
+    print("Copied %u tiles from %s to %s" % (count, args[0], args[1]))
@@ -13,14 +13,108 @@ import pickle
 import os.path
 import os
 import zipfile
-import array
 import math
-import multiprocessing
+import mmap
+import Queue
+import threading
+import time
 from MAVProxy.modules.lib import mp_util
 import tempfile
 
-childTileDownload = {}
-childFileListDownload = {}
+np = mp_util.lazy_import('numpy')
+
+# one SRTMFetcher per process, as threads don't survive a fork
+fetchers = {}
+
+class SRTMFuture(object):
+    """The result of a job queued on a SRTMFetcher. Callbacks are called
+        from the fetch thread."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.callbacks = []
+        self.ok = None
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self):
+        """True if the job succeeded, None while it is running"""
+        return self.ok
+
+    def wait(self, timeout=None):
+        """wait for the job to finish, returning True if it has"""
+        self.event.wait(timeout)
+        return self.event.is_set()
+
+    def add_done_callback(self, fn):
+        """call fn(future) when the job finishes"""
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, ok):
+        with self.lock:
+            self.ok = ok
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as ex:
+                print("SRTM callback failed: %s" % ex)
+
+
+class SRTMFetcher(object):
+    """A pool of threads running SRTM downloads and conversions. Jobs are
+        identified by a key, and submitting a job that is already queued
+        or running returns the future of the existing job."""
+    def __init__(self, workers=2):
+        self.num_workers = workers
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.workers = []
+
+    def submit(self, key, fn, *args):
+        """queue fn(*args), returning a SRTMFuture"""
+        with self.lock:
+            if key in self.jobs:
+                return self.jobs[key]
+            future = SRTMFuture()
+            self.jobs[key] = future
+            self.queue.put((key, future, fn, args))
+            while len(self.workers) < self.num_workers:
+                t = threading.Thread(target=self._worker, name='srtm-fetch-%u' % len(self.workers))
+                t.daemon = True
+                self.workers.append(t)
+                t.start()
+        return future
+
+    def pending(self, key):
+        """return the future of a queued or running job, or None"""
+        return self.jobs.get(key, None)
+
+    def _worker(self):
+        while True:
+            (key, future, fn, args) = self.queue.get()
+            try:
+                ok = fn(*args)
+            except Exception:
+                ok = False
+            with self.lock:
+                self.jobs.pop(key, None)
+            future.set_result(ok)
+
+def get_fetcher():
+    """the SRTMFetcher of this process"""
+    mypid = os.getpid()
+    if not mypid in fetchers:
+        fetchers[mypid] = SRTMFetcher()
+    return fetchers[mypid]
 
 class NoSuchTileError(Exception):
     """Raised when there is no tile for a region."""
@@ -85,6 +179,14 @@ class SRTMDownloader():
                 r"([NS])(\d{2})([EW])(\d{3})\.hgt\.zip")
         self.filelist_file = os.path.join(self.cachedir, "filelist_python")
         self.min_filelist_len = 14500
+        # (lat, lon) -> time of the last failed fetch, to avoid retrying
+        # a tile on every lookup
+        self.failed = {}
+        self.retry_time = 30
+        # time the last file list fetch finished
+        self.filelist_time = 0
+        # tiles that can't be saved decompressed
+        self.unconvertible = set()
 
     def loadFileList(self):
         """Load a previously created file list or create a new one if none is
@@ -110,12 +212,22 @@ class SRTMDownloader():
 
     def createFileList(self):
         """SRTM data is split into different directories, get a list of all of
-            them and create a dictionary for easy lookup."""
-        global childFileListDownload
-        mypid = os.getpid()
-        if mypid not in childFileListDownload or not childFileListDownload[mypid].is_alive():
-            childFileListDownload[mypid] = multiprocessing.Process(target=self.createFileListHTTP)
-            childFileListDownload[mypid].start()
+            them and create a dictionary for easy lookup. The list is fetched
+            in the background, returning a SRTMFuture."""
+        future = get_fetcher().submit(('filelist', self.filelist_file), self.createFileListHTTP)
+        def fetch_done(future):
+            self.filelist_time = time.time()
+        future.add_done_callback(fetch_done)
+        return future
+
+    def retryFileList(self):
+        """Fetch the file list again if it is missing or incomplete, at
+            most once every retry_time seconds."""
+        if self.offline != 0 or get_fetcher().pending(('filelist', self.filelist_file)) is not None:
+            return
+        if time.time() - self.filelist_time < self.retry_time:
+            return
+        self.createFileList()
 
     def getURIWithRedirect(self, url):
         '''fetch a URL with redirect handling'''
@@ -142,13 +254,13 @@ class SRTMDownloader():
         HTTP file transfer protocol (rather than ftp).
         30may2010  GJ ORIGINAL VERSION
         """
-        mp_util.child_close_fds()
         if self.debug:
             print("Connecting to %s" % self.server, self.directory)
         try:
             data = self.getURIWithRedirect(self.directory)
         except Exception:
-            return
+            return False
+        filelist = {}
         parser = parseHTMLDirectoryListing()
         parser.feed(data)
         continents = parser.getDirListing()
@@ -173,16 +285,17 @@ class SRTMDownloader():
             files = parser.getDirListing()
 
             for filename in files:
-                self.filelist[self.parseFilename(filename)] = (
+                filelist[self.parseFilename(filename)] = (
                             continent, filename)
 
-            '''print self.filelist'''
+            '''print filelist'''
         # Add meta info
-        self.filelist["server"] = self.server
-        self.filelist["directory"] = self.directory
+        filelist["server"] = self.server
+        filelist["directory"] = self.directory
+        self.filelist = filelist
         tmpname = self.filelist_file + ".tmp"
         with open(tmpname , 'wb') as output:
-            pickle.dump(self.filelist, output)
+            pickle.dump(filelist, output)
             output.close()
             try:
                 os.unlink(self.filelist_file)
@@ -193,7 +306,8 @@ class SRTMDownloader():
             except Exception:
                 pass
         if self.debug:
-            print("created file list with %u entries" % len(self.filelist))
+            print("created file list with %u entries" % len(filelist))
+        return True
 
     def parseFilename(self, filename):
         """Get lat/lon values from filename."""
@@ -210,74 +324,152 @@ class SRTMDownloader():
             lon = -lon
         return lat, lon
 
-    def getTile(self, lat, lon):
-        """Get a SRTM tile object. This function can return either an SRTM1 or
-            SRTM3 object depending on what is available, however currently it
-            only returns SRTM3 objects."""
-        global childFileListDownload
-        mypid = os.getpid()
-        if mypid in childFileListDownload and childFileListDownload[mypid].is_alive():
-            if self.debug:
-                print("still getting file list")
-            return 0
-        elif not self.filelist:
+    def tileFile(self, lat, lon):
+        """Return (continent, filename) of the tile for a lat/lon, 'ocean'
+            if there is no tile because it is all sea, or None if this
+            isn't known yet."""
+        if not self.filelist:
+            if get_fetcher().pending(('filelist', self.filelist_file)) is not None:
+                if self.debug:
+                    print("still getting file list")
+                return None
             if self.debug:
                 print("Filelist download complete, loading data ", self.filelist_file)
-            data = open(self.filelist_file, 'rb')
-            self.filelist = pickle.load(data)
-            data.close()
-
+            try:
+                data = open(self.filelist_file, 'rb')
+                self.filelist = pickle.load(data)
+                data.close()
+            except Exception:
+                self.retryFileList()
+                return None
         try:
-            continent, filename = self.filelist[(int(lat), int(lon))]
+            return self.filelist[(int(lat), int(lon))]
         except KeyError:
             if len(self.filelist) > self.min_filelist_len:
                 # we appear to have a full filelist - this must be ocean
-                return SRTMOceanTile(int(lat), int(lon))
-            return 0
+                return 'ocean'
+            self.retryFileList()
+            return None
 
-        global childTileDownload
-        mypid = os.getpid()
-        if not os.path.exists(os.path.join(self.cachedir, filename)):
-            if not mypid in childTileDownload or not childTileDownload[mypid].is_alive():
-                try:
-                    childTileDownload[mypid] = multiprocessing.Process(target=self.downloadTile, args=(str(continent), str(filename)))
-                    childTileDownload[mypid].start()
-                except Exception as ex:
-                    if mypid in childTileDownload:
-                        childTileDownload.pop(mypid)
-                    return 0
-                '''print "Getting Tile"'''
+    def fetchTile(self, lat, lon):
+        """Start downloading and converting the tile for a lat/lon in the
+            background. Returns a SRTMFuture, or None if there is nothing
+            to fetch. Fetches of the same tile are shared."""
+        tfile = self.tileFile(lat, lon)
+        if tfile is None or tfile == 'ocean':
+            return None
+        (continent, filename) = tfile
+        path = os.path.join(self.cachedir, filename)
+        if os.path.exists(path) and (raw_tile_ready(path) or path in self.unconvertible):
+            return None
+        key = (int(lat), int(lon))
+        future = get_fetcher().pending(('tile', path))
+        if future is not None:
+            return future
+        if time.time() - self.failed.get(key, 0) < self.retry_time:
+            return None
+        future = get_fetcher().submit(('tile', path), self.downloadTile, str(continent), str(filename), key)
+        def fetch_done(future):
+            if not future.result():
+                self.failed[key] = time.time()
+        future.add_done_callback(fetch_done)
+        return future
+
+    def waitTile(self, lat, lon, timeout):
+        """Wait up to timeout seconds for the file list and the tile for a
+            lat/lon to be fetched."""
+        t_end = time.time() + timeout
+        future = get_fetcher().pending(('filelist', self.filelist_file))
+        if future is not None:
+            future.wait(max(0, t_end - time.time()))
+        future = self.fetchTile(lat, lon)
+        if future is not None:
+            future.wait(max(0, t_end - time.time()))
+
+    def getTile(self, lat, lon):
+        """Get a SRTM tile object. This function can return either an SRTM1 or
+            SRTM3 object depending on what is available, however currently it
+            only returns SRTM3 objects. It never waits: if the tile has to be
+            downloaded or converted first, that is started in the background
+            and 0 is returned."""
+        tfile = self.tileFile(lat, lon)
+        if tfile is None:
             return 0
-        elif mypid in childTileDownload and childTileDownload[mypid].is_alive():
-            '''print "Still Getting Tile"'''
+        if tfile == 'ocean':
+            return SRTMOceanTile(int(lat), int(lon))
+        (continent, filename) = tfile
+        path = os.path.join(self.cachedir, filename)
+        if not os.path.exists(path) or not (raw_tile_ready(path) or path in self.unconvertible):
+            self.fetchTile(lat, lon)
             return 0
-        # TODO: Currently we create a new tile object each time.
-        # Caching is required for improved performance.
         try:
-            return SRTMTile(os.path.join(self.cachedir, filename), int(lat), int(lon))
+            return SRTMTile(path, int(lat), int(lon))
         except InvalidTileError:
             return 0
 
-    def downloadTile(self, continent, filename):
-        #Use HTTP
-        mp_util.child_close_fds()
-        if self.offline == 1:
-            return
-        filepath = "%s%s%s" % \
-                     (self.directory,continent,filename)
-        try:
-            data = self.getURIWithRedirect(filepath)
-            if data:
-                self.ftpfile = open(os.path.join(self.cachedir, filename), 'wb')
-                self.ftpfile.write(data)
-                self.ftpfile.close()
-                self.ftpfile = None
-        except Exception as e:
-            if not self.first_failure:
-                print("SRTM Download failed %s on server %s" % (filepath, self.server))
-                self.first_failure = True
-            pass
-
+    def downloadTile(self, continent, filename, key):
+        """Download a tile if needed and convert it, returning True if it
+            is ready to use. Run from the fetch threads."""
+        path = os.path.join(self.cachedir, filename)
+        if not os.path.exists(path):
+            #Use HTTP
+            if self.offline == 1:
+                return False
+            filepath = "%s%s%s" % \
+                         (self.directory,continent,filename)
+            try:
+                data = self.getURIWithRedirect(filepath)
+            except Exception:
+                data = None
+            if not data:
+                if not self.first_failure:
+                    print("SRTM Download failed %s on server %s" % (filepath, self.server))
+                    self.first_failure = True
+                return False
+            # another process or fetch thread may be downloading the
+            # same tile, so each writes its own temporary file
+            (fd, tmpname) = tempfile.mkstemp(dir=self.cachedir, prefix=filename, suffix='.tmp')
+            try:
+                ftpfile = os.fdopen(fd, 'wb')
+                ftpfile.write(data)
+                ftpfile.close()
+                os.chmod(tmpname, 0o644)
+                os.rename(tmpname, path)
+            except (OSError, IOError):
+                try:
+                    os.unlink(tmpname)
+                except OSError:
+                    pass
+                raise
+        # decompress it here, so the caller only has to map it
+        SRTMTile(path, key[0], key[1])
+        if not raw_tile_ready(path):
+            # the cache is read only, the caller will have to decompress it
+            self.unconvertible.add(path)
+        return True
+
+
+def raw_tile_path(f):
+    '''path of the decompressed copy of a .hgt.zip tile'''
+    if f.endswith('.zip'):
+        f = f[:-4]
+    return f + '.raw'
+
+def raw_tile_ready(f):
+    '''return True if a tile has an up to date decompressed copy'''
+    try:
+        return os.path.getmtime(raw_tile_path(f)) >= os.path.getmtime(f)
+    except OSError:
+        return False
+
+def tile_size(nbytes):
+    '''return the size of a tile with nbytes of data, or None if it
+    is not a SRTM1 or SRTM3 tile'''
+    size = int(math.sqrt(nbytes/2)) # 2 bytes per sample
+    # Currently only SRTM1/3 is supported
+    if size not in (1201, 3601) or size * size * 2 != nbytes:
+        return None
+    return size
 
 class SRTMTile:
     """Base class for all SRTM tiles.
@@ -286,26 +478,81 @@ class SRTMTile:
         This means there is a 1 pixel overlap between tiles. This makes it
         easier for as to interpolate the value, because for every point we
         only have to look at a single tile.
+
+        The first time a tile is used its .hgt.zip is decompressed into a
+        .raw file of little endian int16 samples next to it. After that
+        the .raw file is memory mapped, so tiles open quickly and the
+        processes using a tile share its pages.
         """
     def __init__(self, f, lat, lon):
+        self.lat = lat
+        self.lon = lon
+        self.data = self._map_raw(f)
+        if self.data is None:
+            self.data = self._convert(f)
+        self.size = int(math.sqrt(len(self.data)))
+
+    @staticmethod
+    def _map_raw(f):
+        '''memory map the decompressed copy of a tile, or return None if
+        there isn't an up to date one'''
+        raw = raw_tile_path(f)
+        try:
+            if os.path.getmtime(raw) < os.path.getmtime(f):
+                return None
+            h = open(raw, 'rb')
+        except (OSError, IOError):
+            return None
+        try:
+            nbytes = os.fstat(h.fileno()).st_size
+            if tile_size(nbytes) is None:
+                return None
+            m = mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            return None
+        finally:
+            h.close()
+        return np.frombuffer(m, dtype='<i2')
+
+    def _convert(self, f):
+        '''decompress a tile, saving a .raw copy if possible'''
         try:
             zipf = zipfile.ZipFile(f, 'r')
         except Exception:
-            raise InvalidTileError(lat, lon)
+            raise InvalidTileError(self.lat, self.lon)
         names = zipf.namelist()
         if len(names) != 1:
-            raise InvalidTileError(lat, lon)
+            raise InvalidTileError(self.lat, self.lon)
         data = zipf.read(names[0])
-        self.size = int(math.sqrt(len(data)/2)) # 2 bytes per sample
-        # Currently only SRTM1/3 is supported
-        if self.size not in (1201, 3601):
-            raise InvalidTileError(lat, lon)
-        self.data = array.array('h', data)
-        self.data.byteswap()
-        if len(self.data) != self.size * self.size:
-            raise InvalidTileError(lat, lon)
-        self.lat = lat
-        self.lon = lon
+        zipf.close()
+        if tile_size(len(data)) is None:
+            raise InvalidTileError(self.lat, self.lon)
+        # hgt files are big endian
+        samples = np.frombuffer(data, dtype='>i2').astype('<i2')
+        raw = raw_tile_path(f)
+        # other processes may be converting the same tile, so each
+        # writes its own temporary file
+        tmpname = None
+        try:
+            (fd, tmpname) = tempfile.mkstemp(dir=os.path.dirname(raw), prefix=os.path.basename(raw), suffix='.tmp')
+            h = os.fdopen(fd, 'wb')
+            h.write(samples.tostring())
+            h.close()
+            # mkstemp files are private, the cache may be shared
+            os.chmod(tmpname, 0o644)
+            os.rename(tmpname, raw)
+        except (OSError, IOError):
+            # the cache may be read only, use the copy in memory
+            if tmpname is not None:
+                try:
+                    os.unlink(tmpname)
+                except OSError:
+                    pass
+            return samples
+        mapped = self._map_raw(f)
+        if mapped is None:
+            return samples
+        return mapped
 
     @staticmethod
     def _avg(value1, value2, weight):
@@ -347,7 +594,7 @@ class SRTMTile:
         # Same as calcOffset, inlined for performance reasons
         offset = x + self.size * (self.size - y - 1)
         #print offset
-        value = self.data[offset]
+        value = int(self.data[offset])
         if value == -32768:
             return -1 # -32768 is a special value for areas with no data
         return value
@@ -382,6 +629,34 @@ class SRTMTile:
         #        value00, value10, value1, value01, value11, value2, value)
         return value
 
+    def getAltitudeArray(self, lats, lons):
+        """Get the altitudes of arrays of lat/lon points within this tile,
+            interpolating the same way as getAltitudeFromLatLon.
+        """
+        lat = np.asarray(lats, dtype=float) - self.lat
+        lon = np.asarray(lons, dtype=float) - self.lon
+        if np.any((lat < 0.0) | (lat >= 1.0) | (lon < 0.0) | (lon >= 1.0)):
+            bad = np.argmax((lat < 0.0) | (lat >= 1.0) | (lon < 0.0) | (lon >= 1.0))
+            raise WrongTileError(self.lat, self.lon, self.lat+lat[bad], self.lon+lon[bad])
+        x = lon * (self.size - 1)
+        y = lat * (self.size - 1)
+        x_int = x.astype(int)
+        x_frac = x - x_int
+        y_int = y.astype(int)
+        y_frac = y - y_int
+        # row 0 of the data is the northern edge
+        grid = self.data.reshape(self.size, self.size)
+        row0 = self.size - 1 - y_int
+        row1 = row0 - 1
+        samples = [grid[row0, x_int], grid[row0, x_int+1],
+                   grid[row1, x_int], grid[row1, x_int+1]]
+        # -32768 is a special value for areas with no data
+        (value00, value10, value01, value11) = [
+            np.where(v == -32768, -1, v).astype(float) for v in samples ]
+        value1 = value10 * x_frac + value00 * (1 - x_frac)
+        value2 = value11 * x_frac + value01 * (1 - x_frac)
+        return value2 * y_frac + value1 * (1 - y_frac)
+
 class SRTMOceanTile(SRTMTile):
     '''a tile for areas of zero altitude'''
     def __init__(self, lat, lon):
@@ -391,6 +666,9 @@ class SRTMOceanTile(SRTMTile):
     def getAltitudeFromLatLon(self, lat, lon):
         return 0
 
+    def getAltitudeArray(self, lats, lons):
+        return np.zeros(len(lats))
+
 
 class parseHTMLDirectoryListing(HTMLParser):
 
@@ -4,6 +4,10 @@
     output add 10.11.12.13:14550
     output list
     output remove 3      # to remove 3rd output
+    output filter 0 allow ATTITUDE,GLOBAL_POSITION_INT,HEARTBEAT
+    output filter 0 rate ATTITUDE 2
+    output filter 0 deny SCALED_*
+    output filter 0 clear
 '''
 
 from pymavlink import mavutil
@@ -11,12 +15,14 @@ from pymavlink import mavutil
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_msgfilter
 
 class OutputModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(OutputModule, self).__init__(mpstate, "output", "output control", public=True)
         self.add_command('output', self.cmd_output, "output control",
-                         ["<list|add|remove|sysid>"])
+                         ["<list|add|remove|sysid>",
+                          "filter (OUTPUT) <allow|deny|rate|clear|show>"])
 
     def cmd_output(self, args):
         '''handle output commands'''
@@ -37,20 +43,83 @@ class OutputModule(mp_module.MPModule):
                 print("Usage: output sysid SYSID OUTPUT")
                 return
             self.cmd_output_sysid(args[1:])
+        elif args[0] == "filter":
+            self.cmd_output_filter(args[1:])
         else:
-            print("usage: output <list|add|remove|sysid>")
+            print("usage: output <list|add|remove|sysid|filter>")
 
     def cmd_output_list(self):
         '''list outputs'''
         print("%u outputs" % len(self.mpstate.mav_outputs))
         for i in range(len(self.mpstate.mav_outputs)):
             conn = self.mpstate.mav_outputs[i]
-            print("%u: %s" % (i, conn.address))
+            print("%u: %s%s" % (i, conn.address, self.filter_string(conn)))
         if len(self.mpstate.sysid_outputs) > 0:
             print("%u sysid outputs" % len(self.mpstate.sysid_outputs))
             for sysid in self.mpstate.sysid_outputs:
                 conn = self.mpstate.sysid_outputs[sysid]
-                print("%u: %s" % (sysid, conn.address))
+                print("%u: %s%s" % (sysid, conn.address, self.filter_string(conn)))
+
+    def filter_string(self, conn):
+        '''return a description of the filter on an output'''
+        f = getattr(conn, 'msg_filter', None)
+        if f is None:
+            return ''
+        return ' [%s]' % str(f)
+
+    def find_output(self, device):
+        '''find an output by number or address'''
+        for i in range(len(self.mpstate.mav_outputs)):
+            conn = self.mpstate.mav_outputs[i]
+            if str(i) == device or conn.address == device:
+                return conn
+        for sysid in self.mpstate.sysid_outputs:
+            conn = self.mpstate.sysid_outputs[sysid]
+            if conn.address == device:
+                return conn
+        return None
+
+    def cmd_output_filter(self, args):
+        '''set message filtering rules for an output'''
+        usage = "usage: output filter OUTPUT <allow TYPES|deny TYPES|rate TYPE HZ|clear|show>"
+        if len(args) < 1:
+            print(usage)
+            return
+        conn = self.find_output(args[0])
+        if conn is None:
+            print("Unknown output %s" % args[0])
+            return
+        f = getattr(conn, 'msg_filter', None)
+        if len(args) < 2 or args[1] == "show":
+            if f is None:
+                print("%s: no filter" % conn.address)
+            else:
+                print("%s: %s" % (conn.address, str(f)))
+            return
+        if f is None:
+            f = mp_msgfilter.MsgFilter()
+        if args[1] == "clear":
+            f = None
+        elif args[1] in ["allow", "deny"] and len(args) == 3:
+            types = set([ t.upper() for t in args[2].split(',') ])
+            if args[1] == "allow":
+                f.allow_types.update(types)
+            else:
+                f.deny_types.update(types)
+        elif args[1] == "rate" and len(args) == 4:
+            rate = float(args[3])
+            if rate <= 0:
+                f.rates.pop(args[2].upper(), None)
+            else:
+                f.rates[args[2].upper()] = rate
+        else:
+            print(usage)
+            return
+        if f is not None and f.empty():
+            f = None
+        if f is not None:
+            f.compile(self.module('link').message_ids())
+        conn.msg_filter = f
 
     def cmd_output_add(self, args):
         '''add new output'''
@@ -269,6 +269,7 @@ class ParamState:
 class ParamModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(ParamModule, self).__init__(mpstate, "param", "parameter handling", public = True)
+        self.set_message_types(['PARAM_VALUE'])
         self.pstate = ParamState(self.mav_param, self.logdir, self.vehicle_name, 'mav.parm')
         self.add_command('param', self.cmd_param, "parameter handling",
                          ["<download|status>",
@@ -12,6 +12,7 @@ from MAVProxy.modules.lib import mp_module
 class PPPModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(PPPModule, self).__init__(mpstate, "ppp", "PPP link")
+        self.set_message_types(['PPP'])
         self.command = "noauth nodefaultroute nodetach nodeflate nobsdcomp mtu 128".split()
         self.packet_count = 0
         self.byte_count = 0
@@ -7,6 +7,7 @@ from MAVProxy.modules.lib import mp_module
 class SpeechModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(SpeechModule, self).__init__(mpstate, "speech", "speech output")
+        self.set_message_types(['STATUSTEXT'])
         self.add_command('speech', self.cmd_speech, "text-to-speech", ['<test>'])
 
         self.old_mpstate_say_function = self.mpstate.functions.say
@@ -2,36 +2,103 @@
   MAVProxy terrain handling module
 """
 
+import math
+import os
 import time
 
 from MAVProxy.modules.mavproxy_map import mp_elevation
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_terraincache
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_settings
 
+# bytes on the wire of a TERRAIN_DATA message
+TERRAIN_DATA_BYTES = 51
+
+# most outstanding TERRAIN_REQUESTs to keep
+MAX_REQUESTS = 8
+
+# most grid blocks to work out from SRTM on each send
+MAX_GRID_UPDATES = 1
+
+# seconds before working out again a grid block with missing heights
+# when no SRTM fetch is running for it
+NO_DATA_RETRY = 5.0
+
+class TerrainRequest(object):
+    '''a TERRAIN_REQUEST being answered'''
+    def __init__(self, msg):
+        self.lat = msg.lat
+        self.lon = msg.lon
+        self.grid_spacing = msg.grid_spacing
+        self.mask = msg.mask
+        self.sent = 0
+        self.time = time.time()
+        self.centres = None
+
+    def key(self):
+        return (self.lat, self.lon, self.grid_spacing)
+
+    def block_centre(self, bit):
+        '''lat/lon of the middle of a block'''
+        if self.centres is None:
+            self.centres = []
+            bit_spacing = self.grid_spacing * mp_terraincache.GRID_MAVLINK_SIZE
+            for b in range(mp_terraincache.GRID_BLOCKS):
+                self.centres.append(mp_util.gps_offset(self.lat * 1.0e-7, self.lon * 1.0e-7,
+                                                       east=bit_spacing * (b % mp_terraincache.GRID_BLOCK_MUL_Y + 0.5),
+                                                       north=bit_spacing * (b // mp_terraincache.GRID_BLOCK_MUL_Y + 0.5)))
+        return self.centres[bit]
+
+
 class TerrainModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(TerrainModule, self).__init__(mpstate, "terrain", "terrain handling", public=False)
+        self.set_message_types(['TERRAIN_REQUEST', 'TERRAIN_REPORT', 'RADIO_STATUS', 'GLOBAL_POSITION_INT'])
 
         self.ElevationModel = mp_elevation.ElevationModel()
-        self.current_request = None
-        self.sent_mask = 0
+        self.block_cache = mp_terraincache.TerrainBlockCache(
+            os.path.join(self.ElevationModel.downloader.cachedir, 'terrain_blocks.sqlite'))
+        # outstanding requests, keyed by grid block
+        self.requests = {}
+        # grid blocks with missing heights, keyed like requests, to
+        # (SRTM fetch futures, time) so they are not worked out again
+        # until their tiles have arrived
+        self.no_data = {}
+        self.grid_updates = MAX_GRID_UPDATES
         self.last_send_time = time.time()
+        self.last_tick = time.time()
+        self.send_credit = 0
+        # blocks per second, adjusted from RADIO_STATUS
+        self.send_rate = 5.0
+        self.txbuf = None
+        self.last_radio_status = 0
+        # (lat, lon, heading) of the vehicle
+        self.vehicle_pos = None
         self.requests_received = 0
         self.blocks_sent = 0
         self.check_lat = 0
         self.check_lon = 0
         self.add_command('terrain', self.cmd_terrain, "terrain control",
-                         ["<status|check>",
+                         ["<status|check|pregen>",
                           'set (TERRAINSETTING)'])
         self.terrain_settings = mp_settings.MPSettings(
-            [ ('debug', int, 0) ]
+            [ ('debug', int, 0),
+              ('minrate', float, 2.0),
+              ('maxrate', float, 50.0),
+              ('txbuf_low', int, 30),
+              ('txbuf_high', int, 60) ]
             )
         self.add_completion_function('(TERRAINSETTING)', self.terrain_settings.completion)
+        self.add_timer(0.05, self.terrain_timer)
+        # fetch the SRTM tiles for the mission, fence and home before
+        # they are needed
+        self.prefetching = set()
+        self.add_timer(10, self.prefetch_timer)
 
     def cmd_terrain(self, args):
         '''terrain command parser'''
-        usage = "usage: terrain <set|status|check>"
+        usage = "usage: terrain <set|status|check|pregen>"
         if len(args) == 0:
             print(usage)
             return
@@ -39,10 +106,24 @@ class TerrainModule(mp_module.MPModule):
             print("blocks_sent: %u requests_received: %u" % (
                 self.blocks_sent,
                 self.requests_received))
+            if self.txbuf is not None:
+                txbuf = "%u%%" % self.txbuf
+            else:
+                txbuf = "unknown"
+            print("requests: %u send rate: %.1f/s radio txbuf: %s" % (
+                len(self.requests),
+                self.current_send_rate(),
+                txbuf))
+            print("block cache: %u grids, %u hits %u misses" % (
+                len(self.block_cache),
+                self.block_cache.hits,
+                self.block_cache.misses))
         elif args[0] == "set":
             self.terrain_settings.command(args[1:])
         elif args[0] == "check":
             self.cmd_terrain_check(args[1:])
+        elif args[0] == "pregen":
+            self.cmd_terrain_pregen(args[1:])
         else:
             print(usage)
 
@@ -63,15 +144,159 @@ class TerrainModule(mp_module.MPModule):
         self.check_lon = int(latlon[1]*1e7)
         self.master.mav.terrain_check_send(self.check_lat, self.check_lon)
 
+    def pregen_points(self):
+        '''positions to generate terrain around: home, the mission with
+        points along each leg, and the fence'''
+        points = []
+        try:
+            home = self.module('wp').get_home()
+            if home is not None:
+                points.append((home.x, home.y))
+            mission = self.module('wp').wploader.polygon()
+        except Exception:
+            mission = []
+        for i in range(len(mission)):
+            points.append(mission[i])
+            if i == 0:
+                continue
+            (lat1, lon1) = mission[i-1]
+            (lat2, lon2) = mission[i]
+            dist = mp_util.gps_distance(lat1, lon1, lat2, lon2)
+            bearing = mp_util.gps_bearing(lat1, lon1, lat2, lon2)
+            d = 500.0
+            while d < dist:
+                points.append(mp_util.gps_newpos(lat1, lon1, bearing, d))
+                d += 500.0
+        try:
+            points.extend(self.module('fence').fenceloader.polygon())
+        except Exception:
+            pass
+        return [ (lat, lon) for (lat, lon) in points if lat != 0 or lon != 0 ]
+
+    def cmd_terrain_pregen(self, args):
+        '''generate grid blocks covering the mission, fence and home'''
+        margin = 1000.0
+        grid_spacing = self.get_mav_param('TERRAIN_SPACING', 100)
+        if len(args) > 0:
+            margin = float(args[0])
+        if len(args) > 1:
+            grid_spacing = int(args[1])
+        grid_spacing = int(grid_spacing)
+        points = self.pregen_points()
+        if len(points) == 0:
+            print("No mission, fence or home to generate terrain for")
+            return
+        step = grid_spacing * mp_terraincache.GRID_BLOCK_SPACING_X * 0.5
+        corners = set()
+        for (lat, lon) in points:
+            north = -margin
+            while north <= margin + step:
+                east = -margin
+                while east <= margin + step:
+                    (lat2, lon2) = mp_util.gps_offset(lat, lon, east, north)
+                    corners.add(mp_terraincache.grid_block_corner(lat2, lon2, grid_spacing))
+                    east += step
+                north += step
+        generated = 0
+        incomplete = 0
+        for (lat, lon) in sorted(corners):
+            blocks = self.block_cache.get(lat, lon, grid_spacing)
+            if blocks is None or None in blocks:
+                blocks = self.update_grid_block(lat, lon, grid_spacing)
+                generated += 1
+            if None in blocks:
+                incomplete += 1
+        print("Terrain: %u grid blocks at %um spacing, %u generated, %u incomplete" % (
+            len(corners), grid_spacing, generated, incomplete))
+
+    def prefetch_done(self, future):
+        '''called from the SRTM fetch thread when a prefetch finishes'''
+        self.prefetching.discard(future)
+        if self.terrain_settings.debug:
+            print("SRTM prefetch done, %u left" % len(self.prefetching))
+
+    def prefetch_timer(self):
+        '''start fetching SRTM tiles covering the mission, fence and home'''
+        points = self.pregen_points()
+        if len(points) == 0:
+            return
+        for future in self.ElevationModel.Prefetch(points, margin=2000):
+            if not future in self.prefetching:
+                self.prefetching.add(future)
+                future.add_done_callback(self.prefetch_done)
+
+    def update_grid_block(self, lat, lon, grid_spacing):
+        '''work out the heights of a grid block and cache them. If some
+        are missing, start fetching the SRTM tiles under the grid block'''
+        blocks = mp_terraincache.compute_grid_block(self.ElevationModel, lat, lon, grid_spacing)
+        if blocks.count(None) != len(blocks):
+            self.block_cache.put(lat, lon, grid_spacing, blocks)
+        key = (lat, lon, grid_spacing)
+        if None in blocks:
+            corners = []
+            for north in (0, mp_terraincache.GRID_BLOCK_MUL_X):
+                for east in (0, mp_terraincache.GRID_BLOCK_MUL_Y):
+                    corners.append(mp_util.gps_offset(lat * 1.0e-7, lon * 1.0e-7,
+                                                      east=east * mp_terraincache.GRID_MAVLINK_SIZE * grid_spacing,
+                                                      north=north * mp_terraincache.GRID_MAVLINK_SIZE * grid_spacing))
+            self.no_data[key] = (self.ElevationModel.Prefetch(corners), time.time())
+        else:
+            self.no_data.pop(key, None)
+        return blocks
+
+    def grid_waiting(self, key):
+        '''see if a grid block with missing heights is still waiting for
+        its SRTM tiles'''
+        if not key in self.no_data:
+            return False
+        (futures, t) = self.no_data[key]
+        if len(futures) > 0:
+            waiting = False in [ f.done() for f in futures ]
+        else:
+            waiting = time.time() - t < NO_DATA_RETRY
+        if not waiting:
+            self.no_data.pop(key)
+        return waiting
+
+    def grid_block(self, lat, lon, grid_spacing, bit):
+        '''return the 16 heights of a block of a grid block, or None if
+        they are not known yet. Grid blocks with missing heights are only
+        worked out again once their SRTM tiles arrive, and at most
+        grid_updates of them are worked out between sends'''
+        blocks = self.block_cache.get(lat, lon, grid_spacing)
+        if blocks is not None and blocks[bit] is not None:
+            return blocks[bit]
+        if self.grid_updates <= 0 or self.grid_waiting((lat, lon, grid_spacing)):
+            return None
+        self.grid_updates -= 1
+        blocks = self.update_grid_block(lat, lon, grid_spacing)
+        return blocks[bit]
+
     def mavlink_packet(self, msg):
         '''handle an incoming mavlink packet'''
         type = msg.get_type()
         master = self.master
         # add some status fields
         if type == 'TERRAIN_REQUEST':
-            self.current_request = msg
-            self.sent_mask = 0
             self.requests_received += 1
+            request = TerrainRequest(msg)
+            old = self.requests.pop(request.key(), None)
+            if old is not None and old.centres is not None:
+                request.centres = old.centres
+            # a repeated request lists the blocks still missing, so they
+            # are all sent again
+            self.requests[request.key()] = request
+            while len(self.requests) > MAX_REQUESTS:
+                oldest = min(self.requests.values(), key=lambda r: r.time)
+                self.requests.pop(oldest.key())
+        elif type == 'RADIO_STATUS':
+            self.update_send_rate(msg.txbuf)
+        elif type == 'GLOBAL_POSITION_INT':
+            if self.target_system == 0 or msg.get_srcSystem() == self.target_system:
+                heading = None
+                if msg.hdg != 65535:
+                    heading = msg.hdg * 0.01
+                self.vehicle_pos = (msg.lat * 1.0e-7, msg.lon * 1.0e-7, heading)
         elif type == 'TERRAIN_REPORT':
             if (msg.lat == self.check_lat and
                 msg.lon == self.check_lon and
@@ -80,63 +305,120 @@ class TerrainModule(mp_module.MPModule):
                 self.check_lat = 0
                 self.check_lon = 0
 
-    def send_terrain_data_bit(self, bit):
-        '''send some terrain data'''
-        lat = self.current_request.lat * 1.0e-7
-        lon = self.current_request.lon * 1.0e-7
-        bit_spacing = self.current_request.grid_spacing * 4
-        (lat, lon) = mp_util.gps_offset(lat, lon,
-                                        east=bit_spacing * (bit % 8),
-                                        north=bit_spacing * (bit // 8))
-        data = []
-        for i in range(4*4):
-            y = i % 4
-            x = i // 4
-            (lat2,lon2) = mp_util.gps_offset(lat, lon,
-                                             east=self.current_request.grid_spacing * y,
-                                             north=self.current_request.grid_spacing * x)
-            alt = self.ElevationModel.GetElevation(lat2, lon2)
-            if alt is None:
-                if self.terrain_settings.debug:
-                    print("no alt ", lat2, lon2)
-                return
-            data.append(int(alt))
-        self.master.mav.terrain_data_send(self.current_request.lat,
-                                          self.current_request.lon,
-                                          self.current_request.grid_spacing,
+    def send_terrain_data_bit(self, request, bit):
+        '''send one block of terrain data, returning True if it was sent'''
+        data = self.grid_block(request.lat, request.lon, request.grid_spacing, bit)
+        if data is None:
+            if self.terrain_settings.debug:
+                print("no alt ", request.lat, request.lon, bit)
+            return False
+        self.master.mav.terrain_data_send(request.lat,
+                                          request.lon,
+                                          request.grid_spacing,
                                           bit,
                                           data)
         self.blocks_sent += 1
         self.last_send_time = time.time()
-        self.sent_mask |= 1<<bit
+        request.sent |= 1<<bit
         if self.terrain_settings.debug and bit == 55:
-            lat = self.current_request.lat * 1.0e-7
-            lon = self.current_request.lon * 1.0e-7
+            lat = request.lat * 1.0e-7
+            lon = request.lon * 1.0e-7
             print("--lat=%f --lon=%f %.1f" % (
                 lat, lon, self.ElevationModel.GetElevation(lat, lon)))
             (lat2,lon2) = mp_util.gps_offset(lat, lon,
-                                             east=32*self.current_request.grid_spacing,
-                                             north=28*self.current_request.grid_spacing)
+                                             east=32*request.grid_spacing,
+                                             north=28*request.grid_spacing)
             print("--lat=%f --lon=%f %.1f" % (
                 lat2, lon2, self.ElevationModel.GetElevation(lat2, lon2)))
+        return True
 
+    def block_priority(self, request, bit):
+        '''priority of a block, lower is sooner. Blocks close to the
+        vehicle come first, and blocks ahead of it before those behind'''
+        if self.vehicle_pos is None:
+            # no position yet, take the newest request in block order
+            return (-request.time, bit)
+        (lat, lon, heading) = self.vehicle_pos
+        (blat, blon) = request.block_centre(bit)
+        # flat earth approximation is fine over a grid block
+        north = (blat - lat) * 111319.5
+        east = (blon - lon) * 111319.5 * math.cos(math.radians(lat))
+        dist = math.sqrt(north**2 + east**2)
+        if dist > 0 and heading is not None:
+            ahead = (north * math.cos(math.radians(heading)) + east * math.sin(math.radians(heading))) / dist
+            dist *= 1.5 - 0.5 * ahead
+        return (dist, bit)
 
-    def send_terrain_data(self):
-        '''send some terrain data'''
-        for bit in range(56):
-            if self.current_request.mask & (1<<bit) and self.sent_mask & (1<<bit) == 0:
-                self.send_terrain_data_bit(bit)
-                return
-        # no bits to send
-        self.current_request = None
-        self.sent_mask = 0
+    def next_blocks(self):
+        '''return the unsent (request, bit) pairs in the order to send them'''
+        blocks = []
+        for request in self.requests.values():
+            pending = request.mask & ~request.sent
+            if pending == 0:
+                continue
+            for bit in range(mp_terraincache.GRID_BLOCKS):
+                if pending & (1<<bit):
+                    blocks.append((self.block_priority(request, bit), request, bit))
+        blocks.sort(key=lambda b: b[0])
+        return [ (request, bit) for (priority, request, bit) in blocks ]
+
+    def link_rate_limit(self):
+        '''the most blocks per second a serial link can carry, leaving room
+        for other traffic, or None if the link speed is unknown'''
+        baud = getattr(self.master, 'baud', None)
+        if not baud:
+            return None
+        # about 10 bits per byte, and use at most half of the link
+        return 0.5 * baud / (10.0 * TERRAIN_DATA_BYTES)
 
-    def idle_task(self):
-        '''called when idle'''
-        if self.current_request is None:
+    def update_send_rate(self, txbuf):
+        '''adjust the send rate from the free space in the radio transmit
+        buffer: back off quickly when it fills, and speed up slowly while
+        there is plenty of room'''
+        self.txbuf = txbuf
+        self.last_radio_status = time.time()
+        if txbuf < self.terrain_settings.txbuf_low:
+            self.send_rate = max(self.terrain_settings.minrate, self.send_rate * 0.5)
+        elif txbuf > self.terrain_settings.txbuf_high:
+            self.send_rate = min(self.terrain_settings.maxrate, self.send_rate + 1)
+
+    def current_send_rate(self):
+        '''blocks per second to send now'''
+        if time.time() - self.last_radio_status < 5:
+            rate = self.send_rate
+        else:
+            # no radio reporting its buffer, so assume a fast link
+            rate = self.terrain_settings.maxrate
+        limit = self.link_rate_limit()
+        if limit is not None:
+            rate = min(rate, limit)
+        return max(rate, self.terrain_settings.minrate)
+
+    def send_terrain_data(self):
+        '''send as much terrain data as the send rate allows'''
+        now = time.time()
+        rate = self.current_send_rate()
+        self.send_credit = min(self.send_credit + rate * (now - self.last_tick), max(1.0, rate * 0.2))
+        self.last_tick = now
+        if self.send_credit < 1:
             return
-        if time.time() - self.last_send_time < 0.2:
-            # limit to 5 per second
+        self.grid_updates = MAX_GRID_UPDATES
+        for (request, bit) in self.next_blocks():
+            if self.send_credit < 1:
+                break
+            if self.send_terrain_data_bit(request, bit):
+                self.send_credit -= 1
+        # drop requests that have been fully sent
+        for key in list(self.requests.keys()):
+            request = self.requests[key]
+            if request.mask & ~request.sent == 0:
+                self.requests.pop(key)
+
+    def terrain_timer(self):
+        '''called regularly to send pending terrain data'''
+        if len(self.requests) == 0:
+            self.last_tick = time.time()
+            self.send_credit = 0
             return
         self.send_terrain_data()
 
@@ -11,6 +11,10 @@ if mp_util.has_wxpython:
 class WPModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(WPModule, self).__init__(mpstate, "wp", "waypoint handling", public = True)
+        self.set_message_types(['WAYPOINT_COUNT', 'MISSION_COUNT', 'WAYPOINT',
+                                'MISSION_ITEM', 'WAYPOINT_REQUEST',
+                                'MISSION_REQUEST', 'WAYPOINT_CURRENT',
+                                'MISSION_CURRENT', 'MISSION_ITEM_REACHED'])
         self.wp_op = None
         self.wp_requested = {}
         self.wp_received = {}
@@ -19,7 +23,7 @@ class WPModule(mp_module.MPModule):
         self.loading_waypoints = False
         self.loading_waypoint_lasttime = time.time()
         self.last_waypoint = 0
-        self.wp_period = mavutil.periodic_event(0.5)
+        self.add_timer(2.0, self.check_missing_wps)
         self.undo_wp = None
         self.undo_type = None
         self.undo_wp_idx = -1
@@ -153,14 +157,16 @@ class WPModule(mp_module.MPModule):
                     if alt_offset > 0.005:
                         self.say("ALT OFFSET IS NOT ZERO passing DO_LAND_START")
 
+    def check_missing_wps(self):
+        '''handle missing waypoints, called at 0.5Hz'''
+        # cope with packet loss fetching mission
+        if self.master is not None and self.master.time_since('MISSION_ITEM') >= 2 and self.wploader.count() < getattr(self.wploader,'expected_count',0):
+            wps = self.missing_wps_to_request();
+            print("re-requesting WPs %s" % str(wps))
+            self.send_wp_requests(wps)
+
     def idle_task(self):
-        '''handle missing waypoints'''
-        if self.wp_period.trigger():
-            # cope with packet loss fetching mission
-            if self.master is not None and self.master.time_since('MISSION_ITEM') >= 2 and self.wploader.count() < getattr(self.wploader,'expected_count',0):
-                wps = self.missing_wps_to_request();
-                print("re-requesting WPs %s" % str(wps))
-                self.send_wp_requests(wps)
+        '''called on idle'''
         if self.module('console') is not None and not self.menu_added_console:
             self.menu_added_console = True
             self.module('console').add_menu(self.menu)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+'''
+unit tests for the redundant link duplicate detector
+
+    python -m unittest MAVProxy.tests.test_dedup
+'''
+
+import unittest
+
+from MAVProxy.modules.lib import mp_dedup
+
+HEARTBEAT = 0
+ATTITUDE = 30
+
+class MAVDedupTest(unittest.TestCase):
+    '''MAVDedup.check() and loss()'''
+
+    def setUp(self):
+        self.dedup = mp_dedup.MAVDedup(window=128, timeout=2.0)
+        self.link1 = self.dedup.link_stats()
+        self.link2 = self.dedup.link_stats()
+
+    def test_first_copy(self):
+        '''only the first copy of a packet is passed, from either link'''
+        self.assertTrue(self.dedup.check(self.link1, 1, 1, 5, ATTITUDE, 10.0))
+        self.assertFalse(self.dedup.check(self.link2, 1, 1, 5, ATTITUDE, 10.1))
+        self.assertFalse(self.dedup.check(self.link1, 1, 1, 5, ATTITUDE, 10.2))
+        self.assertTrue(self.dedup.check(self.link2, 1, 1, 6, ATTITUDE, 10.3))
+        self.assertEqual(self.dedup.unique, 2)
+        self.assertEqual(self.dedup.duplicates, 2)
+
+    def test_key(self):
+        '''seq, msgid and source all make a packet distinct'''
+        self.assertTrue(self.dedup.check(self.link1, 1, 1, 5, ATTITUDE, 10.0))
+        self.assertTrue(self.dedup.check(self.link1, 1, 1, 5, HEARTBEAT, 10.0))
+        self.assertTrue(self.dedup.check(self.link1, 2, 1, 5, ATTITUDE, 10.0))
+        self.assertTrue(self.dedup.check(self.link1, 1, 2, 5, ATTITUDE, 10.0))
+        self.assertFalse(self.dedup.check(self.link2, 2, 1, 5, ATTITUDE, 10.0))
+
+    def test_timeout(self):
+        '''a copy older than the timeout is a new packet'''
+        self.assertTrue(self.dedup.check(self.link1, 1, 1, 5, ATTITUDE, 10.0))
+        self.assertFalse(self.dedup.check(self.link2, 1, 1, 5, ATTITUDE, 12.0))
+        self.assertTrue(self.dedup.check(self.link2, 1, 1, 5, ATTITUDE, 12.5))
+        # the timeout restarts from the newer copy
+        self.assertFalse(self.dedup.check(self.link1, 1, 1, 5, ATTITUDE, 13.0))
+
+    def test_window(self):
+        '''packets drop out of the window once it is full'''
+        for seq in range(129):
+            self.assertTrue(self.dedup.check(self.link1, 1, 1, seq, ATTITUDE, 10.0))
+        # seq 0 has been pushed out, seq 1 is still remembered
+        self.assertTrue(self.dedup.check(self.link2, 1, 1, 0, ATTITUDE, 10.1))
+        self.assertFalse(self.dedup.check(self.link2, 1, 1, 2, ATTITUDE, 10.1))
+
+    def test_seq_wrap(self):
+        '''a wrapped sequence number is not mistaken for a duplicate,
+        even well inside the timeout'''
+        for n in range(600):
+            self.assertTrue(self.dedup.check(self.link1, 1, 1, n % 256, ATTITUDE, 10.0 + n*0.001))
+            self.assertFalse(self.dedup.check(self.link2, 1, 1, n % 256, ATTITUDE, 10.0005 + n*0.001))
+        self.assertEqual(self.dedup.unique, 600)
+        self.assertEqual(self.dedup.duplicates, 600)
+
+    def test_link_stats(self):
+        '''per link counts and delay to the first copy'''
+        for seq in range(10):
+            self.dedup.check(self.link1, 1, 1, seq, ATTITUDE, 10.0 + seq)
+            self.dedup.check(self.link2, 1, 1, seq, ATTITUDE, 10.1 + seq)
+        self.assertEqual((self.link1.seen, self.link1.first, self.link1.dups), (10, 10, 0))
+        self.assertEqual((self.link2.seen, self.link2.first, self.link2.dups), (10, 0, 10))
+        self.assertEqual(self.link1.delay_avg, 0.0)
+        self.assertAlmostEqual(self.link2.delay_max, 0.1)
+        self.assertTrue(0.0 < self.link2.delay_avg < 0.1)
+
+    def test_loss(self):
+        '''share of unique packets a link did not deliver'''
+        self.assertEqual(self.dedup.loss(self.link1), 0.0)
+        for seq in range(10):
+            self.dedup.check(self.link1, 1, 1, seq, ATTITUDE, 10.0)
+            if seq % 2 == 0:
+                self.dedup.check(self.link2, 1, 1, seq, ATTITUDE, 10.1)
+        self.assertAlmostEqual(self.dedup.loss(self.link1), 0.0)
+        self.assertAlmostEqual(self.dedup.loss(self.link2), 50.0)
+
+    def test_loss_new_link(self):
+        '''a link added later is only measured from when it was added'''
+        for seq in range(10):
+            self.dedup.check(self.link1, 1, 1, seq, ATTITUDE, 10.0)
+        link3 = self.dedup.link_stats()
+        self.assertEqual(self.dedup.loss(link3), 0.0)
+        for seq in range(10, 20):
+            self.dedup.check(link3, 1, 1, seq, ATTITUDE, 11.0)
+            if seq % 4 == 0:
+                self.dedup.check(self.link1, 1, 1, seq, ATTITUDE, 11.1)
+        self.assertAlmostEqual(self.dedup.loss(link3), 0.0)
+        self.assertAlmostEqual(self.dedup.loss(self.link1), 40.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+'''
+duplicate removal with two links to the same vehicle
+
+runs mavproxy.py headless with two UDP masters and sends every packet
+of a synthetic vehicle to both, always to the second link after the
+first. With duplicate removal the second link only ever delivers
+duplicates, and it must still be seen as up.
+
+    python -m unittest MAVProxy.tests.test_link_dedup
+'''
+
+import os, sys, time, socket, signal, subprocess, tempfile, shutil
+import unittest
+
+def free_port():
+    '''return a free local UDP port'''
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+class LinkDedupTest(unittest.TestCase):
+    '''the slower of two healthy links stays up'''
+    duration = 8
+
+    def run_two_links(self, cmds):
+        '''feed two links for duration seconds, returning mavproxy's output'''
+        from pymavlink import mavutil
+        ports = [ free_port(), free_port() ]
+        tmpdir = tempfile.mkdtemp(prefix='test_link_dedup')
+        cmd = [ sys.executable, '-m', 'MAVProxy.mavproxy',
+                '--master=udpin:127.0.0.1:%u' % ports[0],
+                '--master=udpin:127.0.0.1:%u' % ports[1],
+                '--daemon', '--nowait',
+                '--state-basedir=%s' % tmpdir,
+                '--default-modules=link',
+                '--cmd=%s' % cmds ]
+        out = tempfile.TemporaryFile()
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=out, stderr=subprocess.STDOUT,
+                                cwd=tmpdir, preexec_fn=os.setsid)
+        try:
+            time.sleep(2)
+            mav = mavutil.mavlink.MAVLink(None, srcSystem=1, srcComponent=1)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            start = time.time()
+            n = 0
+            while time.time() - start < self.duration:
+                ms = int((time.time() - start) * 1000)
+                msgs = [ mav.attitude_encode(ms, 0, 0, 0, 0, 0, 0),
+                         mav.sys_status_encode(0, 0, 0, 500, 12000, 100, 80, 0, 0, 0, 0, 0, 0) ]
+                if n % 10 == 0:
+                    msgs.append(mav.heartbeat_encode(2, 3, 81, 0, 4))
+                for m in msgs:
+                    buf = bytes(m.pack(mav))
+                    # pack() doesn't advance the sequence number, only send() does
+                    mav.seq = (mav.seq + 1) % 256
+                    sock.sendto(buf, ('127.0.0.1', ports[0]))
+                    time.sleep(0.002)
+                    sock.sendto(buf, ('127.0.0.1', ports[1]))
+                n += 1
+                time.sleep(0.1)
+            sock.close()
+        finally:
+            try:
+                os.killpg(proc.pid, signal.SIGTERM)
+            except OSError:
+                pass
+            proc.wait()
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        out.seek(0)
+        return out.read()
+
+    def test_slow_link_up(self):
+        output = self.run_two_links('set dedup 1')
+        self.assertTrue('online system 1' in output, output)
+        self.assertFalse('link 2 down' in output, output)
+
+    def test_slow_link_up_fastfwd(self):
+        output = self.run_two_links('set dedup 1;set fastfwd 1')
+        self.assertTrue('online system 1' in output, output)
+        self.assertFalse('link 2 down' in output, output)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+'''
+unit tests for the per-link send queues
+
+    python -m unittest MAVProxy.tests.test_sendqueue
+'''
+
+import errno, os, socket
+import unittest
+
+from MAVProxy.modules.lib import mp_sendqueue
+
+HEARTBEAT = 0
+PARAM_VALUE = 22
+ATTITUDE = 30
+
+PRIORITIES = { HEARTBEAT : mp_sendqueue.PRIO_CRITICAL,
+               ATTITUDE : mp_sendqueue.PRIO_STREAM }
+
+def frame(msgid, n, length=20):
+    '''a MAVLink1 shaped frame of the given msgid, with n in its payload'''
+    payload = bytearray([ (n + i) & 0xFF for i in range(length) ])
+    return bytes(bytearray([ 0xFE, length, n & 0xFF, 1, 1, msgid ]) + payload + bytearray([0, 0]))
+
+class DatagramConn(object):
+    '''a connection that takes one frame per write'''
+    def __init__(self):
+        self.sent = []
+
+    def write(self, buf):
+        self.sent.append(buf)
+
+
+class FakeSocket(object):
+    '''a non-blocking socket taking at most accept bytes per send'''
+    def __init__(self, accept):
+        self.accept = accept
+        self.data = b''
+        self.sends = 0
+        self.error = None
+
+    def send(self, data):
+        self.sends += 1
+        if self.error is not None:
+            raise socket.error(self.error, os.strerror(self.error))
+        if self.accept == 0:
+            raise socket.error(errno.EAGAIN, 'would block')
+        n = min(self.accept, len(data))
+        self.data += data[:n]
+        return n
+
+
+class StreamConn(object):
+    '''a TCP style connection'''
+    def __init__(self, accept):
+        self.port = FakeSocket(accept)
+        self.disconnects = 0
+
+    def write(self, buf):
+        self.port.send(buf)
+
+    def handle_disconnect(self):
+        self.disconnects += 1
+
+
+class SerialConn(object):
+    '''a serial style connection writing to a file descriptor'''
+    def __init__(self, fd):
+        self.fd = fd
+        self.portdead = False
+        self.autoreconnect = False
+
+    def write(self, buf):
+        return os.write(self.fd, buf)
+
+
+class SendQueueTest(unittest.TestCase):
+    '''MPSendQueue draining and shedding'''
+
+    def test_datagram_drain(self):
+        '''a datagram queue sends every frame and ends up empty'''
+        conn = DatagramConn()
+        q = mp_sendqueue.MPSendQueue(conn, 'udp', priorities=PRIORITIES, datagram=True)
+        frames = [ frame([ATTITUDE, HEARTBEAT, PARAM_VALUE][i % 3], i) for i in range(10) ]
+        for f in frames:
+            conn.write(f)
+        self.assertEqual(conn.sent, [])
+        self.assertEqual(q.pending(), sum([ len(f) for f in frames ]))
+        self.assertEqual(q.drain(), sum([ len(f) for f in frames ]))
+        self.assertEqual(conn.sent, frames)
+        self.assertEqual(q.pending(), 0)
+        self.assertEqual(q.frames_out, 10)
+        self.assertEqual(q.drain(), 0)
+        q.unwrap()
+        self.assertEqual(q.pending(), 0)
+
+    def test_stream_drain(self):
+        '''a stream queue joins frames into writes of up to max_write'''
+        conn = StreamConn(accept=100000)
+        q = mp_sendqueue.MPSendQueue(conn, 'tcp', priorities=PRIORITIES, max_write=100)
+        frames = [ frame(ATTITUDE, i) for i in range(10) ]
+        for f in frames:
+            conn.write(f)
+        # 28 byte frames, three to a write
+        self.assertEqual(q.drain(), 84)
+        self.assertEqual(q.drain(limit=None), 196)
+        self.assertEqual(conn.port.data, b''.join(frames))
+        self.assertEqual(q.pending(), 0)
+        self.assertEqual(q.drain(), 0)
+
+    def test_partial_write(self):
+        '''short writes keep the rest of the data in order, and a would
+        block write loses nothing'''
+        conn = StreamConn(accept=0)
+        q = mp_sendqueue.MPSendQueue(conn, 'tcp', priorities=PRIORITIES)
+        frames = [ frame([ATTITUDE, HEARTBEAT][i % 2], i) for i in range(10) ]
+        for f in frames:
+            conn.write(f)
+        total = q.pending()
+        self.assertEqual(q.drain(), 0)
+        self.assertEqual(q.pending(), total)
+        conn.port.accept = 17
+        while q.pending() > 0:
+            n = q.drain()
+            self.assertTrue(n <= 17)
+        self.assertEqual(conn.port.data, b''.join(frames))
+        self.assertEqual(q.frames_out, 10)
+        self.assertEqual(q.dropped, 0)
+
+    def test_partial_frame_not_shed(self):
+        '''the rest of a partly written frame is written even when the
+        queue is over its limit'''
+        conn = StreamConn(accept=10)
+        q = mp_sendqueue.MPSendQueue(conn, 'tcp', limit=60, priorities=PRIORITIES)
+        first = frame(ATTITUDE, 0)
+        conn.write(first)
+        q.drain()
+        for i in range(1, 5):
+            conn.write(frame(ATTITUDE, i))
+        conn.port.accept = 100000
+        q.drain(limit=None)
+        self.assertEqual(conn.port.data[:len(first)], first)
+        self.assertEqual((len(conn.port.data) - len(first)) % len(first), 0)
+
+    def test_shedding(self):
+        '''streaming frames go first, critical frames are never dropped'''
+        conn = DatagramConn()
+        q = mp_sendqueue.MPSendQueue(conn, 'udp', limit=28*6, priorities=PRIORITIES, datagram=True)
+        for i in range(6):
+            conn.write(frame(HEARTBEAT, i))
+        for i in range(6):
+            conn.write(frame(ATTITUDE, i))
+        for i in range(3):
+            conn.write(frame(PARAM_VALUE, i))
+        self.assertTrue(q.pending() <= q.limit)
+        q.drain()
+        ids = [ mp_sendqueue.frame_msgid(b) for b in conn.sent ]
+        self.assertEqual(ids.count(HEARTBEAT), 6)
+        self.assertEqual(ids.count(ATTITUDE), 0)
+        self.assertEqual(q.dropped, 9)
+        for i in range(8):
+            conn.write(frame(HEARTBEAT, i))
+        self.assertEqual(q.pending(), 8*28)
+        self.assertEqual(q.drain(), 8*28)
+
+    def test_socket_error(self):
+        '''a failed write is dropped and handed to the connection once,
+        without writing the data again'''
+        conn = StreamConn(accept=100000)
+        q = mp_sendqueue.MPSendQueue(conn, 'tcp', priorities=PRIORITIES)
+        conn.write(frame(ATTITUDE, 0))
+        conn.port.error = errno.ECONNRESET
+        self.assertEqual(q.drain(), 0)
+        self.assertEqual(conn.port.sends, 1)
+        self.assertEqual(conn.disconnects, 1)
+        self.assertEqual(q.errors, 1)
+        self.assertEqual(q.dropped, 1)
+        self.assertEqual(q.pending(), 0)
+
+    def test_serial_nonblocking(self):
+        '''a serial port fd is written without blocking when it is full'''
+        (rfd, wfd) = os.pipe()
+        try:
+            conn = SerialConn(wfd)
+            q = mp_sendqueue.MPSendQueue(conn, 'serial', limit=10000000, priorities=PRIORITIES,
+                                         serial=True, max_write=512)
+            frames = [ frame(HEARTBEAT, i, length=200) for i in range(2000) ]
+            for f in frames:
+                conn.write(f)
+            total = q.pending()
+            # more than a pipe holds, so the fd fills up part way
+            while q.drain() > 0:
+                pass
+            self.assertTrue(0 < q.pending() < total)
+            received = b''
+            while q.pending() > 0:
+                received += os.read(rfd, 65536)
+                q.drain(limit=None)
+            q.unwrap()
+            while len(received) < total:
+                received += os.read(rfd, 65536)
+            self.assertEqual(received, b''.join(frames))
+        finally:
+            os.close(rfd)
+            os.close(wfd)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+'''
+map tile downloader against a local HTTP tile server
+
+starts a BaseHTTPServer stand-in for a tile service on a local port
+and checks the order tiles are fetched in, cancellation, the
+per-service rate limit and keep-alive connection reuse.
+
+    python -m unittest MAVProxy.tests.test_tile_downloader
+'''
+
+import BaseHTTPServer
+import SocketServer
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from MAVProxy.modules.mavproxy_map import mp_tile_downloader
+from MAVProxy.modules.mavproxy_map import mp_tilestore
+
+SERVICE = 'TestService'
+
+class TileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''serve a small fake image for any path, recording each request'''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.log_request_made(self.path, self.client_address)
+        body = b'IMG' + self.path.encode('ascii')
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''local tile server'''
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), TileHandler)
+        self.lock = threading.Lock()
+        # (time, path, client address) of each request
+        self.requests = []
+
+    def log_request_made(self, path, client_address):
+        with self.lock:
+            self.requests.append((time.time(), path, client_address))
+
+    def paths(self):
+        with self.lock:
+            return [ r[1] for r in self.requests ]
+
+
+class TileDownloaderTest(unittest.TestCase):
+    '''TileDownloader fetching from a local server'''
+
+    def setUp(self):
+        self.server = TileServer()
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.tmpdir = tempfile.mkdtemp(prefix='test_tile_downloader')
+        self.store = mp_tilestore.DirectoryTileStore(self.tmpdir)
+        self.done = []
+        self.done_cond = threading.Condition()
+        self.downloader = None
+
+    def tearDown(self):
+        if self.downloader is not None:
+            self.downloader.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def on_result(self, key, ok):
+        with self.done_cond:
+            self.done.append((key, ok))
+            self.done_cond.notify_all()
+
+    def wait_done(self, count, timeout=10):
+        '''wait for count tiles to finish'''
+        end = time.time() + timeout
+        with self.done_cond:
+            while len(self.done) < count and time.time() < end:
+                self.done_cond.wait(0.1)
+        self.assertEqual(len(self.done), count)
+
+    def make_downloader(self, workers, rate=1000.0):
+        self.downloader = mp_tile_downloader.TileDownloader(self.store, workers=workers,
+                                                            rate_limits={ SERVICE : rate },
+                                                            on_result=self.on_result)
+        return self.downloader
+
+    def key(self, i):
+        return ((i, 0), 10, SERVICE)
+
+    def url(self, i):
+        return 'http://127.0.0.1:%u/10/%u/0.png' % (self.server.server_address[1], i)
+
+    def test_priority_order(self):
+        '''queued tiles are fetched lowest priority value first, with a
+        re-request changing the priority of a pending tile'''
+        dl = self.make_downloader(workers=1)
+        priorities = [ 5, 3, 9, 1, 7, 2, 8 ]
+        # hold the lock so nothing is fetched until all are queued
+        with dl.lock:
+            for i in range(len(priorities)):
+                dl.request(self.key(i), self.url(i), SERVICE, priorities[i])
+            dl.request(self.key(6), self.url(6), SERVICE, 0)
+        self.wait_done(len(priorities))
+        order = [ int(p.split('/')[2]) for p in self.server.paths() ]
+        self.assertEqual(order, [ 6, 3, 5, 1, 0, 4, 2 ])
+        self.assertEqual([ k for (k, ok) in self.done ], [ self.key(i) for i in order ])
+        self.assertTrue(all([ ok for (k, ok) in self.done ]))
+        (data, mtime) = self.store.get(self.key(3))
+        self.assertEqual(data, b'IMG/10/3/0.png')
+
+    def test_retain(self):
+        '''tiles not retained are cancelled before they are fetched'''
+        dl = self.make_downloader(workers=2)
+        with dl.lock:
+            for i in range(10):
+                dl.request(self.key(i), self.url(i), SERVICE, i)
+            dl.retain(set([ self.key(i) for i in range(0, 10, 2) ]))
+        self.wait_done(5)
+        time.sleep(0.2)
+        fetched = sorted([ int(p.split('/')[2]) for p in self.server.paths() ])
+        self.assertEqual(fetched, [ 0, 2, 4, 6, 8 ])
+        self.assertEqual(dl.cancelled, 5)
+        self.assertEqual(dl.tiles_pending(), 0)
+        self.assertEqual(self.store.get(self.key(1)), (None, None))
+
+    def test_rate_limit(self):
+        '''requests to a service are spaced by its rate limit, across
+        all workers'''
+        rate = 20.0
+        dl = self.make_downloader(workers=4, rate=rate)
+        with dl.lock:
+            for i in range(8):
+                dl.request(self.key(i), self.url(i), SERVICE, i)
+        self.wait_done(8)
+        times = sorted([ r[0] for r in self.server.requests ])
+        self.assertEqual(len(times), 8)
+        # allow for timer and scheduling jitter
+        self.assertTrue(times[-1] - times[0] >= 0.9 * 7 / rate, times)
+        gaps = [ times[i+1] - times[i] for i in range(len(times)-1) ]
+        self.assertTrue(min(gaps) >= 0.5 / rate, gaps)
+
+    def test_connection_reuse(self):
+        '''a worker sends all its requests over one kept-alive connection'''
+        dl = self.make_downloader(workers=1)
+        with dl.lock:
+            for i in range(10):
+                dl.request(self.key(i), self.url(i), SERVICE, i)
+        self.wait_done(10)
+        self.assertEqual(dl.requests, 10)
+        self.assertEqual(dl.connections, 1)
+        self.assertTrue(dl.requests > dl.connections)
+        clients = set([ r[2] for r in self.server.requests ])
+        self.assertEqual(len(clients), 1)
+        self.assertEqual(dl.downloaded, 10)
+
+    def test_stop(self):
+        '''stop() waits for the workers, so the store can be closed, and
+        tiles still waiting for the rate limit are not fetched'''
+        self.store = mp_tilestore.SQLiteTileStore(os.path.join(self.tmpdir, 'tiles.mbtiles'))
+        dl = self.make_downloader(workers=4, rate=4.0)
+        with dl.lock:
+            for i in range(8):
+                dl.request(self.key(i), self.url(i), SERVICE, i)
+            workers = list(dl.workers)
+        self.wait_done(1)
+        dl.stop()
+        self.assertFalse(True in [ t.is_alive() for t in workers ])
+        self.assertEqual(dl.workers, [])
+        self.store.close()
+        self.assertTrue(len(self.server.requests) < 8)
+
+if __name__ == '__main__':
+    unittest.main()
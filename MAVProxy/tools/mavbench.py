@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+'''
+benchmark the MAVProxy routing, parsing and module pipeline
+
+starts mavproxy.py headless with a given module set, feeds it a
+synthetic vehicle stream over local UDP and listens on N UDP outputs.
+Reports throughput, per message latency percentiles (vehicle send to
+output receive), loss, and the CPU and memory use of the mavproxy
+process, and writes the results as JSON so runs can be compared
+between releases. Linux only, as CPU and memory come from /proc
+
+    mavbench.py --rate 2000 --duration 30 --outputs 2 --modules wp,param,adsb --json bench.json
+'''
+
+import sys, os, time, json, socket, signal, platform, subprocess, tempfile, shutil
+import multiprocessing
+from optparse import OptionParser
+
+# default mix of message types and relative rates, roughly an ArduPilot stream
+MESSAGE_MIX = [ ('HEARTBEAT', 1),
+                ('SYS_STATUS', 2),
+                ('SYSTEM_TIME', 1),
+                ('ATTITUDE', 10),
+                ('GLOBAL_POSITION_INT', 5),
+                ('GPS_RAW_INT', 5),
+                ('VFR_HUD', 5),
+                ('RAW_IMU', 10),
+                ('SCALED_PRESSURE', 5),
+                ('SERVO_OUTPUT_RAW', 5),
+                ('RC_CHANNELS', 5),
+                ('NAV_CONTROLLER_OUTPUT', 5),
+                ('MISSION_CURRENT', 2) ]
+
+def make_message(mav, mtype, n):
+    '''build a message of the given type, with fields that change with n.
+    Every message carries n, so frames are unique and can be matched up
+    at the outputs after the sequence number wraps'''
+    ms = n & 0xFFFFFFFF
+    if mtype == 'HEARTBEAT':
+        return mav.heartbeat_encode(2, 3, 81, ms, 4)
+    if mtype == 'SYS_STATUS':
+        return mav.sys_status_encode(0, 0, 0, 500, 12000, 100, 80, 0, 0, n & 0xFFFF, (n >> 16) & 0xFFFF, 0, 0)
+    if mtype == 'SYSTEM_TIME':
+        return mav.system_time_encode(int(time.time()*1.0e6), ms)
+    if mtype == 'ATTITUDE':
+        return mav.attitude_encode(ms, 0.01*(n%100), 0.02, 0.03, 0, 0, 0)
+    if mtype == 'GLOBAL_POSITION_INT':
+        return mav.global_position_int_encode(ms, -353632610 + n%1000, 1491652370, 584000, 20000, 0, 0, 0, 0)
+    if mtype == 'GPS_RAW_INT':
+        return mav.gps_raw_int_encode(ms*1000, 3, -353632610, 1491652370, 584000, 100, 100, 0, 0, 10)
+    if mtype == 'VFR_HUD':
+        return mav.vfr_hud_encode(10, 10, 90, 50, n & 0xFFFFFF, 0)
+    if mtype == 'RAW_IMU':
+        return mav.raw_imu_encode(ms*1000, n%100, 0, 1000, 0, 0, 0, 100, 100, 100)
+    if mtype == 'SCALED_PRESSURE':
+        return mav.scaled_pressure_encode(ms, 1013.0, 0, 2500)
+    if mtype == 'SERVO_OUTPUT_RAW':
+        return mav.servo_output_raw_encode((ms*1000) & 0xFFFFFFFF, 0, 1500, 1500, 1500, 1500, 1000, 1000, 1000, 1000)
+    if mtype == 'RC_CHANNELS':
+        return mav.rc_channels_encode(ms, 8, 1500, 1500, 1000, 1500, 1000, 1000, 1000, 1000,
+                                      0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 255)
+    if mtype == 'NAV_CONTROLLER_OUTPUT':
+        return mav.nav_controller_output_encode(0, 0, 90, 90, 100, 0, 0, n & 0xFFFFFF)
+    if mtype == 'MISSION_CURRENT':
+        return mav.mission_current_encode(n & 0xFFFF)
+    raise ValueError("unknown message type %s" % mtype)
+
+def vehicle_process(port, rate, duration, dialect, result_pipe):
+    '''send a synthetic vehicle stream to mavproxy, returning the send time of each frame'''
+    os.environ['MAVLINK_DIALECT'] = dialect
+    from pymavlink import mavutil
+    mavutil.set_dialect(dialect)
+    mav = mavutil.mavlink.MAVLink(None, srcSystem=1, srcComponent=1)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(0)
+    dest = ('127.0.0.1', port)
+    schedule = []
+    for (mtype, weight) in MESSAGE_MIX:
+        schedule.extend([mtype] * weight)
+    sent = {}
+    dropped = 0
+    n = 0
+    start = time.time()
+    while True:
+        now = time.time()
+        if now - start >= duration:
+            break
+        due = int((now - start) * rate)
+        while n < due:
+            m = make_message(mav, schedule[n % len(schedule)], n)
+            buf = bytes(m.pack(mav))
+            # pack() doesn't advance the sequence number, only send() does
+            mav.seq = (mav.seq + 1) % 256
+            try:
+                sock.sendto(buf, dest)
+                sent[buf] = time.time()
+            except socket.error:
+                dropped += 1
+            n += 1
+        try:
+            # discard anything mavproxy sends to the vehicle
+            while True:
+                sock.recv(65536)
+        except socket.error:
+            pass
+        time.sleep(0.002)
+    result_pipe.send((sent, n, dropped))
+
+def listener_process(port, duration, result_pipe):
+    '''receive from a mavproxy output, returning the receive time of each frame'''
+    from MAVProxy.modules.lib import mp_framer
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', port))
+    sock.settimeout(0.1)
+    framer = mp_framer.MAVFramer()
+    received = []
+    end = time.time() + duration
+    while time.time() < end:
+        try:
+            data = sock.recv(65536)
+        except socket.timeout:
+            continue
+        t = time.time()
+        for (msgid, src, comp, seq, frame) in framer.parse(data):
+            if msgid is not None:
+                received.append((frame, t))
+    result_pipe.send(received)
+
+def proc_stats(pid):
+    '''return (cpu seconds, rss bytes) for a process from /proc'''
+    f = open('/proc/%u/stat' % pid)
+    fields = f.read().split(')')[-1].split()
+    f.close()
+    ticks = os.sysconf(os.sysconf_names['SC_CLK_TCK'])
+    cpu = (int(fields[11]) + int(fields[12])) / float(ticks)
+    rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+    return (cpu, rss)
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0
+    idx = int(round((len(sorted_values)-1) * pct / 100.0))
+    return sorted_values[idx]
+
+def free_port():
+    '''return a free local UDP port'''
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def mavproxy_command():
+    '''command to start mavproxy from the MAVProxy package in use, which
+    works both from a source tree and once installed'''
+    return [ sys.executable, '-m', 'MAVProxy.mavproxy' ]
+
+def run_benchmark(opts):
+    '''run one benchmark, returning a results dictionary'''
+    master_port = free_port()
+    output_ports = [ free_port() for i in range(opts.outputs) ]
+    tmpdir = tempfile.mkdtemp(prefix='mavbench')
+    cmd = mavproxy_command() + [
+            '--master=udpin:127.0.0.1:%u' % master_port,
+            '--daemon', '--nowait',
+            '--state-basedir=%s' % tmpdir,
+            '--default-modules=%s' % opts.modules,
+            '--dialect=%s' % opts.dialect ]
+    for p in output_ports:
+        cmd.append('--out=udp:127.0.0.1:%u' % p)
+    cmds = []
+    if opts.fastfwd:
+        cmds.append('set fastfwd 1')
+    if opts.cmd:
+        cmds.append(opts.cmd)
+    if cmds:
+        cmd.append('--cmd=%s' % ';'.join(cmds))
+    devnull = open(os.devnull, 'w')
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=devnull, stderr=subprocess.STDOUT,
+                            cwd=tmpdir, preexec_fn=os.setsid)
+    try:
+        time.sleep(opts.warmup)
+        if proc.poll() is not None:
+            raise RuntimeError("mavproxy exited during startup, run '%s' to see why" % ' '.join(cmd))
+
+        listeners = []
+        for p in output_ports:
+            (parent, child) = multiprocessing.Pipe()
+            lp = multiprocessing.Process(target=listener_process, args=(p, opts.duration+2, child))
+            lp.start()
+            listeners.append((lp, parent))
+        (vparent, vchild) = multiprocessing.Pipe()
+        vp = multiprocessing.Process(target=vehicle_process,
+                                     args=(master_port, opts.rate, opts.duration, opts.dialect, vchild))
+
+        (cpu0, rss0) = proc_stats(proc.pid)
+        t0 = time.time()
+        vp.start()
+        samples = []
+        while vp.is_alive() and not vparent.poll():
+            time.sleep(1)
+            (cpu, rss) = proc_stats(proc.pid)
+            samples.append({ 'time' : time.time() - t0, 'cpu' : cpu - cpu0, 'rss' : rss })
+        (sent, num_sent, send_dropped) = vparent.recv()
+        vp.join()
+        (cpu1, rss1) = proc_stats(proc.pid)
+        t1 = time.time()
+        received = [ parent.recv() for (lp, parent) in listeners ]
+        for (lp, parent) in listeners:
+            lp.join()
+    finally:
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+            for i in range(50):
+                if proc.poll() is not None:
+                    break
+                time.sleep(0.1)
+            if proc.poll() is None:
+                os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        devnull.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    elapsed = t1 - t0
+    outputs = []
+    all_latency = []
+    for i in range(len(received)):
+        latency = []
+        for (frame, t) in received[i]:
+            ts = sent.get(frame, None)
+            if ts is not None:
+                latency.append(t - ts)
+        latency.sort()
+        all_latency.extend(latency)
+        outputs.append({ 'port' : output_ports[i],
+                         'received' : len(received[i]),
+                         'matched' : len(latency),
+                         'loss_pct' : 100.0 * (1.0 - len(latency) / float(max(num_sent, 1))),
+                         'rate' : len(received[i]) / opts.duration,
+                         'latency_p50_ms' : percentile(latency, 50) * 1000,
+                         'latency_p99_ms' : percentile(latency, 99) * 1000 })
+    all_latency.sort()
+    return { 'config' : { 'rate' : opts.rate,
+                          'duration' : opts.duration,
+                          'outputs' : opts.outputs,
+                          'modules' : opts.modules.split(','),
+                          'fastfwd' : opts.fastfwd,
+                          'dialect' : opts.dialect,
+                          'cmd' : opts.cmd },
+             'environment' : { 'time' : time.time(),
+                               'python' : platform.python_version(),
+                               'platform' : platform.platform(),
+                               'cpus' : multiprocessing.cpu_count() },
+             'results' : { 'sent' : num_sent,
+                           'send_dropped' : send_dropped,
+                           'send_rate' : num_sent / opts.duration,
+                           'forward_rate' : sum([ o['rate'] for o in outputs ]),
+                           'latency_p50_ms' : percentile(all_latency, 50) * 1000,
+                           'latency_p90_ms' : percentile(all_latency, 90) * 1000,
+                           'latency_p99_ms' : percentile(all_latency, 99) * 1000,
+                           'latency_max_ms' : (all_latency[-1] * 1000) if all_latency else 0,
+                           'cpu_pct' : 100.0 * (cpu1 - cpu0) / elapsed,
+                           'rss_start' : rss0,
+                           'rss_end' : rss1,
+                           'rss_growth' : rss1 - rss0,
+                           'outputs' : outputs,
+                           'samples' : samples } }
+
+def print_results(r):
+    c = r['config']
+    res = r['results']
+    print("rate %u/s for %.0fs, %u outputs, modules %s%s" % (c['rate'], c['duration'], c['outputs'],
+                                                             ','.join(c['modules']),
+                                                             ' (fastfwd)' if c['fastfwd'] else ''))
+    print("sent %u (%.0f/s), forwarded %.0f/s" % (res['sent'], res['send_rate'], res['forward_rate']))
+    print("latency p50 %.2fms p90 %.2fms p99 %.2fms max %.2fms" % (res['latency_p50_ms'], res['latency_p90_ms'],
+                                                                   res['latency_p99_ms'], res['latency_max_ms']))
+    print("cpu %.1f%% rss %.1fMB growth %.1fMB" % (res['cpu_pct'], res['rss_end']/1.0e6, res['rss_growth']/1.0e6))
+    for o in res['outputs']:
+        print("  output %u: %u received, %.2f%% loss, p50 %.2fms p99 %.2fms" % (o['port'], o['received'], o['loss_pct'],
+                                                                               o['latency_p50_ms'], o['latency_p99_ms']))
+
+if __name__ == '__main__':
+    parser = OptionParser("mavbench.py [options]")
+    parser.add_option("--rate", type='float', default=1000, help="vehicle messages per second")
+    parser.add_option("--duration", type='float', default=20, help="seconds to run for")
+    parser.add_option("--warmup", type='float', default=3, help="seconds to let mavproxy start")
+    parser.add_option("--outputs", type='int', default=1, help="number of UDP outputs")
+    parser.add_option("--modules", default="log,wp,param,adsb", help="module list to load")
+    parser.add_option("--fastfwd", action='store_true', default=False, help="enable the forwarding fast path")
+    parser.add_option("--dialect", default="ardupilotmega", help="MAVLink dialect")
+    parser.add_option("--cmd", default=None, help="extra mavproxy commands, separated by ;")
+    parser.add_option("--json", default=None, help="append results as a line of JSON to this file")
+    (opts, args) = parser.parse_args()
+
+    if platform.system() != 'Linux':
+        print("mavbench needs Linux")
+        sys.exit(1)
+
+    result = run_benchmark(opts)
+    print_results(result)
+    if opts.json is not None:
+        f = open(opts.json, mode='a')
+        f.write(json.dumps(result) + "\n")
+        f.close()
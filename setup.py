@@ -69,8 +69,10 @@ on how to use MAVProxy.''',
       scripts=['MAVProxy/mavproxy.py',
                'MAVProxy/tools/mavflightview.py',
                'MAVProxy/tools/MAVExplorer.py',
+               'MAVProxy/tools/mavbench.py',
                'MAVProxy/modules/mavproxy_map/mp_slipmap.py',
-               'MAVProxy/modules/mavproxy_map/mp_tile.py'],
+               'MAVProxy/modules/mavproxy_map/mp_tile.py',
+               'MAVProxy/modules/mavproxy_map/mp_tilestore.py'],
       package_data={'MAVProxy':
                     package_data}
     )